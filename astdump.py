@@ -5,10 +5,27 @@ returned by ast.parse(expression, mode='eval').body
 
 It is useful if you're making changes to the convert_java.py script
 and want to know what the ast of some python expression looks like.
+
+With --batch it reads many snippets instead (one per line from files
+or stdin, or every python snippet of a polyglot test directory with
+--polyglot), writes a compact one-line dump per snippet and/or prints
+a histogram of node types, operators and ReQL method names over all of
+them. That tells you which converter paths are hot and what a
+realistic benchmark corpus looks like.
 '''
 
+import argparse
 import ast
 import json
+import sys
+from collections import Counter
+
+import multireql
+from conversion_utils import add_is_reql_flags
+
+# Attributes that only say where the node came from
+POSITION_FIELDS = frozenset((
+    'lineno', 'col_offset', 'end_lineno', 'end_col_offset'))
 
 
 def convert_to_dict(node):
@@ -26,6 +43,33 @@ def convert_to_dict(node):
         return repr(node)
 
 
+def is_constant_value(node, name):
+    return type(node) == ast.Constant and name == 'value'
+
+
+def compact(node):
+    '''Like convert_to_dict, but without positions or empty fields, and
+    with each node as [type, {fields}] to keep the dump short'''
+    if isinstance(node, list):
+        return [compact(n) for n in node]
+    elif isinstance(node, ast.AST):
+        fields = {}
+        for name, value in ast.iter_fields(node):
+            if name in POSITION_FIELDS or value == [] or \
+               (value is None and not is_constant_value(node, name)):
+                # None is a missing optional field, except as a literal
+                continue
+            fields[name] = compact(value)
+        if getattr(node, 'is_reql', False):
+            fields['is_reql'] = True
+        return [node.__class__.__name__, fields] if fields \
+            else [node.__class__.__name__]
+    elif node is None or isinstance(node, (int, float, str, bool)):
+        return node
+    else:
+        return repr(node)
+
+
 def get_astjson(expr, mode='eval'):
     asta = ast.parse(expr, mode=mode).body
     if isinstance(asta, list):
@@ -38,6 +82,145 @@ def ppast(expr, mode='eval'):
     astjson = get_astjson(expr, mode=mode)
     print(astjson)
 
+
+class Histogram(object):
+    '''Counts node types, operators and ReQL method names'''
+
+    def __init__(self):
+        self.node_types = Counter()
+        self.operators = Counter()
+        self.methods = Counter()
+        self.snippets = 0
+        self.errors = 0
+
+    def add(self, node):
+        self.snippets += 1
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            kind = node.__class__.__name__
+            if isinstance(node, (ast.operator, ast.unaryop, ast.cmpop,
+                                 ast.boolop)):
+                self.operators[kind] += 1
+                continue
+            if isinstance(node, ast.expr_context):
+                continue
+            self.node_types[kind] += 1
+            if kind == 'Call' and getattr(node, 'is_reql', False) and \
+               type(node.func) == ast.Attribute:
+                self.methods[node.func.attr] += 1
+            stack.extend(ast.iter_child_nodes(node))
+
+    def as_dict(self):
+        return {
+            'snippets': self.snippets,
+            'errors': self.errors,
+            'node_types': dict(self.node_types),
+            'operators': dict(self.operators),
+            'methods': dict(self.methods),
+        }
+
+    def format(self, top=20):
+        lines = ['%d snippets, %d unparseable' % (self.snippets,
+                                                  self.errors)]
+        for title, counter in (('node types', self.node_types),
+                               ('operators', self.operators),
+                               ('reql methods', self.methods)):
+            total = sum(counter.values()) or 1
+            lines.append('')
+            lines.append('%s (%d distinct):' % (title, len(counter)))
+            for name, count in counter.most_common(top):
+                lines.append('  %-24s %8d %5.1f%%' % (
+                    name, count, 100.0 * count / total))
+        return '\n'.join(lines)
+
+
+def file_snippets(files):
+    '''One snippet per non-empty line'''
+    for f in files:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def run_batch(snippets, dump=None, histogram=None):
+    '''Parses and flags every snippet, writing a compact JSON line per
+    snippet to `dump` and counting it in `histogram`'''
+    for snippet in snippets:
+        try:
+            node = ast.parse(snippet, mode='eval').body
+            add_is_reql_flags(node)
+        except Exception as e:
+            if histogram is not None:
+                histogram.errors += 1
+            if dump is not None:
+                dump.write(json.dumps({'snippet': snippet, 'error': str(e)},
+                                      separators=(',', ':')))
+                dump.write('\n')
+            continue
+        if histogram is not None:
+            histogram.add(node)
+        if dump is not None:
+            dump.write(json.dumps({'snippet': snippet, 'ast': compact(node)},
+                                  separators=(',', ':')))
+            dump.write('\n')
+    return histogram
+
+
+def has_flags(argv):
+    return any(arg.startswith('--') or arg == '-h' for arg in argv)
+
+
+def main():
+    if not has_flags(sys.argv[1:]):
+        # plain expressions, which may start with a minus sign:
+        # ./astdump.py "-r.expr(1)"
+        for expr in sys.argv[1:]:
+            ppast(expr)
+        return
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('expr', nargs='*',
+                        help='an expression, or files with --batch. Put '
+                        'expressions starting with "-" after --')
+    parser.add_argument('--batch', action='store_true',
+                        help='read snippets from files (or stdin)')
+    parser.add_argument('--polyglot', metavar='TEST_DIR',
+                        help='read the snippets of a polyglot directory')
+    parser.add_argument('--dump', metavar='PATH',
+                        help='write the compact dump here ("-" for stdout)')
+    parser.add_argument('--histogram', action='store_true')
+    parser.add_argument('--json', action='store_true',
+                        help='print the histogram as json')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    if not (args.batch or args.polyglot):
+        for expr in args.expr:
+            ppast(expr)
+        return
+    if args.polyglot:
+        snippets = multireql.every_snippet(args.polyglot)
+    elif args.expr:
+        snippets = file_snippets(open(path) for path in args.expr)
+    else:
+        snippets = file_snippets([sys.stdin])
+    histogram = Histogram() if args.histogram or not args.dump else None
+    dump = None
+    if args.dump == '-':
+        dump = sys.stdout
+    elif args.dump:
+        dump = open(args.dump, 'w')
+    try:
+        run_batch(snippets, dump, histogram)
+    finally:
+        if dump not in (None, sys.stdout):
+            dump.close()
+    if histogram is not None:
+        if args.json:
+            print(json.dumps(histogram.as_dict(), indent=4, sort_keys=True))
+        else:
+            print(histogram.format(args.top))
+
+
 if __name__ == "__main__":
-    import sys
-    ppast(sys.argv[1])
+    main()
@@ -0,0 +1,156 @@
+'''asyncio entry points, for services that can't afford to block their
+event loop on a big snippet.
+
+The parse and emit work of each snippet runs on an executor: a thread
+pool by default, or a process pool (`make_executor('process')`) when
+the GIL is the bottleneck. An AsyncTranspiler never has more than
+`max_in_flight` snippets on its executor, however many coroutines call
+it.
+
+    transpiler = AsyncTranspiler(max_in_flight=8)
+    result = await transpiler.transpile("r.table('x').count()")
+    async for result in transpiler.transpile_stream(snippets):
+        ...
+
+`transpile_stream` yields results in input order and only reads the
+next snippet when there's room for it, so a consumer that falls behind
+slows the producer down instead of piling up results in memory.
+
+Cancelling a call takes its snippet off the executor if it hasn't
+started yet. One that has already started runs to completion in the
+background (threads can't be interrupted), but its result is dropped
+and its slot is only given back once it's done, so the in-flight limit
+holds.
+'''
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import os
+
+import batch
+
+DEFAULT_MAX_IN_FLIGHT = 4 * (os.cpu_count() or 1)
+
+EXECUTOR_KINDS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def make_executor(kind='thread', max_workers=None):
+    '''A thread or process pool to pass to AsyncTranspiler. The caller
+    owns it and shuts it down'''
+    try:
+        executor_class = EXECUTOR_KINDS[kind]
+    except KeyError:
+        raise ValueError("Unknown executor kind %r, expected one of %s"
+                         % (kind, ', '.join(sorted(EXECUTOR_KINDS))))
+    return executor_class(max_workers)
+
+
+class AsyncTranspiler(object):
+    '''batch.transpile_one for asyncio code. `executor` is any
+    concurrent.futures executor; with None the transpiler starts its
+    own thread pool, which close() (or leaving an `async with` block)
+    shuts down. The other arguments are the ones of transpile_one and
+    apply to every snippet'''
+
+    def __init__(self, langs=batch.DEFAULT_LANGS, reql_vars=None,
+                 executor=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 precheck=True, budget=None, fold=False):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_in_flight)
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        # frozen so a process pool gets the same arguments every time
+        self.work = functools.partial(
+            batch.transpile_one, langs=batch.check_langs(langs),
+            reql_vars=None if reql_vars is None else frozenset(reql_vars),
+            precheck=precheck, budget=budget, fold=fold)
+        self._slots = None
+
+    @property
+    def slots(self):
+        # created on first use, inside the loop that will use it
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        return self._slots
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def transpile(self, snippet):
+        '''Returns the TranspileResult of one snippet'''
+        async with self.slots:
+            work = self.executor.submit(self.work, snippet)
+            future = asyncio.wrap_future(work)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # not started yet: it never will be. Otherwise keep the
+                # slot until the executor is really done with it
+                if not work.cancel():
+                    await asyncio.wait([future])
+                raise
+
+    async def transpile_stream(self, snippets, window=None):
+        '''Yields the TranspileResult of each snippet, in order.
+        `snippets` is an iterable or an async iterable. At most
+        `window` (default: max_in_flight) snippets are read ahead of
+        the result being waited for'''
+        window = window or self.max_in_flight
+        pending = deque()
+        try:
+            async for snippet in _aiter(snippets):
+                pending.append(asyncio.ensure_future(self.transpile(snippet)))
+                if len(pending) >= window:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # the consumer stopped early, was cancelled or a snippet
+            # failed: the remaining ones aren't wanted any more
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+
+async def _aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def transpile(snippet, langs=batch.DEFAULT_LANGS, reql_vars=None,
+                    executor=None, **kwargs):
+    '''One-off AsyncTranspiler.transpile. Use an AsyncTranspiler to
+    share an in-flight limit between calls'''
+    async with AsyncTranspiler(langs, reql_vars, executor,
+                               **kwargs) as transpiler:
+        return await transpiler.transpile(snippet)
+
+
+async def transpile_stream(snippets, langs=batch.DEFAULT_LANGS,
+                           reql_vars=None, executor=None,
+                           max_in_flight=DEFAULT_MAX_IN_FLIGHT, **kwargs):
+    '''One-off AsyncTranspiler.transpile_stream'''
+    async with AsyncTranspiler(langs, reql_vars, executor, max_in_flight,
+                               **kwargs) as transpiler:
+        async for result in transpiler.transpile_stream(snippets):
+            yield result
@@ -0,0 +1,365 @@
+'''Library entry points for transpiling many snippets in one go.
+
+Unlike the helpers in multireql.py nothing is printed: failures are
+returned as TranspileError records alongside the successful outputs.
+'''
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import ast
+import os
+import threading
+import time
+
+import capabilities
+import conversion_utils
+import fastpath
+import folding
+import metrics
+import ruby_converter
+import js_converter
+import java_converter
+import wire_converter
+
+LANGUAGES = OrderedDict([
+    ('rb', ruby_converter),
+    ('js', js_converter),
+    ('java', java_converter),
+    ('json', wire_converter),
+])
+
+# The wire format is opt-in: it's a fingerprint, not a driver language
+DEFAULT_LANGS = ('rb', 'js', 'java')
+
+# How many distinct snippets transpile_many remembers for deduplication
+DEFAULT_DEDUPE_CACHE_SIZE = 65536
+
+# Converters are reused, but never shared between threads. Parsed trees
+# are created per call and only flagged and read by the thread that
+# parsed them, so the whole parse -> flag -> emit pipeline can run
+# concurrently without locks.
+_local = threading.local()
+
+
+class TranspileError(object):
+    '''Why a snippet couldn't be converted. `stage` is "parse",
+    "precheck" or "transpile". `kind` is the name of the exception that
+    was raised (a budgets.BudgetExceeded subclass when the snippet went
+    over its budget), or the capabilities reason code for "precheck"'''
+
+    __slots__ = ('stage', 'lang', 'kind', 'message')
+
+    def __init__(self, stage, lang, kind, message):
+        self.stage = stage
+        self.lang = lang
+        self.kind = kind
+        self.message = message
+
+    @classmethod
+    def from_exception(cls, stage, lang, exc):
+        return cls(stage, lang, type(exc).__name__, str(exc))
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'lang': self.lang,
+            'kind': self.kind,
+            'message': self.message,
+        }
+
+    def __repr__(self):
+        return 'TranspileError(%r, %r, %r, %r)' % (
+            self.stage, self.lang, self.kind, self.message)
+
+
+class TranspileResult(object):
+    '''Outputs for one snippet. `outputs` maps language to the
+    converted source, `errors` maps language to a TranspileError'''
+
+    __slots__ = ('snippet', 'outputs', 'errors')
+
+    def __init__(self, snippet, outputs=None, errors=None):
+        self.snippet = snippet
+        self.outputs = outputs or {}
+        self.errors = errors or {}
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def as_dict(self):
+        return {
+            'snippet': self.snippet,
+            'outputs': self.outputs,
+            'errors': {lang: err.as_dict()
+                       for lang, err in self.errors.items()},
+        }
+
+    def __repr__(self):
+        return 'TranspileResult(%r, outputs=%r, errors=%r)' % (
+            self.snippet, self.outputs, self.errors)
+
+
+def check_langs(langs):
+    langs = tuple(langs)
+    for lang in langs:
+        if lang not in LANGUAGES:
+            raise ValueError("Unknown language: %s" % lang)
+    return langs
+
+
+def parse(snippet, reql_vars=None, tracker=None, mode='eval'):
+    '''Parses and flags a snippet, raising on failure. With a
+    budgets.BudgetTracker the source size is checked before parsing and
+    the tree's depth and size before flagging. With mode="exec" the
+    snippet must be a single statement, like a definition'''
+    if not metrics.enabled:
+        return _parse(snippet, reql_vars, tracker, mode)
+    start = time.perf_counter()
+    metrics.INPUT_BYTES.inc(amount=metrics.utf8_size(snippet))
+    try:
+        parsed = _parse(snippet, reql_vars, tracker, mode)
+    except Exception:
+        metrics.PARSES.inc('error')
+        raise
+    finally:
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                      'parse', '')
+    metrics.PARSES.inc('success')
+    return parsed
+
+
+def _parse(snippet, reql_vars, tracker, mode):
+    if tracker is not None:
+        tracker.check_source(snippet)
+    parsed = ast.parse(snippet, mode=mode).body
+    if mode == 'exec':
+        if len(parsed) != 1:
+            raise ValueError("Expected one statement, got %d" % len(parsed))
+        parsed = parsed[0]
+    if tracker is not None:
+        tracker.check_tree(parsed)
+    conversion_utils.add_is_reql_flags(parsed, reql_vars, budget=tracker)
+    return parsed
+
+
+def converter_for(lang, reql_vars=None):
+    '''Returns the calling thread's reusable converter for `lang`'''
+    reql_vars = None if reql_vars is None else frozenset(reql_vars)
+    try:
+        converters = _local.converters
+    except AttributeError:
+        converters = _local.converters = {}
+    converter = converters.get((lang, reql_vars))
+    if converter is None:
+        module = LANGUAGES[lang]
+        if reql_vars is None:
+            converter = module.Visitor()
+        else:
+            converter = module.Visitor(reql_vars=reql_vars)
+        converters[(lang, reql_vars)] = converter
+    return converter
+
+
+def transpile_tree(parsed, lang, reql_vars=None, tracker=None, fold=False):
+    '''Converts an already flagged tree, raising on failure. With `fold`
+    the native constant subexpressions are computed first, see
+    folding.py'''
+    if fold:
+        parsed = folding.fold(parsed, lang)
+    converter = converter_for(lang, reql_vars)
+    converter.reset(None if tracker is None else tracker.output())
+    return converter.convert(parsed)
+
+
+def transpile_one(snippet, langs=DEFAULT_LANGS, reql_vars=None,
+                  precheck=True, budget=None, fast=True, fold=False,
+                  parser=None):
+    '''Parses the snippet once and converts it to every language.
+    With `precheck`, languages that capabilities.py says can't handle
+    the snippet are skipped without emitting anything. `budget` is a
+    budgets.Budget shared by all the languages of the snippet.
+
+    With `fast`, simple method chains with literal arguments skip the
+    parser and go through fastpath.py, which gives the same output.
+    Budgeted snippets always take the full path.
+
+    `parser(snippet, reql_vars)` replaces parse() for unbudgeted
+    snippets, like a snippet_ir.TreeCache's parser'''
+    if fast and budget is None:
+        start = time.perf_counter() if metrics.enabled else None
+        outputs = fastpath.transpile(snippet, langs, reql_vars)
+        if outputs is not None:
+            if metrics.enabled:
+                count_fastpath(snippet, outputs, start)
+            return TranspileResult(snippet, outputs)
+    result = TranspileResult(snippet)
+    tracker = None if budget is None else budget.track()
+    try:
+        if parser is not None and tracker is None:
+            parsed = parser(snippet, reql_vars)
+        else:
+            parsed = parse(snippet, reql_vars, tracker)
+    except Exception as e:
+        for lang in langs:
+            result.errors[lang] = TranspileError.from_exception(
+                'parse', lang, e)
+            if metrics.enabled:
+                metrics.TRANSPILES.inc(lang, 'error')
+        return result
+    found = capabilities.features(parsed) if precheck else ()
+    for lang in langs:
+        reason = capabilities.reason_for(found, lang) if found else None
+        if reason is not None:
+            result.errors[lang] = TranspileError(
+                'precheck', lang, reason,
+                "Can't translate %s to %s" % (reason, lang))
+            if metrics.enabled:
+                metrics.TRANSPILES.inc(lang, 'skip')
+            continue
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            result.outputs[lang] = transpile_tree(
+                parsed, lang, reql_vars, tracker, fold)
+        except Exception as e:
+            result.errors[lang] = TranspileError.from_exception(
+                'transpile', lang, e)
+        if metrics.enabled:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                          'transpile', lang)
+            count_transpile(lang, result.outputs.get(lang))
+    return result
+
+
+def count_transpile(lang, output):
+    '''Records one language's outcome of a snippet in the metrics.
+    `output` is None if the conversion failed'''
+    if output is None:
+        metrics.TRANSPILES.inc(lang, 'error')
+    else:
+        metrics.TRANSPILES.inc(lang, 'success')
+        metrics.OUTPUT_BYTES.inc(lang, amount=metrics.utf8_size(output))
+
+
+def count_fastpath(snippet, outputs, start):
+    # the fast path doesn't parse, and converts every language in one go
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                  'fastpath', '')
+    metrics.INPUT_BYTES.inc(amount=metrics.utf8_size(snippet))
+    for lang, output in outputs.items():
+        count_transpile(lang, output)
+
+
+def transpile_many(snippets, langs=DEFAULT_LANGS, reql_vars=None,
+                   dedupe_cache_size=DEFAULT_DEDUPE_CACHE_SIZE,
+                   precheck=True, budget=None, fold=False):
+    '''Transpiles an iterable of snippets, yielding a TranspileResult
+    per snippet in input order. Works lazily, so `snippets` can be a
+    generator over more snippets than fit in memory.
+
+    Identical snippets are only parsed and converted once: the most
+    recent `dedupe_cache_size` distinct snippets are remembered (None
+    remembers all of them) and repeats get the same result object.
+
+    With a budgets.Budget every snippet gets its own tracker, so one
+    pathological snippet fails with a budget error instead of holding
+    up the rest.
+    '''
+    langs = check_langs(langs)
+    seen = OrderedDict()
+    for snippet in snippets:
+        result = seen.get(snippet)
+        if result is None:
+            result = transpile_one(
+                snippet, langs, reql_vars, precheck, budget, fold=fold)
+            seen[snippet] = result
+            if dedupe_cache_size is not None and \
+               len(seen) > dedupe_cache_size:
+                seen.popitem(last=False)
+        elif dedupe_cache_size is not None:
+            seen.move_to_end(snippet)
+        yield result
+
+
+class TranspileCache(object):
+    '''transpile_one with a memory, for long running processes that see
+    the same snippets over and over (like `generate.py --watch`). Keeps
+    the `max_size` most recently used results, None keeps them all'''
+
+    def __init__(self, max_size=DEFAULT_DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def transpile_one(self, snippet, langs=DEFAULT_LANGS, reql_vars=None,
+                      precheck=True, budget=None, fold=False, parser=None):
+        key = (snippet, tuple(langs),
+               None if reql_vars is None else frozenset(reql_vars),
+               precheck, fold)
+        result = self.results.get(key)
+        if result is not None:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+        self.misses += 1
+        result = self.results[key] = transpile_one(
+            snippet, langs, reql_vars, precheck, budget, fold=fold,
+            parser=parser)
+        if self.max_size is not None and len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        return result
+
+
+def transpile_threaded(snippets, langs=DEFAULT_LANGS, reql_vars=None,
+                       max_workers=None, window=None, precheck=True,
+                       budget=None, fold=False, model=None):
+    '''Like transpile_many, but converts snippets on a thread pool.
+
+    Results are still yielded in input order. At most `window`
+    snippets (default: 4 per worker) are in flight, so the input is
+    consumed lazily. On a free-threaded python build this scales with
+    the number of cores.
+
+    With a scheduling.CostModel as `model`, the snippets are read up
+    front instead and spread over the workers longest first, see
+    scheduling.transpile_scheduled.
+    '''
+    langs = check_langs(langs)
+    if model is not None:
+        # scheduling imports this module
+        import scheduling
+        results, _ = scheduling.transpile_scheduled(
+            snippets, langs, reql_vars, max_workers, model, precheck,
+            budget, fold)
+        for result in results:
+            yield result
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    window = window or 4 * max_workers
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = deque()
+        # snippet -> [future, number of pending results using it]
+        in_flight = {}
+        for snippet in snippets:
+            entry = in_flight.get(snippet)
+            if entry is None:
+                future = pool.submit(transpile_one, snippet, langs,
+                                     reql_vars, precheck, budget,
+                                     fold=fold)
+                entry = in_flight[snippet] = [future, 0]
+            entry[1] += 1
+            pending.append(snippet)
+            if len(pending) >= window:
+                yield _next_result(pending, in_flight)
+        while pending:
+            yield _next_result(pending, in_flight)
+
+
+def _next_result(pending, in_flight):
+    snippet = pending.popleft()
+    entry = in_flight[snippet]
+    entry[1] -= 1
+    if not entry[1]:
+        del in_flight[snippet]
+    return entry[0].result()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+'''Benchmarks for the transpiler. Run `./bench.py threads` to see how
+batch.transpile_threaded scales with the number of worker threads,
+`./bench.py fastpath` to compare fastpath.py with the full path,
+`./bench.py schedule` to compare equal chunks with cost-based
+scheduling (`./bench.py calibrate model.json` fits the cost model),
+`./bench.py intern` for the memory of interned trees.
+
+The thread scaling numbers are only interesting on a free-threaded
+(no-GIL) CPython build; with the GIL the speedup stays around 1x.
+'''
+
+from __future__ import print_function
+
+import argparse
+import marshal
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+import batch
+import fastpath
+import multireql
+import scheduling
+import snippet_ir
+
+SNIPPET_TEMPLATES = [
+    "r.db('test').table('t{n}').get_all({n}, index='id').count()",
+    "r.expr([{n}, 2, 3]).map(lambda x: x * {n} + 1).filter(lambda x: x > 2)",
+    "r.table('t{n}').filter(lambda doc: doc.get_field('age') > {n}).pluck('name')",
+    "r.expr({{'a': {n}, 'b': [1, 2, 'x']}}).merge({{'c': r.now()}})",
+    "r.range({n}).map(r.range(), lambda x, y: x + y).coerce_to('array')",
+]
+
+
+# Literal-only method chains, the kind fastpath.py handles
+CHAIN_TEMPLATES = [
+    "r.db('test').table('t{n}').get_all({n}, index='id').count()",
+    "r.table('t{n}').get('x').default(None)",
+    "r.expr('s{n}').add('x').to_json_string()",
+    "r.db('d').table('t', read_mode='outdated').between({n}, 10).limit(5)",
+]
+
+
+def synthetic_snippets(count):
+    '''Distinct snippets, so deduplication doesn't skew the numbers'''
+    for n in range(count):
+        template = SNIPPET_TEMPLATES[n % len(SNIPPET_TEMPLATES)]
+        yield template.format(n=n)
+
+
+def varied_snippets(count, seed=0):
+    '''Snippets whose cost varies by orders of magnitude, like the
+    corpus: mostly small ones, now and then a big literal or a deeply
+    nested query'''
+    rng = random.Random(seed)
+    for n in range(count):
+        kind = rng.random()
+        if kind < 0.05:
+            size = rng.randint(100, 3000)
+            yield 'r.expr([%s])' % ', '.join(
+                "{'k%d': %d}" % (i, i) for i in range(size))
+        elif kind < 0.1:
+            depth = rng.randint(5, 60)
+            yield 'r.expr(%d)' % n + '.add(r.expr(1)' * depth + ')' * depth
+        elif kind < 0.15:
+            yield 'r.expr(%r)' % ('x' * rng.randint(1000, 50000))
+        else:
+            yield SNIPPET_TEMPLATES[n % len(SNIPPET_TEMPLATES)].format(n=n)
+
+
+def gil_enabled():
+    return getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def time_run(snippets, workers):
+    start = time.perf_counter()
+    if workers == 0:
+        results = batch.transpile_many(snippets)
+    else:
+        results = batch.transpile_threaded(snippets, max_workers=workers)
+    for _ in results:
+        pass
+    return time.perf_counter() - start
+
+
+def bench_threads(count=20000, workers=(1, 2, 4, 8)):
+    snippets = list(synthetic_snippets(count))
+    print("Python %s, GIL %s" % (
+        sys.version.split()[0],
+        'enabled' if gil_enabled() else 'disabled'))
+    baseline = time_run(snippets, 0)
+    print("%-10s %10s %12s %8s" % ('workers', 'seconds', 'snippets/s',
+                                    'speedup'))
+    print("%-10s %10.3f %12.0f %8.2f" % ('serial', baseline,
+                                          count / baseline, 1.0))
+    for n in workers:
+        elapsed = time_run(snippets, n)
+        print("%-10d %10.3f %12.0f %8.2f" % (n, elapsed, count / elapsed,
+                                              baseline / elapsed))
+
+
+def bench_ir(count=20000):
+    '''Compares reparsing snippets with loading them from the IR'''
+    snippets = list(synthetic_snippets(count))
+    start = time.perf_counter()
+    trees = [batch.parse(s) for s in snippets]
+    parse_time = time.perf_counter() - start
+    encoded = [snippet_ir.dumps(t) for t in trees]
+    start = time.perf_counter()
+    for data in encoded:
+        snippet_ir.loads(data)
+    load_time = time.perf_counter() - start
+    print("%-22s %10.3f" % ('ast.parse + IsReql', parse_time))
+    print("%-22s %10.3f" % ('IR load', load_time))
+    print("%d snippets, %d bytes of source" % (
+        count, sum(len(s) for s in snippets)))
+    print("%-22s %10d bytes" % ('IR, one per snippet',
+                                sum(len(d) for d in encoded)))
+    # what an IRStore writes: all of them in one compressed file
+    print("%-22s %10d bytes" % ('IR store (zlib)', len(zlib.compress(
+        marshal.dumps([snippet_ir.encode(t) for t in trees]),
+        snippet_ir.COMPRESSION_LEVEL))))
+
+
+def bench_fastpath(count=20000):
+    '''Compares the fast path with the full path on simple chains'''
+    snippets = [CHAIN_TEMPLATES[n % len(CHAIN_TEMPLATES)].format(n=n)
+                for n in range(count)]
+    report = fastpath.differential(snippets[:1000])
+    if report['mismatches']:
+        print("Fast path differs from the full path:")
+        for mismatch in report['mismatches'][:10]:
+            print("  %r %s: %r != %r" % mismatch)
+    times = {}
+    for name, fast in (('full path', False), ('fast path', True)):
+        start = time.perf_counter()
+        for snippet in snippets:
+            batch.transpile_one(snippet, fast=fast)
+        times[name] = time.perf_counter() - start
+        print("%-10s %10.3f %12.0f snippets/s" % (
+            name, times[name], count / times[name]))
+    print("speedup %.2fx" % (times['full path'] / times['fast path']))
+
+
+def bench_schedule(count=2000, workers=4, model=None):
+    '''Equal sized chunks against lpt over the cost model'''
+    snippets = list(varied_snippets(count))
+    model = scheduling.CostModel.load(model) if model else None
+    print("Python %s, GIL %s" % (
+        sys.version.split()[0],
+        'enabled' if gil_enabled() else 'disabled'))
+    unique = list(dict.fromkeys(snippets))
+    for name, bins in (
+            ('chunks', scheduling.chunks(len(unique), workers)),
+            ('lpt', None)):
+        _, report = scheduling.transpile_scheduled(
+            snippets, max_workers=workers, model=model, bins=bins)
+        print('%-8s %s' % (name, report.format()))
+
+
+def bench_calibrate(path, count=1000):
+    '''Fits the cost model on half the snippets, checks it on the rest'''
+    snippets = list(varied_snippets(count, seed=1))
+    train, check = snippets[::2], snippets[1::2]
+    model = scheduling.calibrate(train)
+    measured = scheduling.measure(check)
+    predicted = [model.cost(s) for s in check]
+    mean = sum(measured) / len(measured)
+    total = sum((m - mean) ** 2 for m in measured)
+    residual = sum((m - p) ** 2 for m, p in zip(measured, predicted))
+    for name, c in zip(scheduling.FEATURES, model.coefficients):
+        print('%-8s %.3g' % (name, c))
+    print('R^2 on held out snippets: %.3f' % (1 - residual / total))
+    model.save(path)
+
+
+def allocated(build):
+    '''(result of build(), bytes it holds on to)'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_intern(test_dir=None, count=20000):
+    '''Memory of one tree per snippet against interned trees, over the
+    python snippets of a polyglot suite (or synthetic ones)'''
+    if test_dir:
+        snippets = list(multireql.every_snippet(test_dir))
+    else:
+        snippets = list(synthetic_snippets(count))
+    parseable = []
+    for snippet in snippets:
+        try:
+            batch.parse(snippet)
+        except Exception:
+            continue
+        parseable.append(snippet)
+    trees, plain = allocated(
+        lambda: [batch.parse(snippet) for snippet in parseable])
+    del trees
+
+    def build_interned():
+        interner = snippet_ir.Interner()
+        return interner, [interner.parse(s) for s in parseable]
+    (interner, interned), shared = allocated(build_interned)
+    # the trees alone, once the loading is over and the table is dropped
+    _, trees_only = allocated(lambda: build_interned()[1])
+    for snippet, tree in zip(parseable[:1000], interned):
+        for lang in batch.LANGUAGES:
+            if outcome(tree, lang) != outcome(batch.parse(snippet), lang):
+                print("Interned tree converts differently: %r" % snippet)
+    print("%d snippets, %d distinct subtrees (%.0f%% of lookups shared)" % (
+        len(parseable), len(interner),
+        100.0 * interner.hits / max(1, interner.hits + interner.misses)))
+    print("%-22s %12d bytes" % ('one tree each', plain))
+    print("%-22s %12d bytes" % ('interned, with table', shared))
+    print("%-22s %12d bytes" % ('interned, trees only', trees_only))
+    print("reduction %.1fx (%.1fx without the table)" % (
+        float(plain) / max(1, shared), float(plain) / max(1, trees_only)))
+
+
+def outcome(tree, lang):
+    try:
+        return batch.transpile_tree(tree, lang)
+    except Exception as e:
+        return type(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='benchmark')
+    threads = sub.add_parser('threads', help='thread pool scaling')
+    threads.add_argument('--snippets', type=int, default=20000)
+    threads.add_argument('--workers', type=int, nargs='+',
+                         default=[1, 2, 4, 8])
+    ir = sub.add_parser('ir', help='IR load vs reparsing')
+    ir.add_argument('--snippets', type=int, default=20000)
+    fast = sub.add_parser('fastpath', help='fast path vs full path')
+    fast.add_argument('--snippets', type=int, default=20000)
+    schedule = sub.add_parser('schedule', help='chunks vs lpt balance')
+    schedule.add_argument('--snippets', type=int, default=2000)
+    schedule.add_argument('--workers', type=int, default=4)
+    schedule.add_argument('--model', help='a calibrated cost model')
+    calibrate = sub.add_parser('calibrate', help='fit the cost model')
+    calibrate.add_argument('out', help='where to write the model')
+    calibrate.add_argument('--snippets', type=int, default=1000)
+    intern = sub.add_parser('intern', help='interned trees memory')
+    intern.add_argument('--test-dir', help='a polyglot suite, default: '
+                        'synthetic snippets')
+    intern.add_argument('--snippets', type=int, default=20000)
+    args = parser.parse_args()
+    if args.benchmark == 'threads':
+        bench_threads(args.snippets, args.workers)
+    elif args.benchmark == 'ir':
+        bench_ir(args.snippets)
+    elif args.benchmark == 'fastpath':
+        bench_fastpath(args.snippets)
+    elif args.benchmark == 'schedule':
+        bench_schedule(args.snippets, args.workers, args.model)
+    elif args.benchmark == 'calibrate':
+        bench_calibrate(args.out, args.snippets)
+    elif args.benchmark == 'intern':
+        bench_intern(args.test_dir, args.snippets)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+'''Resource limits for transpiling untrusted snippets.
+
+A Budget holds the limits; `budget.track()` starts the clock for one
+snippet and returns a tracker that parsing, the IsReql pass and the
+converters report to. Going over any limit raises a subclass of
+BudgetExceeded, which stops the work right there.
+'''
+
+import ast
+import time
+
+try:
+    from io import StringIO
+except ImportError:
+    from cStringIO import StringIO
+
+# How many nodes or writes happen between two looks at the clock
+CLOCK_INTERVAL = 64
+
+
+class BudgetExceeded(Exception):
+    '''Base class for all budget errors'''
+
+    def __init__(self, message, limit=None):
+        super(BudgetExceeded, self).__init__(message)
+        self.limit = limit
+
+
+class SourceTooLarge(BudgetExceeded):
+    pass
+
+
+class DepthExceeded(BudgetExceeded):
+    pass
+
+
+class NodeCountExceeded(BudgetExceeded):
+    pass
+
+
+class OutputTooLarge(BudgetExceeded):
+    pass
+
+
+class DeadlineExceeded(BudgetExceeded):
+    pass
+
+
+class Budget(object):
+    '''Limits for one snippet. None means unlimited. `time_limit` is
+    in seconds and covers parsing, flagging and emitting every
+    language; output size is counted in characters over all
+    languages'''
+
+    def __init__(self,
+                 max_source_bytes=None,
+                 max_depth=None,
+                 max_nodes=None,
+                 max_output_bytes=None,
+                 time_limit=None,
+    ):
+        self.max_source_bytes = max_source_bytes
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_output_bytes = max_output_bytes
+        self.time_limit = time_limit
+
+    def track(self):
+        return BudgetTracker(self)
+
+
+class BudgetTracker(object):
+    '''Counts the work done on one snippet against a Budget'''
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.deadline = (None if budget.time_limit is None
+                         else time.monotonic() + budget.time_limit)
+        self.ticks = 0
+        self.output_bytes = 0
+
+    def check_deadline(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DeadlineExceeded(
+                "Ran out of time (%ss)" % self.budget.time_limit,
+                self.budget.time_limit)
+
+    def tick(self):
+        '''Called once per unit of work, looks at the clock now and
+        then'''
+        self.ticks += 1
+        if self.ticks % CLOCK_INTERVAL == 0:
+            self.check_deadline()
+
+    def check_source(self, source):
+        limit = self.budget.max_source_bytes
+        if limit is not None and len(source) > limit:
+            raise SourceTooLarge(
+                "Snippet is %d bytes, limit is %d" % (len(source), limit),
+                limit)
+
+    def check_tree(self, node):
+        '''Walks a parsed tree checking its depth and size'''
+        max_depth = self.budget.max_depth
+        max_nodes = self.budget.max_nodes
+        if max_depth is None and max_nodes is None and \
+           self.deadline is None:
+            return
+        count = 0
+        stack = [(node, 1)]
+        while stack:
+            node, depth = stack.pop()
+            count += 1
+            if max_nodes is not None and count > max_nodes:
+                raise NodeCountExceeded(
+                    "More than %d nodes" % max_nodes, max_nodes)
+            if max_depth is not None and depth > max_depth:
+                raise DepthExceeded(
+                    "Nested deeper than %d" % max_depth, max_depth)
+            self.tick()
+            for child in ast.iter_child_nodes(node):
+                stack.append((child, depth + 1))
+
+    def output(self):
+        '''An output buffer for a converter that enforces the output
+        size limit and the deadline'''
+        return BudgetedOutput(self)
+
+    def wrote(self, count):
+        self.output_bytes += count
+        limit = self.budget.max_output_bytes
+        if limit is not None and self.output_bytes > limit:
+            raise OutputTooLarge(
+                "Output is over %d bytes" % limit, limit)
+        self.tick()
+
+
+class BudgetedOutput(object):
+    '''StringIO stand-in that reports every write to a tracker'''
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.buffer = StringIO()
+
+    def write(self, s):
+        self.tracker.wrote(len(s))
+        return self.buffer.write(s)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+    def __iter__(self):
+        return iter(self.buffer.getvalue().splitlines(True))
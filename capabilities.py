@@ -0,0 +1,127 @@
+'''Decides up front whether a snippet can be translated to a target.
+
+One walk over the flagged tree collects the features that some target
+can't handle, then each target looks up the first of them it doesn't
+support. This is much cheaper than emitting the whole snippet and
+failing half way, and gives a reason code for every rejection.
+'''
+
+import ast
+
+from conversion_utils import is_ext_slice
+
+# Reason codes
+ROW = 'r.row'
+NON_FUNCTION_MAP = 'non-function map'
+NON_FUNCTION_FOR_EACH = 'non-function for_each'
+EXT_SLICE = 'ext-slice'
+LIST_COMPREHENSION = 'list comprehension'
+RANGE_COMPREHENSION = 'range comprehension'
+FROZENSET = 'frozenset'
+CHAINED_COMPARISON = 'chained comparison'
+ARITY_CHECK = 'arity check'
+UNSUPPORTED_SYNTAX = 'unsupported syntax'
+
+# Which features each target can't translate. Checked in this order, so
+# the first matching reason is the one reported.
+UNSUPPORTED = {
+    'rb': (EXT_SLICE, LIST_COMPREHENSION, RANGE_COMPREHENSION, FROZENSET,
+           ROW, UNSUPPORTED_SYNTAX),
+    'js': (EXT_SLICE, LIST_COMPREHENSION, RANGE_COMPREHENSION,
+           CHAINED_COMPARISON, UNSUPPORTED_SYNTAX),
+    'java': (EXT_SLICE, LIST_COMPREHENSION, FROZENSET, ROW,
+             NON_FUNCTION_MAP, NON_FUNCTION_FOR_EACH, CHAINED_COMPARISON,
+             ARITY_CHECK, UNSUPPORTED_SYNTAX),
+    'json': (EXT_SLICE, LIST_COMPREHENSION, RANGE_COMPREHENSION, FROZENSET,
+             CHAINED_COMPARISON, UNSUPPORTED_SYNTAX),
+}
+
+# Node types every converter handles. Anything else is reported as
+# UNSUPPORTED_SYNTAX.
+SUPPORTED_NODES = {
+    'Attribute', 'BinOp', 'Bytes', 'Call', 'Compare', 'Constant', 'Dict',
+    'Index', 'Lambda', 'List', 'Name', 'NameConstant', 'Num', 'Slice',
+    'Str', 'Subscript', 'Tuple', 'UnaryOp',
+    # handled as part of their parents
+    'arguments', 'arg', 'keyword', 'comprehension', 'Load', 'Store',
+}
+
+ARITY_MESSAGE_FRAGMENTS = ('xpected', 'Got')
+
+
+def is_range_call(node):
+    return type(node) == ast.Call and type(node.func) == ast.Name and \
+        node.func.id.endswith('range')
+
+
+def is_function_like(node):
+    '''What the java driver accepts as the function argument of map'''
+    return type(node) in (ast.Lambda, ast.Dict, ast.Name) or (
+        type(node) == ast.Call and type(node.func) == ast.Attribute and
+        node.func.attr == 'js')
+
+
+def is_arity_check(node):
+    try:
+        message = node.args[1].s
+    except (AttributeError, IndexError):
+        return False
+    return type(node.func) == ast.Name and node.func.id == 'err' and \
+        'argument' in message and \
+        any(fragment in message for fragment in ARITY_MESSAGE_FRAGMENTS)
+
+
+def features(node):
+    '''Returns the set of reason codes that apply to a flagged tree'''
+    found = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        kind = type(node).__name__
+        if kind not in SUPPORTED_NODES and \
+           not isinstance(node, (ast.operator, ast.unaryop, ast.cmpop,
+                                 ast.boolop)):
+            found.add(UNSUPPORTED_SYNTAX if kind != 'ListComp'
+                      else (RANGE_COMPREHENSION
+                            if is_range_call(node.generators[0].iter)
+                            else LIST_COMPREHENSION))
+        elif kind == 'Attribute':
+            if node.attr == 'row' and type(node.value) == ast.Name and \
+               node.value.id == 'r':
+                found.add(ROW)
+        elif kind == 'Name':
+            if node.id == 'frozenset':
+                found.add(FROZENSET)
+        elif kind == 'Compare':
+            if len(node.comparators) > 1:
+                found.add(CHAINED_COMPARISON)
+        elif kind == 'Subscript':
+            if is_ext_slice(node.slice):
+                found.add(EXT_SLICE)
+        elif kind == 'Call':
+            if is_arity_check(node):
+                found.add(ARITY_CHECK)
+            if getattr(node, 'is_reql', False) and \
+               type(node.func) == ast.Attribute and node.args:
+                if node.func.attr == 'map' and \
+                   not is_function_like(node.args[-1]):
+                    found.add(NON_FUNCTION_MAP)
+                elif node.func.attr == 'for_each' and \
+                        type(node.args[0]) != ast.Lambda:
+                    found.add(NON_FUNCTION_FOR_EACH)
+        stack.extend(ast.iter_child_nodes(node))
+    return found
+
+
+def reason_for(found, lang):
+    '''The first reason in `found` that `lang` can't handle, or None'''
+    for reason in UNSUPPORTED[lang]:
+        if reason in found:
+            return reason
+    return None
+
+
+def classify(node, langs=('rb', 'js', 'java')):
+    '''Maps each target to None (translatable) or a reason code'''
+    found = features(node)
+    return {lang: reason_for(found, lang) for lang in langs}
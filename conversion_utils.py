@@ -1,3 +1,4 @@
+import copy
 import re
 import ast
 
@@ -25,20 +26,145 @@ def dromedary(varname):
         return varname[0].lower() + varname[1:]
 
 
-def add_is_reql_flags(node, reql_vars=None, passed_to_reql=False):
-    IsReql(reql_vars, passed_to_reql).visit(node)
+def is_ext_slice(slc):
+    '''True for subscripts like a[1:2, 3]'''
+    if type(slc).__name__ == 'ExtSlice':
+        return True
+    # Python 3.9+ parses them as a tuple containing slices
+    return type(slc) == ast.Tuple and \
+        any(type(elt) == ast.Slice for elt in slc.elts)
+
+
+def subscript_index(slc):
+    '''Returns the index expression of a subscript like a[i], or None
+    if it's a slice. Python 3.9 stopped wrapping indexes in ast.Index'''
+    if type(slc) == ast.Slice or is_ext_slice(slc):
+        return None
+    if type(slc).__name__ == 'Index':
+        return slc.value
+    return slc
+
+
+# Lists and dicts with fewer elements than this go through the normal
+# visit_* methods, the bulk path isn't worth the check for them
+BULK_LITERAL_MIN = 32
+
+NUMBER_TYPES = (int, float)
+
+
+def literal_kind(node):
+    '''Returns (kind, value, negative) for a plain constant, where kind
+    is 'str', 'number' or 'bool', and negative is set for -<number>.
+    Returns None for anything else'''
+    negative = False
+    if type(node) == ast.UnaryOp and type(node.op) == ast.USub:
+        negative = True
+        node = node.operand
+    if type(node) != ast.Constant:
+        return None
+    value = node.value
+    kind = type(value)
+    if kind in NUMBER_TYPES:
+        return 'number', value, negative
+    elif negative:
+        return None
+    elif kind == str:
+        return 'str', value, False
+    elif kind == bool:
+        return 'bool', value, False
+    return None
+
+
+def bulk_literals(nodes, min_count=BULK_LITERAL_MIN):
+    '''If `nodes` is a long run of constants of the same kind, returns
+    that kind and a list of (value, negative) pairs, so converters can
+    emit the whole run at once instead of visiting each node. Returns
+    (None, None) otherwise'''
+    if len(nodes) < min_count:
+        return None, None
+    first = literal_kind(nodes[0])
+    if first is None:
+        return None, None
+    kind = first[0]
+    values = []
+    for node in nodes:
+        literal = literal_kind(node)
+        if literal is None or literal[0] != kind:
+            return None, None
+        values.append(literal[1:])
+    return kind, values
+
+
+def bulk_dict(node, min_count=BULK_LITERAL_MIN):
+    '''Like bulk_literals for a dict with string keys. Returns (kind
+    of the values, keys, values) or (None, None, None)'''
+    if len(node.keys) < min_count or \
+       any(type(key) != ast.Constant or type(key.value) != str
+           for key in node.keys):
+        return None, None, None
+    kind, values = bulk_literals(node.values, min_count)
+    if kind is None:
+        return None, None, None
+    return kind, [key.value for key in node.keys], values
+
+
+def map_children(node, func):
+    '''Returns `node` with `func` applied to each child node. If func
+    returned every child unchanged, `node` itself is returned,
+    otherwise a shallow copy with the new children, so the original
+    tree (and any other tree sharing its nodes) is left alone'''
+    changed = {}
+    for name, field in ast.iter_fields(node):
+        if isinstance(field, ast.AST):
+            new = func(field)
+            if new is not field:
+                changed[name] = new
+        elif isinstance(field, list):
+            new = [func(item) if isinstance(item, ast.AST) else item
+                   for item in field]
+            if any(a is not b for a, b in zip(new, field)):
+                changed[name] = new
+    if not changed:
+        return node
+    node = copy.copy(node)
+    for name, field in changed.items():
+        setattr(node, name, field)
+    return node
+
+
+def add_is_reql_flags(node, reql_vars=None, passed_to_reql=False,
+                      budget=None):
+    if 'lineno' in type(node)._attributes and 'lineno' not in vars(node):
+        # trees without positions are interned or loaded from an IR
+        # store (snippet_ir.py): their nodes may be shared, so flagging
+        # them again would re-flag other snippets too
+        raise ValueError("Can't flag an interned or loaded tree")
+    IsReql(reql_vars, passed_to_reql, budget).visit(node)
 
 
 class IsReql(ast.NodeVisitor):
     '''Adds a flag to every node in the tree indicating if it's a reql
-    term or not'''
-    def __init__(self, reql_vars=None, passed_to_reql=False):
+    term or not. `budget` is an optional budgets.BudgetTracker'''
+    def __init__(self, reql_vars=None, passed_to_reql=False, budget=None):
         self.reql_vars = reql_vars or {'r'}
         self.passed_to_reql = passed_to_reql
+        self.budget = budget
+
+    def child(self, reql_vars, passed_to_reql=False):
+        return IsReql(reql_vars, passed_to_reql, self.budget)
+
+    def visit(self, node):
+        if self.budget is not None:
+            self.budget.tick()
+        return super(IsReql, self).visit(node)
 
     def generic_visit(self, node):
         node.is_reql = False
 
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        node.is_reql = node.value.is_reql
+
     def visit_Name(self, node):
         node.is_reql = node.id in self.reql_vars
 
@@ -50,15 +176,15 @@ class IsReql(ast.NodeVisitor):
         node.is_reql = self.passed_to_reql
         if self.passed_to_reql:
             lambda_vars = {n.arg for n in node.args.args}
-            IsReql(reql_vars=self.reql_vars | lambda_vars).visit(node.body)
+            self.child(self.reql_vars | lambda_vars).visit(node.body)
         else:
-            IsReql(reql_vars=self.reql_vars).visit(node.body)
+            self.child(self.reql_vars).visit(node.body)
 
     def visit_Call(self, node):
         self.visit(node.func)
         node.is_reql = node.func.is_reql
         if node.is_reql:
-            pp = IsReql(self.reql_vars, passed_to_reql=True)
+            pp = self.child(self.reql_vars, passed_to_reql=True)
         else:
             pp = self
         for arg in node.args:
@@ -71,18 +197,18 @@ class IsReql(ast.NodeVisitor):
         self.visit(node.value)
         node.is_reql = node.value.is_reql
         if node.is_reql:
-            pp = IsReql(self.reql_vars, passed_to_reql=True)
+            pp = self.child(self.reql_vars, passed_to_reql=True)
         else:
             pp = self
         pp.visit(node.slice)
 
     def visit_Index(self, node):
-        pp = IsReql(self.reql_vars, passed_to_reql=False)
+        pp = self.child(self.reql_vars, passed_to_reql=False)
         pp.visit(node.value)
         node.is_reql = self.passed_to_reql
 
     def visit_Slice(self, node):
-        pp = IsReql(self.reql_vars, passed_to_reql=False)
+        pp = self.child(self.reql_vars, passed_to_reql=False)
         if node.lower is not None:
             pp.visit(node.lower)
         if node.step is not None:
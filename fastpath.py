@@ -0,0 +1,297 @@
+'''Fast path for the most common kind of snippet: a chain of method
+calls on r (or another reql variable) with only literal arguments,
+like
+
+    r.db('x').table('y').get_all(1, index='z').count()
+
+These are scanned with the token patterns of the tokenize module and
+emitted straight to ruby, javascript and java, skipping ast.parse, the
+IsReql pass and the visitors. The output must be exactly what the full
+path produces, so anything the converters treat specially (r.row,
+r.ast, map and for_each, which the capability pre-check looks at) or
+anything outside the grammar makes `transpile` return None and the
+caller falls back to the full path.
+
+`differential` checks the byte-for-byte promise against the full path
+over a corpus of snippets.
+'''
+
+import ast
+import functools
+import keyword
+import re
+import tokenize
+
+from conversion_utils import dromedary
+import batch
+import java_converter
+
+# Every character ends up in one of the groups, "bad" ones included
+TOKEN_REGEX = re.compile(
+    r'[ \t]*(?:(?P<string>%s)|(?P<number>%s)|(?P<name>%s)|(?P<op>[().,=-])'
+    r'|(?P<bad>.|$))'
+    % (tokenize.String, tokenize.Number, tokenize.Name), re.DOTALL)
+
+# Methods the converters or the capability pre-check treat specially
+SPECIAL_METHODS = frozenset(('map', 'for_each'))
+# Special when called directly on r
+SPECIAL_TOPLEVEL = frozenset(('row', 'ast'))
+CONSTANT_NAMES = {'True': True, 'False': False, 'None': None}
+
+JAVA_MAX_LONG = 9223372036854775807
+
+
+class NotSimple(Exception):
+    '''The snippet is outside the fast path grammar'''
+
+
+class Literal(object):
+    '''A literal argument. `negative` is set for -<number>, which python
+    parses as a UnaryOp around the number'''
+
+    __slots__ = ('value', 'negative')
+
+    def __init__(self, value, negative=False):
+        self.value = value
+        self.negative = negative
+
+
+def tokens(snippet):
+    '''Yields (kind, text) pairs, raising NotSimple on anything the
+    pattern doesn't cover'''
+    if snippet[:1] in (' ', '\t'):
+        # python won't parse an indented expression
+        raise NotSimple(snippet)
+    for match in TOKEN_REGEX.finditer(snippet):
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'bad':
+            if text:
+                raise NotSimple(snippet)
+            return
+        if kind == 'name' and not text.isidentifier():
+            raise NotSimple(snippet)
+        yield kind, text
+
+
+def literal(kind, text, negative=False):
+    if kind == 'name':
+        if negative or text not in CONSTANT_NAMES:
+            raise NotSimple(text)
+        return Literal(CONSTANT_NAMES[text])
+    if kind not in ('string', 'number') or (negative and kind == 'string'):
+        raise NotSimple(text)
+    if text.isdigit() and (text[0] != '0' or not text.strip('0')):
+        return Literal(int(text), negative)
+    if kind == 'string' and text[0] in '\'"' and '\\' not in text:
+        return Literal(text[1:-1], negative)
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        raise NotSimple(text)
+    if type(value) not in (str, int, float):
+        raise NotSimple(text)
+    return Literal(value, negative)
+
+
+def scan(snippet, reql_vars=None):
+    '''Returns (root, [(method, args, [(keyword, arg)])]) or raises
+    NotSimple'''
+    reql_vars = reql_vars or {'r'}
+    toks = tokens(snippet)
+    kind, root = next(toks, (None, None))
+    if kind != 'name' or root not in reql_vars or keyword.iskeyword(root):
+        raise NotSimple(snippet)
+    calls = []
+    for kind, text in toks:
+        if text != '.':
+            raise NotSimple(snippet)
+        kind, method = next(toks, (None, None))
+        if kind != 'name' or keyword.iskeyword(method) or \
+           method in SPECIAL_METHODS or \
+           (not calls and method in SPECIAL_TOPLEVEL):
+            raise NotSimple(snippet)
+        if next(toks, (None, None))[1] != '(':
+            raise NotSimple(snippet)
+        calls.append((method,) + scan_args(toks, snippet))
+    if not calls:
+        raise NotSimple(snippet)
+    return root, calls
+
+
+def scan_args(toks, snippet):
+    '''Reads the arguments of a call up to and including the ")"'''
+    args, kwargs = [], []
+    while True:
+        kind, text = next(toks, (None, None))
+        if text == ')':
+            return args, kwargs
+        negative = text == '-' and kind == 'op'
+        if negative:
+            kind, text = next(toks, (None, None))
+        following = next(toks, (None, None))
+        if kind == 'name' and following[1] == '=' and not negative:
+            if keyword.iskeyword(text) or \
+               any(name == text for name, _ in kwargs):
+                raise NotSimple(snippet)
+            name = text
+            kind, text = next(toks, (None, None))
+            negative = text == '-' and kind == 'op'
+            if negative:
+                kind, text = next(toks, (None, None))
+            kwargs.append((name, literal(kind, text, negative)))
+            following = next(toks, (None, None))
+        elif kwargs:
+            # positional argument after a keyword argument
+            raise NotSimple(snippet)
+        else:
+            args.append(literal(kind, text, negative))
+        if following[1] == ')':
+            return args, kwargs
+        if following[1] != ',':
+            raise NotSimple(snippet)
+
+
+def ruby_literal(lit):
+    value = lit.value
+    if value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif value is None:
+        return 'nil'
+    elif type(value) == str:
+        return repr(value).strip('b')
+    return ('-' if lit.negative else '') + repr(value)
+
+
+def js_literal(lit):
+    value = lit.value
+    if value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif value is None:
+        return 'null'
+    elif type(value) == str:
+        return repr(value).strip('b')
+    return ('-' if lit.negative else '') + repr(value)
+
+
+# Table names, index names and so on repeat a lot
+method_name = functools.lru_cache(maxsize=4096)(dromedary)
+
+
+java_string = functools.lru_cache(maxsize=4096)(java_converter.string_expr)
+
+
+def java_literal(lit):
+    value = lit.value
+    if value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif value is None:
+        return 'null'
+    elif type(value) == str:
+        return java_string(value)
+    text = repr(value)
+    if type(value) != float:
+        if value > JAVA_MAX_LONG or value < -JAVA_MAX_LONG - 1:
+            text += '.0'
+        else:
+            text += 'L'
+    return ('-' if lit.negative else '') + text
+
+
+def emit_ruby(root, calls):
+    parts = [root]
+    for i, (method, args, kwargs) in enumerate(calls):
+        if not (i == 0 and root == 'r' and method == 'expr'):
+            # r.expr(foo) is r(foo) in ruby
+            parts.append('.')
+            parts.append(method)
+        if args or kwargs:
+            parts.append('(')
+            parts.append(', '.join(
+                [ruby_literal(arg) for arg in args] +
+                ['%s: %s' % (name, ruby_literal(arg))
+                 for name, arg in kwargs]))
+            parts.append(')')
+    return ''.join(parts)
+
+
+def emit_js(root, calls):
+    parts = [method_name(root)]
+    for method, args, kwargs in calls:
+        parts.append('.')
+        parts.append(method_name(method))
+        parts.append('(')
+        parts.append(', '.join(js_literal(arg) for arg in args))
+        if kwargs:
+            if args:
+                parts.append(', ')
+            parts.append('{')
+            parts.append(', '.join('%s: %s' % (method_name(name),
+                                               js_literal(arg))
+                                   for name, arg in kwargs))
+            parts.append('}')
+        parts.append(')')
+    return ''.join(parts)
+
+
+def emit_java(root, calls):
+    if root in java_converter.JAVA_KEYWORDS or \
+       root in java_converter.OBJECT_METHODS:
+        root += '_'
+    parts = [root]
+    for method, args, kwargs in calls:
+        parts.append('.')
+        parts.append(method_name(method))
+        parts.append('(')
+        parts.append(', '.join(java_literal(arg) for arg in args))
+        parts.append(')')
+        for name, arg in kwargs:
+            parts.append('.optArg(%s, %s)' % (java_string(name),
+                                              java_literal(arg)))
+    return ''.join(parts)
+
+
+EMITTERS = {
+    'rb': emit_ruby,
+    'js': emit_js,
+    'java': emit_java,
+}
+
+
+def transpile(snippet, langs=('rb', 'js', 'java'), reql_vars=None):
+    '''Returns {lang: output} if the snippet is a simple chain, else
+    None. Languages without an emitter (the wire format) always take
+    the full path'''
+    if any(lang not in EMITTERS for lang in langs):
+        return None
+    try:
+        root, calls = scan(snippet, reql_vars)
+    except (NotSimple, StopIteration):
+        return None
+    return {lang: EMITTERS[lang](root, calls) for lang in langs}
+
+
+def differential(snippets, langs=('rb', 'js', 'java'), reql_vars=None):
+    '''Runs every snippet through both paths. Returns a dict with the
+    number of snippets taking the fast path ("fast") and falling back
+    ("fallback"), plus a list of (snippet, lang, fast, full) for every
+    output that differs ("mismatches")'''
+    report = {'fast': 0, 'fallback': 0, 'mismatches': []}
+    for snippet in snippets:
+        fast = transpile(snippet, langs, reql_vars)
+        if fast is None:
+            report['fallback'] += 1
+            continue
+        report['fast'] += 1
+        full = batch.transpile_one(snippet, langs, reql_vars, fast=False)
+        for lang in langs:
+            if full.outputs.get(lang) != fast[lang]:
+                report['mismatches'].append(
+                    (snippet, lang, fast[lang], full.outputs.get(lang)))
+    return report
@@ -0,0 +1,312 @@
+'''Optional constant folding for the native (non-ReQL) parts of a
+snippet, like the `3+2` in `filter(lambda x: x > (3+2))`.
+
+Folding works out at transpile time what the generated code would
+compute at runtime, so it has to use the target's arithmetic rather
+than python's:
+
+- ruby has arbitrary size integers, and integer division and modulo
+  round down like python's // and %
+- javascript only has doubles, and % takes the sign of the dividend
+- java numbers are `L` longs (64 bit, wrapping on overflow, division
+  rounding towards zero) unless they don't fit, in which case the
+  converter already emits a double
+- the wire format ('json') gets what the python driver would have
+  computed before building the query, so it's python's own arithmetic
+
+Anything whose result the target doesn't define the same way (division
+by zero, NaN or infinite results, adding a string to a number, java's
+missing ** operator, ...) is left alone, so folding never changes what
+a test checks. Subexpressions that are ReQL terms (`is_reql`) are never
+folded either: the server evaluates those.
+
+`fold(tree, lang)` returns a folded tree and doesn't modify `tree`,
+which the other languages may still be converting. Untouched subtrees
+are shared between the two.
+'''
+
+import ast
+import math
+
+from conversion_utils import map_children
+
+JAVA_MIN_LONG = -2 ** 63
+JAVA_MAX_LONG = 2 ** 63 - 1
+JS_MAX_SAFE_INTEGER = 2 ** 53
+
+# Folding 2 ** 100000 would make the output bigger, not smaller
+MAX_INT_BITS = 256
+
+NUMBERS = (int, float)
+
+
+class NotFoldable(Exception):
+    pass
+
+
+class Semantics(object):
+    '''How a target language evaluates native arithmetic. Values are
+    python ints, floats and strs; a method raises NotFoldable if the
+    target wouldn't give a well-defined literal result'''
+
+    def constant(self, value):
+        '''The value the target sees for a literal in the snippet'''
+        if type(value) not in (int, float, str):
+            raise NotFoldable(value)
+        return value
+
+    def negate(self, value):
+        if type(value) not in NUMBERS:
+            raise NotFoldable(value)
+        return self.number(-value)
+
+    def binop(self, op, left, right):
+        method = getattr(self, 'op_' + type(op).__name__, None)
+        if method is None:
+            raise NotFoldable(op)
+        if type(left) == str or type(right) == str:
+            return self.strings(op, left, right)
+        try:
+            return self.number(method(left, right))
+        except (OverflowError, ZeroDivisionError):
+            # ints too big for a float, 0.0 ** -1 and so on
+            raise NotFoldable(op)
+
+    def strings(self, op, left, right):
+        if type(op) == ast.Add and type(left) == type(right) == str:
+            return left + right
+        raise NotFoldable(op)
+
+    def number(self, value):
+        '''Checks an arithmetic result'''
+        if type(value) == float and not math.isfinite(value):
+            raise NotFoldable(value)
+        if type(value) == int and value.bit_length() > MAX_INT_BITS:
+            raise NotFoldable(value)
+        return value
+
+    def op_Add(self, left, right):
+        return left + right
+
+    def op_Sub(self, left, right):
+        return left - right
+
+    def op_Mult(self, left, right):
+        return left * right
+
+
+class RubySemantics(Semantics):
+
+    def strings(self, op, left, right):
+        if type(op) == ast.Mult and type(left) == str and \
+           type(right) == int and 0 <= right and \
+           len(left) * right <= 4096:
+            return left * right
+        return super(RubySemantics, self).strings(op, left, right)
+
+    def op_Div(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        if type(left) == type(right) == int:
+            return left // right
+        return left / right
+
+    def op_Mod(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        return left % right
+
+    def op_Pow(self, left, right):
+        if type(right) == int:
+            if right < 0 and type(left) == int:
+                # Rational in ruby
+                raise NotFoldable(right)
+            if type(left) == int and \
+               abs(left) > 1 and right * left.bit_length() > MAX_INT_BITS:
+                raise NotFoldable(right)
+        elif left < 0:
+            # complex in python, NaN in ruby
+            raise NotFoldable(left)
+        return left ** right
+
+
+class JsSemantics(Semantics):
+
+    def constant(self, value):
+        value = super(JsSemantics, self).constant(value)
+        if type(value) == int:
+            try:
+                return float(value)
+            except OverflowError:
+                raise NotFoldable(value)
+        return value
+
+    def op_Div(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        return left / right
+
+    def op_Mod(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        return math.fmod(left, right)
+
+    def op_Pow(self, left, right):
+        if left < 0 and not right.is_integer():
+            raise NotFoldable(left)
+        return left ** right
+
+    def literal(self, value):
+        # javascript doesn't tell 5 and 5.0 apart, so keep integers
+        # looking like integers
+        if type(value) == float and value.is_integer() and \
+           abs(value) <= JS_MAX_SAFE_INTEGER and \
+           (value != 0 or math.copysign(1.0, value) > 0):
+            return int(value)
+        return value
+
+
+class JavaSemantics(Semantics):
+
+    def constant(self, value):
+        value = super(JavaSemantics, self).constant(value)
+        if type(value) == int and \
+           not JAVA_MIN_LONG <= value <= JAVA_MAX_LONG:
+            # the converter emits these as doubles
+            return float(value)
+        return value
+
+    def number(self, value):
+        if type(value) == int:
+            # longs wrap around
+            value = (value - JAVA_MIN_LONG) % 2 ** 64 + JAVA_MIN_LONG
+            if value == JAVA_MIN_LONG:
+                # -9223372036854775808 would be emitted as -(a double)
+                raise NotFoldable(value)
+        return super(JavaSemantics, self).number(value)
+
+    def op_Div(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        if type(left) == type(right) == int:
+            quotient = abs(left) // abs(right)
+            return quotient if (left < 0) == (right < 0) else -quotient
+        return left / right
+
+    def op_Mod(self, left, right):
+        if right == 0:
+            raise NotFoldable(right)
+        if type(left) == type(right) == int:
+            return left - right * self.op_Div(left, right)
+        return math.fmod(left, right)
+
+
+class PythonSemantics(Semantics):
+
+    def strings(self, op, left, right):
+        if type(op) == ast.Mult and type(left) == str and \
+           type(right) == int and len(left) * max(right, 0) <= 4096:
+            return left * right
+        return super(PythonSemantics, self).strings(op, left, right)
+
+    def op_Div(self, left, right):
+        return left / right
+
+    def op_FloorDiv(self, left, right):
+        return left // right
+
+    def op_Mod(self, left, right):
+        return left % right
+
+    def op_Pow(self, left, right):
+        if type(right) == int:
+            if type(left) == int and right > 0 and \
+               abs(left) > 1 and right * left.bit_length() > MAX_INT_BITS:
+                raise NotFoldable(right)
+        elif left < 0:
+            # complex
+            raise NotFoldable(left)
+        return left ** right
+
+
+SEMANTICS = {
+    'rb': RubySemantics(),
+    'js': JsSemantics(),
+    'java': JavaSemantics(),
+    'json': PythonSemantics(),
+}
+
+
+class Folder(object):
+    '''Folds one tree for one language'''
+
+    def __init__(self, semantics):
+        self.semantics = semantics
+        # id(node) -> folded value, or NotFoldable
+        self.values = {}
+
+    def value(self, node):
+        key = id(node)
+        try:
+            value = self.values[key]
+        except KeyError:
+            try:
+                value = self._value(node)
+            except NotFoldable:
+                value = NotFoldable
+            self.values[key] = value
+        if value is NotFoldable:
+            raise NotFoldable(node)
+        return value
+
+    def _value(self, node):
+        if getattr(node, 'is_reql', False):
+            raise NotFoldable(node)
+        kind = type(node)
+        if kind == ast.Constant:
+            return self.semantics.constant(node.value)
+        elif kind == ast.UnaryOp and type(node.op) in (ast.USub, ast.UAdd):
+            value = self.value(node.operand)
+            if type(node.op) == ast.USub:
+                return self.semantics.negate(value)
+            return value
+        elif kind == ast.BinOp:
+            return self.semantics.binop(
+                node.op, self.value(node.left), self.value(node.right))
+        raise NotFoldable(node)
+
+    def fold(self, node):
+        if type(node) in (ast.BinOp, ast.UnaryOp) and \
+           not (type(node) == ast.UnaryOp and
+                type(node.operand) == ast.Constant):
+            # -5 is already as short as it gets
+            try:
+                value = self.value(node)
+            except NotFoldable:
+                pass
+            else:
+                literal = getattr(self.semantics, 'literal', None)
+                if literal is not None:
+                    value = literal(value)
+                return self.constant(node, value)
+        return self.fold_children(node)
+
+    def constant(self, node, value):
+        if type(value) in NUMBERS and value < 0:
+            # the converters expect negative numbers as -<number>
+            folded = ast.UnaryOp(op=ast.USub(),
+                                 operand=ast.Constant(value=-value))
+            folded.operand.is_reql = False
+        else:
+            folded = ast.Constant(value=value)
+        folded.is_reql = False
+        return ast.copy_location(folded, node)
+
+    def fold_children(self, node):
+        return map_children(node, self.fold)
+
+
+def fold(node, lang):
+    '''Returns `node` with the native constant subexpressions folded the
+    way `lang` would evaluate them'''
+    return Folder(SEMANTICS[lang]).fold(node)
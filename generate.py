@@ -0,0 +1,786 @@
+#!/usr/bin/env python3
+'''Turns the polyglot yaml suite into ruby, javascript and java test
+files.
+
+The work is a chain of generators, each pulling one item at a time from
+the one before it:
+
+    read_files -> extract_tests [-> hoist_tests] -> transpile_tests
+        -> write_outputs
+
+so only the yaml file currently being converted is held in memory and
+the output files grow as the tests are translated. Java tests go
+through java_test_emitter.TestFileEmitter, which writes each class as
+soon as it is full.
+
+A hand-written snippet for a language (the `rb`, `js` or `java` key of
+a test) always wins over transpiling the generic `cd` one. Tests that
+can't be translated are left out of the output with a comment saying
+why, or dropped silently with `annotate=False`.
+'''
+
+from __future__ import print_function
+
+import argparse
+import ast
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+import batch
+import capabilities
+import hoisting
+import java_test_emitter
+import metrics
+import multireql
+import scheduling
+import sharding
+import snippet_ir
+from conversion_utils import camel
+from parsePolyglot import parse_yaml
+
+logger = logging.getLogger('generate')
+
+# Seconds between two looks at the test directory in --watch mode
+DEFAULT_POLL_INTERVAL = 0.1
+
+TEST = 'test'
+DEFINITION = 'def'
+
+# What hoist_tests shares variables between
+HOIST_SCOPES = ('file', 'test')
+
+EXTENSIONS = {
+    'rb': '.rb',
+    'js': '.js',
+}
+
+# Hand-written java definitions look like "Type name = value;"
+JAVA_DEFINITION_REGEX = re.compile(
+    r'^\s*(?P<type>[\w.<>\[\], ]+?)\s+(?P<name>\w+)\s*=\s*(?P<value>.+?);?\s*$',
+    re.DOTALL)
+
+
+def as_list(value):
+    '''Snippets in polyglot files are either a string or a list'''
+    return value if isinstance(value, list) else [value]
+
+
+class PolyglotTest(object):
+    '''One entry of the `tests` list of a polyglot file'''
+
+    __slots__ = ('path', 'index', 'kind', 'entry', 'reql_vars', 'java_type')
+
+    def __init__(self, path, index, kind, entry, reql_vars, java_type=None):
+        self.path = path
+        self.index = index
+        self.kind = kind
+        self.entry = entry
+        # shared by all the tests of a file, grows with its definitions
+        self.reql_vars = reql_vars
+        # the java type of a definition, when it's known better than
+        # java_test_emitter.definition_type would guess (hoisted terms)
+        self.java_type = java_type
+
+    def source(self, lang):
+        '''(snippet, hand-written?) for `lang`, or (None, False) if
+        the test doesn't apply to it'''
+        entry = self.entry
+        if self.kind == DEFINITION:
+            entry = entry['def']
+            if not isinstance(entry, dict):
+                return entry, False
+        if lang in entry:
+            return entry[lang], True
+        return entry.get('cd'), False
+
+    def expected(self, lang):
+        '''Like source(), for the expected value of a test'''
+        ot = self.entry.get('ot')
+        if not isinstance(ot, dict):
+            return ot, False
+        if lang in ot:
+            return ot[lang], True
+        return ot.get('cd'), False
+
+    def describe(self):
+        return '%s test #%d' % (self.path, self.index + 1)
+
+    def __repr__(self):
+        return 'PolyglotTest(%r, %r, %r)' % (self.path, self.index,
+                                             self.kind)
+
+
+class Translation(object):
+    '''What a test turned into in one language. `error` is a
+    batch.TranspileError when it couldn't be translated, otherwise
+    `queries` holds the converted test queries, or `definition` the
+    converted definition (a (name, type, value) tuple for java)'''
+
+    __slots__ = ('queries', 'expected', 'definition', 'error', 'source')
+
+    def __init__(self, source, queries=None, expected=None,
+                 definition=None, error=None):
+        self.source = source
+        self.queries = queries
+        self.expected = expected
+        self.definition = definition
+        self.error = error
+
+
+def read_files(paths, test_dir=None):
+    '''Yields (name, parsed yaml) for each path. `name` is the path
+    relative to `test_dir`, used to name the output files'''
+    for path in paths:
+        with open(path) as f:
+            parsed = parse_yaml(f.read())
+        name = path if test_dir is None else os.path.relpath(path, test_dir)
+        yield name, parsed
+
+
+def initial_reql_vars(parsed):
+    '''r, plus the tables the test runner creates for the file'''
+    reql_vars = {'r'}
+    table_vars = parsed.get('table_variable_name')
+    if table_vars:
+        reql_vars.update(re.split(r'[,\s]+', table_vars.strip()))
+    return reql_vars
+
+
+def extract_tests(files):
+    '''Yields a PolyglotTest for every definition and test'''
+    for name, parsed in files:
+        reql_vars = initial_reql_vars(parsed)
+        for index, entry in enumerate(parsed.get('tests') or ()):
+            if not isinstance(entry, dict):
+                logger.warning("%s: test #%d is not a mapping, skipping it",
+                               name, index + 1)
+                continue
+            if 'def' in entry:
+                yield PolyglotTest(name, index, DEFINITION, entry, reql_vars)
+            if any(key in entry for key in ('cd', 'py', 'rb', 'js', 'java')):
+                yield PolyglotTest(name, index, TEST, entry, reql_vars)
+
+
+def hoist_tests(tests, scope='file'):
+    '''Rewrites the generic snippets of the tests so that a ReQL term
+    built more than once is built once into a variable (see
+    hoisting.py), yielding a definition of it just before the first
+    test using it. With scope='file' the variables are shared by all
+    the tests of a polyglot file, with 'test' each test gets its own.
+    Holds one file's tests at a time'''
+    if scope not in HOIST_SCOPES:
+        raise ValueError("Unknown hoisting scope %r" % scope)
+    for path, group in itertools.groupby(tests, lambda test: test.path):
+        group = list(group)
+        # one hoister per file keeps the variable names unique in it
+        hoister = hoisting.Hoister(taken=defined_names(group))
+        if scope == 'file':
+            batches = [group]
+        else:
+            batches = [[test] for test in group]
+        for tests_batch in batches:
+            for test in hoist_batch(tests_batch, hoister):
+                yield test
+
+
+def defined_names(tests):
+    '''The names the definitions of a file assign to'''
+    names = set()
+    for test in tests:
+        if test.kind == DEFINITION:
+            for lang in ('cd', 'py', 'rb', 'js', 'java'):
+                source = test.source(lang)[0]
+                match = re.match(r'\s*(?:[\w.<>\[\], ]+\s+)?(\w+)\s*=',
+                                 source or '')
+                if match:
+                    names.add(match.group(1))
+    return names
+
+
+def hoist_batch(tests, hoister):
+    snippets = []
+    for test in tests:
+        if test.kind == TEST and test.entry.get('cd') is not None:
+            snippets.extend(as_list(test.entry['cd']))
+    new_snippets, placements = hoisting.hoist_snippets(snippets, hoister)
+    position = 0
+    for test in tests:
+        if test.kind != TEST or test.entry.get('cd') is None:
+            yield test
+            continue
+        cd = test.entry['cd']
+        count = len(as_list(cd))
+        hoisted = new_snippets[position:position + count]
+        for placement in placements[position:position + count]:
+            for definition in placement:
+                yield PolyglotTest(test.path, test.index, DEFINITION,
+                                   {'def': definition.source},
+                                   test.reql_vars, definition.java_type)
+        position += count
+        if hoisted != as_list(cd):
+            entry = dict(test.entry)
+            entry['cd'] = hoisted if isinstance(cd, list) else hoisted[0]
+            test = PolyglotTest(test.path, test.index, TEST, entry,
+                                test.reql_vars)
+        yield test
+
+
+def transpile_tests(tests, langs=batch.DEFAULT_LANGS, precheck=True,
+                    budget=None, transpile=batch.transpile_one, trees=None,
+                    test_dir=None):
+    '''Yields (test, {lang: Translation}). Languages the test doesn't
+    apply to are left out of the dict. `transpile` converts a single
+    snippet, like batch.transpile_one or a batch.TranspileCache's. With
+    a snippet_ir.TreeCache as `trees`, the snippets of the tests (whose
+    paths are relative to `test_dir`) are parsed through it'''
+    langs = batch.check_langs(langs)
+    for test in tests:
+        if test.kind == DEFINITION:
+            yield test, transpile_definition(test, langs, precheck, budget)
+            continue
+        transpile_test_snippet = transpile
+        if trees is not None:
+            path = test.path if test_dir is None else \
+                os.path.join(test_dir, test.path)
+            transpile_test_snippet = functools.partial(
+                transpile, parser=trees.parser(path))
+        yield test, transpile_test(test, langs, precheck, budget,
+                                   transpile_test_snippet)
+
+
+def transpile_definition(test, langs, precheck=True, budget=None):
+    translations = {}
+    generic = [lang for lang in langs if not test.source(lang)[1]]
+    source = test.source(generic[0])[0] if generic else None
+    if source is not None:
+        try:
+            node = batch.parse(source, test.reql_vars,
+                               None if budget is None else budget.track(),
+                               mode='exec')
+            if type(node) != ast.Assign or len(node.targets) != 1 or \
+               type(node.targets[0]) != ast.Name:
+                raise ValueError("Definitions must assign to one variable")
+        except Exception as e:
+            error = batch.TranspileError.from_exception('parse', None, e)
+            for lang in generic:
+                translations[lang] = Translation(source, error=error)
+        else:
+            translations.update(translate_definition(
+                node, source, generic, test.reql_vars, precheck, budget,
+                test.java_type))
+            if node.is_reql:
+                test.reql_vars.add(node.targets[0].id)
+            else:
+                test.reql_vars.discard(node.targets[0].id)
+    for lang in langs:
+        source, handwritten = test.source(lang)
+        if handwritten:
+            translations[lang] = Translation(
+                source, definition=handwritten_definition(lang, source))
+    return translations
+
+
+def translate_definition(node, source, langs, reql_vars, precheck=True,
+                         budget=None, java_type=None):
+    found = capabilities.features(node.value) if precheck else ()
+    tracker = None if budget is None else budget.track()
+    for lang in langs:
+        reason = capabilities.reason_for(found, lang) if found else None
+        if reason is not None:
+            yield lang, Translation(source, error=batch.TranspileError(
+                'precheck', lang, reason,
+                "Can't translate %s to %s" % (reason, lang)))
+            continue
+        try:
+            if lang == 'java':
+                definition = java_test_emitter.convert_definition(
+                    node, set(reql_vars), java_type)
+            else:
+                definition = batch.transpile_tree(
+                    node, lang, reql_vars, tracker)
+        except Exception as e:
+            yield lang, Translation(source, error=batch.TranspileError
+                                    .from_exception('transpile', lang, e))
+        else:
+            yield lang, Translation(source, definition=definition)
+
+
+def handwritten_definition(lang, source):
+    if lang != 'java':
+        return source
+    match = JAVA_DEFINITION_REGEX.match(source)
+    if match is None:
+        return None, None, source
+    return match.group('name'), match.group('type'), match.group('value')
+
+
+def transpile_test(test, langs, precheck=True, budget=None,
+                   transpile=batch.transpile_one):
+    translations = {}
+    generic = []
+    for lang in langs:
+        source, handwritten = test.source(lang)
+        if source is None:
+            continue
+        if handwritten:
+            translations[lang] = Translation(source, queries=as_list(source))
+        else:
+            generic.append(lang)
+    if not generic:
+        return finish_expected(test, translations, precheck, transpile)
+    source = test.source(generic[0])[0]
+    queries = {lang: [] for lang in generic}
+    for snippet in as_list(source):
+        # once a snippet fails the language is done with this test
+        remaining = [lang for lang in generic if lang in queries]
+        if not remaining:
+            break
+        result = transpile(snippet, remaining, test.reql_vars,
+                           precheck, budget)
+        for lang in remaining:
+            if lang in result.errors:
+                del queries[lang]
+                translations[lang] = Translation(
+                    snippet, error=result.errors[lang])
+            else:
+                queries[lang].append(result.outputs[lang])
+    for lang, converted in queries.items():
+        translations[lang] = Translation(source, queries=converted)
+    return finish_expected(test, translations, precheck, transpile)
+
+
+def finish_expected(test, translations, precheck=True,
+                    transpile=batch.transpile_one):
+    '''Fills in the expected value of every translated test'''
+    for lang, translation in translations.items():
+        if translation.error is not None:
+            continue
+        expected, handwritten = test.expected(lang)
+        if expected is None or handwritten:
+            translation.expected = expected
+            continue
+        result = transpile(expected, (lang,), precheck=precheck)
+        if result.ok:
+            translation.expected = result.outputs[lang]
+        else:
+            translation.error = result.errors[lang]
+    return translations
+
+
+def java_class_name(name):
+    '''Class name for a polyglot file, e.g. regression/1001.yaml ->
+    Regression1001'''
+    parts = re.split(r'[^A-Za-z0-9]+', os.path.splitext(name)[0])
+    class_name = ''.join(camel(part.lower()) for part in parts if part)
+    if not class_name or class_name[0].isdigit():
+        class_name = 'Test' + class_name
+    return class_name
+
+
+class ScriptWriter(object):
+    '''Writes the tests of one polyglot file as a script with one
+    statement per line. `check` is expected to come from the
+    language's test harness'''
+
+    COMMENT = '# %s\n'
+    DEFINITION = '%s\n'
+    TEST = 'check(%s, %s)\n'
+    UNCHECKED_TEST = 'check(%s)\n'
+
+    def __init__(self, path, name):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.out = open(path, 'w')
+        self.comment('Generated from %s, do not edit' % name)
+
+    def comment(self, text):
+        self.out.write(self.COMMENT % java_test_emitter.one_line(text))
+
+    def definition(self, translation):
+        self.out.write(self.DEFINITION % translation.definition)
+
+    def test(self, translation):
+        for query in translation.queries:
+            if translation.expected is None:
+                self.out.write(self.UNCHECKED_TEST % query)
+            else:
+                self.out.write(self.TEST % (query, translation.expected))
+
+    def close(self):
+        self.out.close()
+        return [self.path]
+
+
+class RubyWriter(ScriptWriter):
+    pass
+
+
+class JsWriter(ScriptWriter):
+    COMMENT = '// %s\n'
+    DEFINITION = '%s;\n'
+    TEST = 'check(%s, %s);\n'
+    UNCHECKED_TEST = 'check(%s);\n'
+
+
+class JavaWriter(object):
+    '''Feeds a polyglot file's tests to a TestFileEmitter, writing each
+    class to `out_dir` as soon as it's complete'''
+
+    def __init__(self, out_dir, name, **emitter_args):
+        self.out_dir = out_dir
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.paths = []
+        self.emitter = java_test_emitter.TestFileEmitter(
+            java_class_name(name), on_class=self.write_class,
+            header='Generated from %s, do not edit' % name, **emitter_args)
+
+    def write_class(self, class_name, source):
+        self.paths.extend(java_test_emitter.write_classes(
+            [(class_name, source)], self.out_dir))
+
+    def comment(self, text):
+        self.emitter.add_statement('%s// %s\n' % (
+            java_test_emitter.INDENT, java_test_emitter.one_line(text)))
+
+    def definition(self, translation):
+        name, java_type, value = translation.definition
+        if name is None:
+            self.emitter.add_statement(
+                '%s%s\n' % (java_test_emitter.INDENT, value))
+        else:
+            self.emitter.add_java_definition(name, java_type, value)
+
+    def test(self, translation):
+        sources = as_list(translation.source)
+        for source, query in zip(sources, translation.queries):
+            self.emitter.add_java_test(query, translation.expected, source)
+
+    def close(self):
+        self.emitter.close()
+        return self.paths
+
+
+def open_writers(out_dir, name, langs):
+    base = os.path.splitext(name)[0]
+    writers = {}
+    for lang in langs:
+        if lang == 'java':
+            writers[lang] = JavaWriter(os.path.join(out_dir, lang), name)
+        else:
+            writer_class = RubyWriter if lang == 'rb' else JsWriter
+            writers[lang] = writer_class(
+                os.path.join(out_dir, lang, base + EXTENSIONS[lang]), name)
+    return writers
+
+
+def write_outputs(translated, out_dir, langs=batch.DEFAULT_LANGS,
+                  annotate=True, written=None):
+    '''Writes translated tests to out_dir/<lang>/, one output file (or
+    set of java classes) per polyglot file. Returns a Counter of
+    (lang, outcome) with outcome "test", "def" or "skipped". If given,
+    `written` is filled with polyglot file name -> output paths'''
+    stats = Counter()
+    name = writers = None
+    if written is None:
+        written = {}
+    try:
+        for test, translations in translated:
+            if test.path != name:
+                if writers is not None:
+                    written[name] = close_writers(writers)
+                name = test.path
+                writers = open_writers(out_dir, name, langs)
+            for lang, translation in translations.items():
+                writer = writers[lang]
+                if translation.error is not None:
+                    stats[lang, 'skipped'] += 1
+                    if annotate:
+                        writer.comment('skipped %s (%s, %s): %s' % (
+                            test.describe(), translation.error.kind,
+                            translation.error.message, translation.source))
+                elif test.kind == DEFINITION:
+                    stats[lang, DEFINITION] += 1
+                    writer.definition(translation)
+                else:
+                    stats[lang, TEST] += 1
+                    writer.test(translation)
+    finally:
+        if writers is not None:
+            written[name] = close_writers(writers)
+    return stats
+
+
+def close_writers(writers):
+    paths = []
+    for writer in writers.values():
+        paths.extend(writer.close())
+    return paths
+
+
+def check_writable(langs):
+    '''Languages there's a test file writer for. The wire format has
+    none: it's a fingerprint, not something to run'''
+    langs = batch.check_langs(langs)
+    for lang in langs:
+        if lang != 'java' and lang not in EXTENSIONS:
+            raise ValueError("Can't generate test files for %s" % lang)
+    return langs
+
+
+def generate(test_dir, out_dir, langs=batch.DEFAULT_LANGS, precheck=True,
+             annotate=True, budget=None, paths=None,
+             transpile=batch.transpile_one, written=None, shard=None,
+             hoist=None, shard_model=None, trees=None):
+    '''Runs the whole pipeline over the polyglot files in test_dir (or
+    just `paths`, which must be inside it). With `shard`, an (I, N)
+    pair, only the files of shard I are generated; each polyglot file
+    becomes its own output files, so shards are split by whole file.
+    Files are split by hash, or by predicted cost with a
+    scheduling.CostModel as `shard_model`. `hoist` is a scope for
+    hoist_tests, or None not to hoist. `trees` is a snippet_ir.TreeCache
+    to parse through, which the caller saves'''
+    langs = check_writable(langs)
+    if paths is None:
+        paths = multireql.all_yaml_paths(test_dir)
+    if shard is not None and shard_model is not None:
+        paths = scheduling.shard_paths(paths, shard[1],
+                                       shard_model)[shard[0] - 1]
+    elif shard is not None:
+        paths = [path for path in paths if sharding.shard_of(
+            os.path.relpath(path, test_dir), None, shard[1]) == shard[0]]
+    files = read_files(paths, test_dir)
+    tests = extract_tests(files)
+    if hoist is not None:
+        tests = hoist_tests(tests, hoist)
+    translated = transpile_tests(tests, langs, precheck, budget, transpile,
+                                 trees, test_dir)
+    return write_outputs(translated, out_dir, langs, annotate, written)
+
+
+class Watcher(object):
+    '''Polls test_dir and regenerates the outputs of every polyglot
+    file that changed since the last poll.
+
+    A file counts as changed when its mtime or size moved and its
+    content hash is different, so touching a file or saving it
+    unchanged costs a stat and a hash but no transpiling. Transpiled
+    snippets are kept in a batch.TranspileCache, so an edit only pays
+    for the tests that actually changed. With `shard`, an (I, N) pair,
+    only the files of shard I (by hash, like generate()) are watched.
+    The trees of a snippet_ir.TreeCache passed as `trees` are saved
+    after every poll.
+    '''
+
+    def __init__(self, test_dir, out_dir, langs=batch.DEFAULT_LANGS,
+                 precheck=True, annotate=True, budget=None,
+                 cache_size=batch.DEFAULT_DEDUPE_CACHE_SIZE, fold=False,
+                 hoist=None, shard=None, trees=None):
+        self.test_dir = test_dir
+        self.out_dir = out_dir
+        self.langs = check_writable(langs)
+        self.precheck = precheck
+        self.annotate = annotate
+        self.budget = budget
+        self.hoist = hoist
+        self.shard = shard
+        self.trees = trees
+        self.cache = batch.TranspileCache(cache_size)
+        self.transpile = functools.partial(self.cache.transpile_one,
+                                           fold=fold)
+        # path -> (mtime_ns, size, sha1 of the contents)
+        self.seen = {}
+        # polyglot file name -> output paths written for it
+        self.outputs = {}
+
+    def changed_paths(self):
+        '''Returns (changed, removed) paths since the last call'''
+        changed = []
+        current = set()
+        for path in multireql.all_yaml_paths(self.test_dir):
+            if self.shard is not None and sharding.shard_of(
+                    os.path.relpath(path, self.test_dir), None,
+                    self.shard[1]) != self.shard[0]:
+                continue
+            current.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            old = self.seen.get(path)
+            if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+                continue
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            self.seen[path] = (st.st_mtime_ns, st.st_size, digest)
+            if old is None or old[2] != digest:
+                changed.append(path)
+        removed = [path for path in self.seen if path not in current]
+        for path in removed:
+            del self.seen[path]
+        return changed, removed
+
+    def regenerate(self, path):
+        '''Rewrites the outputs of one polyglot file, deleting the
+        ones it no longer produces (like a java class that's no longer
+        needed). Returns the stats from write_outputs'''
+        name = os.path.relpath(path, self.test_dir)
+        written = {}
+        stats = generate(self.test_dir, self.out_dir, self.langs,
+                         self.precheck, self.annotate, self.budget,
+                         paths=[path], transpile=self.transpile,
+                         written=written, hoist=self.hoist,
+                         trees=self.trees)
+        self.remove_outputs(name, keep=written.get(name, ()))
+        self.outputs[name] = written.get(name, [])
+        return stats
+
+    def remove_outputs(self, name, keep=()):
+        for output in self.outputs.pop(name, ()):
+            if output not in keep and os.path.exists(output):
+                os.remove(output)
+
+    def poll(self):
+        '''Regenerates whatever changed. Returns a list of
+        (path, milliseconds, error or None)'''
+        changed, removed = self.changed_paths()
+        for path in removed:
+            self.remove_outputs(os.path.relpath(path, self.test_dir))
+        events = []
+        for path in changed:
+            start = time.time()
+            try:
+                self.regenerate(path)
+                error = None
+            except Exception as e:
+                logger.exception("Failed to regenerate %s", path)
+                error = e
+            events.append((path, (time.time() - start) * 1000, error))
+        if self.trees is not None and events:
+            # cached results skip the parser, so entries that look
+            # unused may still be needed
+            self.trees.save(prune=False)
+        return events
+
+    def run(self, interval=DEFAULT_POLL_INTERVAL, metrics_path=None):
+        '''Polls forever. The first poll generates everything. With
+        `metrics_path` the metrics are rewritten after every poll that
+        regenerated something'''
+        while True:
+            events = self.poll()
+            for path, ms, error in events:
+                if error is None:
+                    print('regenerated %s in %.1fms' % (path, ms))
+                else:
+                    print('failed %s after %.1fms: %s' % (path, ms, error))
+            if metrics_path and events:
+                metrics.write(metrics_path)
+            sys.stdout.flush()
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir')
+    parser.add_argument('--test-dir', default=multireql.DEFAULT_TEST_DIR)
+    parser.add_argument('--langs', default=','.join(batch.DEFAULT_LANGS),
+                        help='comma separated, default: %(default)s')
+    parser.add_argument('--no-annotate', action='store_true',
+                        help="drop untranslatable tests without a comment")
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, regenerating changed files')
+    parser.add_argument('--interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help='seconds between polls in --watch mode')
+    parser.add_argument('--shard', metavar='I/N', type=sharding.parse_shard,
+                        help='only generate the files of shard I of N')
+    parser.add_argument('--balance', action='store_true',
+                        help='with --shard, split files by predicted '
+                        'transpile time instead of by hash')
+    parser.add_argument('--cost-model', metavar='PATH',
+                        help='cost model for --balance, from '
+                        '`./bench.py calibrate`')
+    parser.add_argument('--fold', action='store_true',
+                        help='compute constant native subexpressions at '
+                        'generation time (see folding.py)')
+    parser.add_argument('--hoist', choices=HOIST_SCOPES,
+                        help='build repeated ReQL terms once, sharing the '
+                        'variable across the whole file or one test '
+                        '(see hoisting.py)')
+    parser.add_argument('--ir-cache', action='store_true',
+                        help='keep the parsed snippets of every polyglot '
+                        'file in a .ir file next to it, and reuse them on '
+                        'the next run (see snippet_ir.py)')
+    parser.add_argument('--intern', action='store_true',
+                        help='share identical subtrees between the parsed '
+                        'snippets of the run, to use less memory')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write prometheus metrics of the run here '
+                        '("-" for stdout)')
+    args = parser.parse_args()
+    if args.watch and args.balance:
+        # predicted costs move with every edit, and files with them
+        parser.error("--balance can't be used with --watch")
+    if args.metrics:
+        metrics.enable()
+    if args.balance and not args.shard:
+        parser.error("--balance only works with --shard")
+    shard_model = None
+    if args.balance:
+        shard_model = scheduling.CostModel.load(args.cost_model) \
+            if args.cost_model else scheduling.CostModel()
+    trees = None
+    if args.ir_cache or args.intern:
+        trees = snippet_ir.TreeCache(args.ir_cache, args.intern, batch.parse)
+    if args.watch:
+        watcher = Watcher(args.test_dir, args.out_dir, args.langs.split(','),
+                          annotate=not args.no_annotate, fold=args.fold,
+                          hoist=args.hoist, shard=args.shard, trees=trees)
+        try:
+            watcher.run(args.interval, args.metrics)
+        except KeyboardInterrupt:
+            pass
+        return
+    paths = shard = None
+    if shard_model is not None:
+        # split here rather than in generate() to report the balance
+        every_path = list(multireql.all_yaml_paths(args.test_dir))
+        bins, loads = scheduling.balance_paths(every_path, args.shard[1],
+                                               shard_model)
+        paths = bins[args.shard[0] - 1]
+    else:
+        shard = args.shard
+    start = time.perf_counter()
+    stats = generate(args.test_dir, args.out_dir,
+                     args.langs.split(','), annotate=not args.no_annotate,
+                     shard=shard, hoist=args.hoist, paths=paths,
+                     transpile=functools.partial(
+                         batch.transpile_one, fold=args.fold),
+                     trees=trees)
+    elapsed = time.perf_counter() - start
+    if trees is not None:
+        trees.save()
+    for (lang, outcome), count in sorted(stats.items()):
+        print('%-5s %-8s %d' % (lang, outcome, count))
+    if shard_model is not None:
+        print('Shard %d/%d: %d of %d files, predicted %.3fs (shard average '
+              '%.3fs, predicted imbalance %.3f), took %.3fs' % (
+                  args.shard + (len(paths), len(every_path),
+                                loads[args.shard[0] - 1],
+                                sum(loads) / len(loads),
+                                scheduling.imbalance(loads), elapsed)))
+    if args.metrics:
+        metrics.write(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
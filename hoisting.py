@@ -0,0 +1,272 @@
+'''Optional common-subexpression hoisting: ReQL terms that a snippet,
+or a whole polyglot file, builds more than once are built once into a
+variable (`hoisted1`, `hoisted2`, ...) and the repeats refer to it.
+
+Only terms that don't depend on anything but `r` are hoisted, so the
+variable can be defined before any test that uses it: a term using a
+lambda's argument, a table variable of the file or `r.row` (which
+belongs to the function around it) stays where it is. Lambdas are
+never hoisted on their own, but a hoisted term may contain one.
+
+`hoist(trees)` works on flagged trees and leaves them alone, returning
+rewritten copies. generate.py uses it through `hoist_snippets`, which
+turns the definitions into python source, so they go through the
+normal definition handling of every language: `hoisted1 = ...` in
+ruby, `var hoisted1 = ...` in javascript and a field of the term's
+java type in java.
+'''
+
+import ast
+from collections import Counter, OrderedDict
+
+from conversion_utils import add_is_reql_flags, map_children
+import java_test_emitter
+
+DEFAULT_PREFIX = 'hoisted'
+
+# r.db('x').table('y') is 7 nodes. Smaller terms are cheaper to build
+# again than to read through a variable
+MIN_HOIST_SIZE = 6
+
+
+class TermInfo(object):
+
+    __slots__ = ('key', 'size', 'free', 'uses_row')
+
+    def __init__(self, key, size, free, uses_row):
+        self.key = key
+        self.size = size
+        # names the term reads that it doesn't bind itself
+        self.free = free
+        self.uses_row = uses_row
+
+
+class Hoister(object):
+    '''Finds the repeated terms of a group of trees'''
+
+    def __init__(self, prefix=DEFAULT_PREFIX, min_size=MIN_HOIST_SIZE,
+                 roots=frozenset('r'), taken=()):
+        self.prefix = prefix
+        self.min_size = min_size
+        self.roots = frozenset(roots)
+        self.taken = set(taken)
+        self.count = 0
+        # id(node) -> TermInfo
+        self.info = {}
+
+    def describe(self, node):
+        '''Fills in self.info for node and everything under it'''
+        size, free, uses_row = 1, set(), False
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.expr_context, ast.operator,
+                                  ast.unaryop, ast.cmpop, ast.boolop)):
+                continue
+            info = self.describe(child)
+            size += info.size
+            free |= info.free
+            uses_row = uses_row or info.uses_row
+        if type(node) == ast.Name:
+            free.add(node.id)
+        elif type(node) == ast.Lambda:
+            free -= {arg.arg for arg in node.args.args}
+        elif type(node) == ast.Attribute and node.attr == 'row' and \
+                type(node.value) == ast.Name and node.value.id == 'r':
+            uses_row = True
+        info = self.info[id(node)] = TermInfo(
+            ast.dump(node), size, free, uses_row)
+        return info
+
+    def eligible(self, node):
+        info = self.info[id(node)]
+        return type(node) == ast.Call and \
+            getattr(node, 'is_reql', False) and \
+            info.size >= self.min_size and \
+            info.free <= self.roots and not info.uses_row
+
+    def occurrences(self, trees):
+        counts = Counter()
+        first = {}
+        for tree in trees:
+            self.describe(tree)
+            for node in ast.walk(tree):
+                if id(node) in self.info and self.eligible(node):
+                    key = self.info[id(node)].key
+                    counts[key] += 1
+                    first.setdefault(key, node)
+        return counts, first
+
+    def rewrite(self, node, names):
+        '''Replaces the hoisted terms in node with their variables'''
+        info = self.info.get(id(node))
+        if info is not None and info.key in names and self.eligible(node):
+            var = ast.copy_location(
+                ast.Name(id=names[info.key], ctx=ast.Load()), node)
+            var.is_reql = True
+            return var
+        return map_children(node, lambda child: self.rewrite(child, names))
+
+    def new_name(self):
+        while True:
+            self.count += 1
+            name = '%s%d' % (self.prefix, self.count)
+            if name not in self.taken:
+                self.taken.add(name)
+                return name
+
+    def hoist(self, trees):
+        '''Returns (definitions, new trees, placement). `definitions`
+        maps each variable to the (rewritten) term it holds, and
+        placement[i] lists the variables to define before trees[i],
+        dependencies first'''
+        trees = list(trees)
+        self.info = {}
+        counts, first = self.occurrences(trees)
+        placeholders = {key: key for key, count in counts.items()
+                        if count > 1}
+        new_trees = [self.rewrite(tree, placeholders) for tree in trees]
+        bodies = {key: map_children(
+            first[key], lambda child: self.rewrite(child, placeholders))
+            for key in placeholders}
+        new_trees = self._collapse(new_trees, bodies)
+        chosen = set(bodies)
+        names = OrderedDict()
+        definitions = OrderedDict()
+        placement = []
+        for tree in new_trees:
+            needed = []
+            self._place(tree, bodies, names, definitions, needed)
+            placement.append(needed)
+        rename = {key: names[key] for key in chosen}
+        new_trees = [self._rename(tree, rename) for tree in new_trees]
+        definitions = OrderedDict(
+            (name, self._rename(body, rename))
+            for name, body in definitions.items())
+        return definitions, new_trees, placement
+
+    def _collapse(self, trees, bodies):
+        '''Puts the placeholders used only once back into the term using
+        them, removing them from `bodies`. A term only repeated inside a
+        bigger hoisted term, like the prefix of a repeated chain, would
+        otherwise become a variable read once. Returns the new trees'''
+        while True:
+            uses = Counter()
+            for tree in trees + list(bodies.values()):
+                for node in ast.walk(tree):
+                    if type(node) == ast.Name and node.id in bodies:
+                        uses[node.id] += 1
+            single = {key: bodies.pop(key) for key in list(bodies)
+                      if uses[key] < 2}
+            if not single:
+                return trees
+            trees = [self._inline(tree, single) for tree in trees]
+            for key in bodies:
+                bodies[key] = self._inline(bodies[key], single)
+
+    def _inline(self, node, single):
+        if type(node) == ast.Name and node.id in single:
+            return self._inline(single[node.id], single)
+        return map_children(node, lambda child: self._inline(child, single))
+
+    def _place(self, node, bodies, names, definitions, needed):
+        '''Names the placeholders in node in order of first use'''
+        for child in ast.walk(node):
+            if type(child) == ast.Name and child.id in bodies and \
+               child.id not in names:
+                body = bodies[child.id]
+                # what the definition uses comes first
+                self._place(body, bodies, names, definitions, needed)
+                if child.id not in names:
+                    names[child.id] = self.new_name()
+                    definitions[names[child.id]] = body
+                    needed.append(names[child.id])
+
+    def _rename(self, node, rename):
+        if type(node) == ast.Name and node.id in rename:
+            var = ast.copy_location(
+                ast.Name(id=rename[node.id], ctx=ast.Load()), node)
+            var.is_reql = True
+            return var
+        return map_children(node, lambda child: self._rename(child, rename))
+
+
+def names_in(trees):
+    names = set()
+    for tree in trees:
+        for node in ast.walk(tree):
+            if type(node) == ast.Name:
+                names.add(node.id)
+            elif type(node) == ast.arg:
+                names.add(node.arg)
+    return names
+
+
+def hoist(trees, prefix=DEFAULT_PREFIX, min_size=MIN_HOIST_SIZE):
+    '''Hoists the repeated terms of flagged trees, see Hoister.hoist'''
+    trees = list(trees)
+    return Hoister(prefix, min_size, taken=names_in(trees)).hoist(trees)
+
+
+class HoistedDefinition(object):
+    '''A variable introduced by hoisting, as python source'''
+
+    __slots__ = ('name', 'source', 'java_type')
+
+    def __init__(self, name, source, java_type):
+        self.name = name
+        self.source = source
+        self.java_type = java_type
+
+    def __repr__(self):
+        return 'HoistedDefinition(%r, %r, %r)' % (
+            self.name, self.source, self.java_type)
+
+
+def hoist_snippets(snippets, hoister=None):
+    '''Hoists the repeated terms of python snippets. Returns (snippets,
+    placement) where placement[i] lists the HoistedDefinitions to put
+    before snippets[i]. Snippets without a hoisted term, or that don't
+    parse, are returned as they were. A repeated chain is hoisted
+    whole, its prefix isn't a variable of its own when nothing else
+    uses it:
+
+    >>> snippets, placement = hoist_snippets(
+    ...     ["r.db('a').table('b').count()"] * 2)
+    >>> snippets
+    ['hoisted1', 'hoisted1']
+    >>> [definition.source for definition in placement[0]]
+    ["hoisted1 = r.db('a').table('b').count()"]
+    '''
+    snippets = list(snippets)
+    trees, parsed = [], []
+    for snippet in snippets:
+        try:
+            tree = ast.parse(snippet, mode='eval').body
+            # names other than r don't matter: hoisted terms only use r
+            add_is_reql_flags(tree)
+        except (SyntaxError, ValueError, RecursionError):
+            tree = None
+        parsed.append(tree)
+        if tree is not None:
+            trees.append(tree)
+    if hoister is None:
+        hoister = Hoister()
+    hoister.taken |= names_in(trees)
+    try:
+        definitions, new_trees, placements = hoister.hoist(trees)
+    except RecursionError:
+        return snippets, [[] for _ in snippets]
+    new_trees, placements = iter(new_trees), iter(placements)
+    result, placement = [], []
+    for snippet, tree in zip(snippets, parsed):
+        if tree is None:
+            result.append(snippet)
+            placement.append([])
+            continue
+        new_tree = next(new_trees)
+        result.append(snippet if new_tree is tree else ast.unparse(new_tree))
+        placement.append([
+            HoistedDefinition(name, '%s = %s' % (
+                name, ast.unparse(definitions[name])),
+                java_test_emitter.term_type(definitions[name]))
+            for name in next(placements)])
+    return result, placement
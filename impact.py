@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+'''Rule-impact index: which polyglot snippets exercise which converter
+rules, so a change to one rule only needs the snippets that use it
+transpiled again.
+
+`build` transpiles the whole corpus under a profiler and records, for
+every snippet, the converter functions it ran (the "rules", like
+`java_converter:ReQLVisitor.visit_Subscript`), the ReQL methods it
+calls and the ast node types it contains. The index also keeps the
+source of the rule modules as they were, so
+
+    ./impact.py build impact.json
+    ... edit java_converter.py ...
+    ./impact.py rerun impact.json --snapshot golden
+
+diffs the rule modules against that source, works out which rules the
+edit touched and transpiles (and checks against a snapshots.py
+snapshot) only the snippets that ran them. `--since REV` diffs against
+a git revision instead.
+
+A changed line inside a function affects that function. A changed
+module-level assignment (like TOPLEVEL_CONSTANTS) affects every
+function that reads the name, a change in a class body outside its
+methods affects the whole class, and any other module-level change
+affects the whole module. A new `visit_Foo` method also affects every
+snippet containing a Foo node, since those used to go somewhere else.
+Converters are reused between snippets (batch.converter_for), so a
+change to an `__init__` or `reset` affects every snippet that ran the
+module, not just the ones the index saw calling it.
+Only the modules in RULE_MODULES are indexed; a change anywhere else
+needs a full run.
+'''
+
+from __future__ import print_function
+
+import argparse
+import ast
+import difflib
+import json
+import os
+import subprocess
+import sys
+
+import batch
+import capabilities
+import conversion_utils
+import folding
+import java_converter
+import js_converter
+import multireql
+import ruby_converter
+import snapshots
+import wire_converter
+
+INDEX_FORMAT_VERSION = 1
+
+RULE_MODULES = (
+    capabilities,
+    conversion_utils,
+    folding,
+    java_converter,
+    js_converter,
+    ruby_converter,
+    wire_converter,
+)
+
+# Methods that set a reused object up: they don't run for every snippet
+# that depends on them
+SETUP_METHODS = ('__init__', 'reset')
+
+
+def module_name(module):
+    return module.__name__.rpartition('.')[2]
+
+
+def rule_name(module, qualname):
+    '''Comprehensions and lambdas count as part of the function they're
+    in: Visitor.visit_List.<locals>.<listcomp> -> Visitor.visit_List'''
+    parts = qualname.split('.')
+    for i, part in enumerate(parts):
+        if part.startswith('<') and part != '<locals>':
+            parts = parts[:i]
+            if parts and parts[-1] == '<locals>':
+                parts.pop()
+            break
+    if not parts:
+        return None
+    return '%s:%s' % (module, '.'.join(parts))
+
+
+class Recorder(object):
+    '''A sys.setprofile hook collecting the rules called while it's
+    installed'''
+
+    def __init__(self, modules=RULE_MODULES):
+        self.files = {os.path.abspath(module.__file__): module_name(module)
+                      for module in modules}
+        # code objects only know their qualname from python 3.11 on.
+        # Before that it's looked up by line in the module's source
+        self.source_maps = {}
+        if not hasattr(self.profile.__code__, 'co_qualname'):
+            for module in modules:
+                with open(module.__file__) as f:
+                    self.source_maps[module_name(module)] = SourceMap(
+                        module_name(module), f.read())
+        # code object -> rule name, or None if it's not a rule
+        self.rules = {}
+        self.called = set()
+
+    def profile(self, frame, event, arg):
+        if event != 'call':
+            return
+        code = frame.f_code
+        try:
+            rule = self.rules[code]
+        except KeyError:
+            module = self.files.get(os.path.abspath(code.co_filename))
+            rule = None if module is None else rule_name(
+                module, self.qualname(module, code))
+            self.rules[code] = rule
+        if rule is not None:
+            self.called.add(rule)
+
+    def qualname(self, module, code):
+        try:
+            return code.co_qualname
+        except AttributeError:
+            pass
+        # lambdas and comprehensions start inside the function they're
+        # in, and count as part of it anyway
+        return self.source_maps[module].function_at(code.co_firstlineno) \
+            or code.co_name
+
+    def record(self, func, *args, **kwargs):
+        '''Calls func, returning (its result, set of rules it ran)'''
+        self.called = set()
+        sys.setprofile(self.profile)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+        return result, self.called
+
+
+def tree_features(node):
+    '''(node types, reql method names) in a parsed and flagged snippet'''
+    node_types, methods = set(), set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.expr_context):
+            continue
+        node_types.add(node.__class__.__name__)
+        if type(node) == ast.Call and getattr(node, 'is_reql', False) and \
+           type(node.func) == ast.Attribute:
+            methods.add(node.func.attr)
+        stack.extend(ast.iter_child_nodes(node))
+    return node_types, methods
+
+
+class ImpactIndex(object):
+    '''Per snippet: the rules, methods and node types it touches'''
+
+    def __init__(self, entries=None, sources=None, langs=batch.DEFAULT_LANGS):
+        # snippet -> {'rules': set, 'methods': set, 'nodes': set}
+        self.entries = entries if entries is not None else {}
+        # module name -> source when the index was built
+        self.sources = sources if sources is not None else {}
+        self.langs = tuple(langs)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, snippets, langs=batch.DEFAULT_LANGS,
+              modules=RULE_MODULES):
+        langs = batch.check_langs(langs)
+        indexed = {module_name(module) for module in modules}
+        unindexed = [lang for lang in langs
+                     if module_name(batch.LANGUAGES[lang]) not in indexed]
+        if unindexed:
+            raise ValueError("The converters of %s aren't rule modules"
+                             % ', '.join(unindexed))
+        index = cls(langs=langs)
+        for module in modules:
+            with open(module.__file__) as f:
+                index.sources[module_name(module)] = f.read()
+        recorder = Recorder(modules)
+        for snippet in snippets:
+            if snippet in index.entries:
+                continue
+            # the fast path skips the converters, so it would hide which
+            # rules the snippet depends on
+            _, rules = recorder.record(
+                batch.transpile_one, snippet, langs, fast=False)
+            try:
+                node_types, methods = tree_features(batch.parse(snippet))
+            except Exception:
+                node_types, methods = set(), set()
+            index.entries[snippet] = {
+                'rules': rules,
+                'methods': methods,
+                'nodes': node_types,
+            }
+        return index
+
+    def snippets_for(self, rules=(), methods=(), nodes=()):
+        '''Snippets touching any of the given rules, methods or node
+        types, in index order'''
+        rules, methods, nodes = set(rules), set(methods), set(nodes)
+        return [snippet for snippet, entry in self.entries.items()
+                if entry['rules'] & rules or entry['methods'] & methods or
+                entry['nodes'] & nodes]
+
+    def all_rules(self):
+        rules = set()
+        for entry in self.entries.values():
+            rules |= entry['rules']
+        return rules
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': INDEX_FORMAT_VERSION,
+                'langs': list(self.langs),
+                'sources': self.sources,
+                'snippets': [
+                    dict(snippet=snippet,
+                         **{key: sorted(values)
+                            for key, values in entry.items()})
+                    for snippet, entry in self.entries.items()],
+            }, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_FORMAT_VERSION:
+            raise ValueError("Unsupported impact index version %r"
+                             % data.get('version'))
+        entries = {}
+        for item in data['snippets']:
+            entries[item['snippet']] = {
+                key: set(item[key]) for key in ('rules', 'methods', 'nodes')}
+        return cls(entries, data['sources'], data['langs'])
+
+
+class SourceMap(object):
+    '''Which function (as a rule name) each line of a module is in'''
+
+    def __init__(self, module, source):
+        self.module = module
+        # (first line, last line, qualname), outermost first
+        self.functions = []
+        # (first line, last line, class qualname)
+        self.classes = []
+        # name -> qualnames of the functions reading it
+        self.readers = {}
+        # (first line, last line, names) of module-level assignments
+        self.assignments = []
+        # name -> names of module-level values computed from it
+        self.derived = {}
+        # lines that don't do anything: blanks, comments, docstrings
+        self.inert = {number for number, line in
+                      enumerate(source.splitlines(), 1)
+                      if not line.strip() or line.strip().startswith('#')}
+        tree = ast.parse(source)
+        self._walk(tree.body, '')
+        for statement in tree.body:
+            if type(statement) == ast.Expr and \
+               type(statement.value) == ast.Constant:
+                self.inert.update(range(statement.lineno,
+                                        statement.end_lineno + 1))
+            elif isinstance(statement, (ast.Assign, ast.AugAssign,
+                                        ast.AnnAssign)):
+                targets = getattr(statement, 'targets', None) or \
+                    [statement.target]
+                names = {node.id for target in targets
+                         for node in ast.walk(target)
+                         if type(node) == ast.Name}
+                self.assignments.append(
+                    (statement.lineno, statement.end_lineno, names))
+                for node in ast.walk(statement.value):
+                    if type(node) == ast.Name:
+                        self.derived.setdefault(node.id, set()).update(names)
+
+    def _walk(self, body, prefix):
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                qualname = prefix + node.name
+                first = min([node.lineno] + [
+                    d.lineno for d in node.decorator_list])
+                self.functions.append((first, node.end_lineno, qualname))
+                for child in ast.walk(node):
+                    if type(child) == ast.Name and \
+                       type(child.ctx) == ast.Load:
+                        self.readers.setdefault(child.id, set()).add(
+                            qualname)
+                self._walk(node.body, qualname + '.<locals>.')
+            elif isinstance(node, ast.ClassDef):
+                qualname = prefix + node.name
+                for statement in node.body:
+                    if type(statement) == ast.Expr and \
+                       type(statement.value) == ast.Constant:
+                        self.inert.update(range(statement.lineno,
+                                                statement.end_lineno + 1))
+                self.classes.append((node.lineno, node.end_lineno, qualname))
+                self._walk(node.body, qualname + '.')
+            else:
+                # functions inside if/try blocks still count
+                for field in ('body', 'orelse', 'finalbody'):
+                    self._walk(getattr(node, field, None) or [], prefix)
+                for handler in getattr(node, 'handlers', None) or []:
+                    self._walk(handler.body, prefix)
+
+    def rule(self, qualname):
+        return '%s:%s' % (self.module, qualname)
+
+    def function_names(self):
+        return {qualname for _, _, qualname in self.functions}
+
+    def function_at(self, line):
+        '''The qualname of the innermost function containing the line,
+        or None'''
+        innermost = None
+        for first, last, qualname in self.functions:
+            if first <= line <= last:
+                innermost = qualname
+        return innermost
+
+    def affected(self, line):
+        '''Returns (rules, True if the whole module is affected)'''
+        innermost = self.function_at(line)
+        if innermost is not None:
+            return {self.rule(innermost)}, False
+        if line in self.inert:
+            return set(), False
+        for first, last, qualname in self.classes:
+            if first <= line <= last:
+                return {self.rule(name) for name in self.function_names()
+                        if name.startswith(qualname + '.')}, False
+        for first, last, names in self.assignments:
+            if first <= line <= last:
+                rules = set()
+                for name in self.dependents(names):
+                    rules |= {self.rule(qualname)
+                              for qualname in self.readers.get(name, ())}
+                return rules, False
+        return set(), True
+
+    def dependents(self, names):
+        '''names, plus the module-level values computed from them'''
+        names = set(names)
+        todo = list(names)
+        while todo:
+            for name in self.derived.get(todo.pop(), ()):
+                if name not in names:
+                    names.add(name)
+                    todo.append(name)
+        return names
+
+
+def changed_lines(old, new):
+    '''(changed line numbers in old, changed line numbers in new),
+    1-based'''
+    old_lines, new_lines = set(), set()
+    matcher = difflib.SequenceMatcher(
+        None, old.splitlines(), new.splitlines(), autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        old_lines.update(range(i1 + 1, i2 + 1))
+        new_lines.update(range(j1 + 1, j2 + 1))
+    return old_lines, new_lines
+
+
+class Impact(object):
+    '''What a change to the rule modules affects'''
+
+    def __init__(self):
+        self.rules = set()
+        self.nodes = set()
+        # modules changed outside any function or assignment
+        self.modules = set()
+
+    def __bool__(self):
+        return bool(self.rules or self.nodes or self.modules)
+
+    __nonzero__ = __bool__
+
+    def add_module(self, module, old, new):
+        if old == new:
+            return
+        try:
+            old_map = SourceMap(module, old)
+            new_map = SourceMap(module, new)
+        except SyntaxError:
+            self.modules.add(module)
+            return
+        old_lines, new_lines = changed_lines(old, new)
+        for source_map, lines in ((old_map, old_lines),
+                                  (new_map, new_lines)):
+            for line in lines:
+                rules, whole_module = source_map.affected(line)
+                self.rules |= rules
+                if whole_module:
+                    self.modules.add(module)
+        for qualname in new_map.function_names() - old_map.function_names():
+            name = qualname.rpartition('.')[2]
+            if name.startswith('visit_'):
+                self.nodes.add(name[len('visit_'):])
+
+    def whole_modules(self):
+        '''The modules a change affects every snippet of'''
+        modules = set(self.modules)
+        for rule in self.rules:
+            module, _, qualname = rule.partition(':')
+            if qualname.rpartition('.')[2] in SETUP_METHODS:
+                modules.add(module)
+        return modules
+
+    def snippets(self, index):
+        modules = self.whole_modules()
+        if modules:
+            prefixes = tuple(module + ':' for module in modules)
+            rules = self.rules | {rule for rule in index.all_rules()
+                                  if rule.startswith(prefixes)}
+        else:
+            rules = self.rules
+        return index.snippets_for(rules=rules, nodes=self.nodes)
+
+
+def git_source(rev, path):
+    '''The contents of path at a git revision, or '' if it didn't
+    exist'''
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        return subprocess.check_output(
+            ['git', 'show', '%s:./%s' % (rev, os.path.basename(path))],
+            cwd=directory, stderr=subprocess.PIPE).decode('utf-8')
+    except subprocess.CalledProcessError:
+        return ''
+
+
+def find_impact(index, since=None, modules=RULE_MODULES):
+    '''Compares the rule modules on disk with the index's copy (or with
+    git revision `since`)'''
+    impact = Impact()
+    for module in modules:
+        name = module_name(module)
+        with open(module.__file__) as f:
+            new = f.read()
+        if since is not None:
+            old = git_source(since, module.__file__)
+        else:
+            old = index.sources.get(name, '')
+        impact.add_module(name, old, new)
+    return impact
+
+
+def rerun(index, impact, snapshot=None):
+    '''Transpiles the affected snippets. With a snapshots.SnapshotStore
+    returns the Changes among them, otherwise the TranspileResults'''
+    snippets = impact.snippets(index)
+    results = batch.transpile_many(snippets, index.langs)
+    if snapshot is None:
+        return snippets, list(results)
+    return snippets, snapshot.compare(results, partial=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build = subparsers.add_parser('build', help='index the corpus')
+    build.add_argument('index')
+    build.add_argument('--test-dir', default=multireql.DEFAULT_TEST_DIR)
+    build.add_argument('--langs', default=','.join(batch.DEFAULT_LANGS))
+
+    show = subparsers.add_parser(
+        'affected', help='list the rules a change touches and the '
+        'snippets that use them')
+    show.add_argument('index')
+    show.add_argument('--since', metavar='REV')
+
+    again = subparsers.add_parser(
+        'rerun', help='transpile only the snippets a change affects')
+    again.add_argument('index')
+    again.add_argument('--since', metavar='REV')
+    again.add_argument('--snapshot', metavar='PATH',
+                       help='compare with a snapshots.py snapshot')
+
+    query = subparsers.add_parser(
+        'query', help='list the snippets using rules, methods or nodes')
+    query.add_argument('index')
+    query.add_argument('--rule', action='append', default=[])
+    query.add_argument('--method', action='append', default=[])
+    query.add_argument('--node', action='append', default=[])
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        index = ImpactIndex.build(multireql.every_snippet(args.test_dir),
+                                  args.langs.split(','))
+        index.save(args.index)
+        print("Indexed %d snippets using %d rules" % (
+            len(index), len(index.all_rules())))
+        return
+
+    index = ImpactIndex.load(args.index)
+    if args.command == 'query':
+        for snippet in index.snippets_for(args.rule, args.method, args.node):
+            print(snippet)
+        return
+
+    impact = find_impact(index, args.since)
+    if args.command == 'affected':
+        for rule in sorted(impact.rules):
+            print('rule   %s' % rule)
+        for node in sorted(impact.nodes):
+            print('node   %s' % node)
+        for module in sorted(impact.whole_modules()):
+            print('module %s' % module)
+        snippets = impact.snippets(index)
+        print("%d of %d snippets affected" % (len(snippets), len(index)))
+        return
+
+    snapshot = None
+    if args.snapshot:
+        snapshot = snapshots.SnapshotStore(args.snapshot)
+    snippets, results = rerun(index, impact, snapshot)
+    if snapshot is None:
+        for result in results:
+            print(json.dumps(result.as_dict(), sort_keys=True))
+        print("Transpiled %d of %d snippets" % (len(snippets), len(index)))
+        return
+    for change in results:
+        print(snapshots.format_change(change))
+    print("%d outputs differ in %d of %d snippets" % (
+        len(results), len(snippets), len(index)))
+    sys.exit(1 if results else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import ast
+import base64
+import json
 import logging
+import math
 import re
 
 try:
@@ -7,7 +10,8 @@ try:
 except ImportError:
     from cStringIO import StringIO
 
-from conversion_utils import camel, dromedary
+from conversion_utils import (
+    bulk_dict, bulk_literals, camel, dromedary, subscript_index)
 
 logger = logging.getLogger('java_converter')
 
@@ -60,19 +64,89 @@ def is_name(name, node):
     return type(node) == ast.Name and node.id == name
 
 
+# javac limits. A string constant can't be more than 65535 bytes of
+# modified UTF-8, where a character outside the BMP takes 6 bytes, and a
+# method can't be more than 64KB of bytecode, of which each element of
+# an array literal takes around 10 bytes. Literals past these sizes are
+# split up or moved into string constants.
+JAVA_MAX_STRING_CHARS = 10000
+JAVA_MAX_INLINE_ELEMENTS = 2000
+JAVA_MAX_INLINE_BYTES = 4096
+
+JAVA_MAX_LONG = 9223372036854775807
+
+# Java bytes are signed :(
+JAVA_BYTES = tuple(str(byte - 256 if byte > 127 else byte)
+                   for byte in range(256))
+
+# The only printable characters that need escaping
+PRINTABLE_ESCAPES = {ord('"'): r'\"', ord('\\'): r'\\'}
+
+
+def escape_char(codepoint):
+    rpr = repr(codepoint)[1:-1]
+    if rpr.startswith('\\x'):
+        # Python will shorten unicode escapes that are less than a
+        # byte to use \x instead of \u . Java doesn't accept \x so
+        # we have to expand it back out.
+        rpr = '\\u00' + rpr[2:]
+    elif rpr == '"':
+        rpr = r'\"'
+    return rpr
+
+
+def string_literal(s):
+    '''The java string constant for s'''
+    if s.isprintable():
+        return '"' + s.translate(PRINTABLE_ESCAPES) + '"'
+    return '"' + ''.join([escape_char(c) for c in s]) + '"'
+
+
 def escape_string(s, out):
-    out.write('"')
-    for codepoint in s:
-        rpr = repr(codepoint)[1:-1]
-        if rpr.startswith('\\x'):
-            # Python will shorten unicode escapes that are less than a
-            # byte to use \x instead of \u . Java doesn't accept \x so
-            # we have to expand it back out.
-            rpr = '\\u00' + rpr[2:]
-        elif rpr == '"':
-            rpr = r'\"'
-        out.write(rpr)
-    out.write('"')
+    out.write(string_literal(s))
+
+
+def string_expr(s):
+    '''A java expression for s, joined from several constants when
+    it's too long for one'''
+    if len(s) <= JAVA_MAX_STRING_CHARS:
+        return string_literal(s)
+    return 'String.join("", %s)' % ', '.join(
+        string_literal(s[i:i + JAVA_MAX_STRING_CHARS])
+        for i in range(0, len(s), JAVA_MAX_STRING_CHARS))
+
+
+def number_literal(n, negative=False):
+    text = repr(n)
+    if not isinstance(n, float):
+        if n > JAVA_MAX_LONG or n < -JAVA_MAX_LONG - 1:
+            text += ".0"
+        else:
+            text += "L"
+    return "-" + text if negative else text
+
+
+def literal_texts(kind, values):
+    '''Java source for each (value, negative) of a
+    conversion_utils.bulk_literals run'''
+    if kind == 'number':
+        return [number_literal(n, negative) for n, negative in values]
+    elif kind == 'str':
+        return [string_expr(s) for s, _ in values]
+    return ['true' if b else 'false' for b, _ in values]
+
+
+def json_texts(kind, values):
+    '''Like literal_texts, but JSON. Returns None if some value has no
+    JSON form'''
+    if kind == 'number':
+        if any(isinstance(n, float) and not math.isfinite(n)
+               for n, _ in values):
+            return None
+        return [("-" if negative else "") + repr(n) for n, negative in values]
+    elif kind == 'str':
+        return [json.dumps(s) for s, _ in values]
+    return ['true' if b else 'false' for b, _ in values]
 
 
 def py_to_java_type(py_type):
@@ -131,13 +205,17 @@ class Visitor(ast.NodeVisitor):
                  is_def=False,
                  smart_bracket=True,
     ):
-        self.out = StringIO() if out is None else out
         self.reql_vars = reql_vars
         self.type = py_to_java_type(type_)
         self._type = type_
         self.is_def = is_def
         self.smart_bracket = smart_bracket
         super(Visitor, self).__init__()
+        self.reset(out)
+
+    def reset(self, out=None):
+        '''Starts a fresh output buffer so the visitor can be reused'''
+        self.out = StringIO() if out is None else out
         self.write = self.out.write
 
     def skip(self, message, *args, **kwargs):
@@ -158,7 +236,14 @@ class Visitor(ast.NodeVisitor):
             self.visit(item)
 
     def to_str(self, s):
-        escape_string(s, self.out)
+        self.write(string_expr(s))
+
+    def to_json(self, text):
+        '''Emits a literal too big to inline as r.json on a string
+        constant, which costs no bytecode per element'''
+        self.write("r.json(")
+        self.to_str(text)
+        self.write(")")
 
     def cast_null(self, arg, cast='ReqlExpr'):
         '''Emits a cast to (ReqlExpr) if the node represents null'''
@@ -221,16 +306,15 @@ class Visitor(ast.NodeVisitor):
         self.to_str(node.s)
 
     def visit_Bytes(self, node, skip_prefix=False, skip_suffix=False):
+        if len(node.s) > JAVA_MAX_INLINE_BYTES and \
+           not (skip_prefix or skip_suffix):
+            self.write("Base64.getDecoder().decode(")
+            self.to_str(base64.b64encode(node.s).decode('ascii'))
+            self.write(")")
+            return
         if not skip_prefix:
             self.write("new byte[]{")
-        for i, byte in enumerate(node.s):
-            if i > 0:
-                self.write(", ")
-            # Java bytes are signed :(
-            if byte > 127:
-                self.write(str(-(256 - byte)))
-            else:
-                self.write(str(byte))
+        self.write(", ".join([JAVA_BYTES[byte] for byte in node.s]))
         if not skip_suffix:
             self.write("}")
         else:
@@ -279,12 +363,7 @@ class Visitor(ast.NodeVisitor):
         self.write(dromedary(node.attr))
 
     def visit_Num(self, node):
-        self.write(repr(node.n))
-        if not isinstance(node.n, float):
-            if node.n > 9223372036854775807 or node.n < -9223372036854775808:
-                self.write(".0")
-            else:
-                self.write("L")
+        self.write(number_literal(node.n))
 
     def visit_Index(self, node):
         self.visit(node.value)
@@ -334,6 +413,10 @@ class Visitor(ast.NodeVisitor):
         self.to_args(node.args, node.keywords)
 
     def visit_Dict(self, node):
+        kind, keys, values = bulk_dict(node)
+        if kind is not None:
+            self.bulk_dict(kind, keys, values)
+            return
         self.write("r.hashMap(")
         if len(node.keys) > 0:
             self.visit(node.keys[0])
@@ -346,9 +429,33 @@ class Visitor(ast.NodeVisitor):
             self.visit(v)
         self.write(")")
 
+    def bulk_dict(self, kind, keys, values):
+        if len(keys) > JAVA_MAX_INLINE_ELEMENTS:
+            texts = json_texts(kind, values)
+            if texts is not None:
+                self.to_json('{%s}' % ','.join([
+                    json.dumps(key) + ':' + text
+                    for key, text in zip(keys, texts)]))
+                return
+        texts = literal_texts(kind, values)
+        self.write("r.hashMap(")
+        self.write(").with(".join([
+            string_expr(key) + ", " + text
+            for key, text in zip(keys, texts)]))
+        self.write(")")
+
     def visit_List(self, node):
+        kind, values = bulk_literals(node.elts)
+        if kind is not None and len(values) > JAVA_MAX_INLINE_ELEMENTS:
+            texts = json_texts(kind, values)
+            if texts is not None:
+                self.to_json('[%s]' % ','.join(texts))
+                return
         self.write("r.array(")
-        self.join(", ", node.elts)
+        if kind is None:
+            self.join(", ", node.elts)
+        else:
+            self.write(", ".join(literal_texts(kind, values)))
         self.write(")")
 
     def visit_Tuple(self, node):
@@ -363,13 +470,14 @@ class Visitor(ast.NodeVisitor):
         self.visit(node.body)
 
     def visit_Subscript(self, node):
-        if node.slice is None or type(node.slice.value) not in (ast.Num, ast.Str):
+        index = subscript_index(node.slice)
+        if index is None or not isinstance(index, (ast.Num, ast.Str)):
             logger.error("While doing: %s", ast.dump(node))
             raise RuntimeError("Only integers and string subscript can be converted."
-                               " Got %s" % node.slice.value.s)
+                               " Got %s" % ast.dump(node.slice))
         self.visit(node.value)
         self.write(".bracket(")
-        self.visit(node.slice.value)
+        self.visit(index)
         self.write(")")
 
     def visit_ListComp(self, node):
@@ -505,15 +613,16 @@ class ReQLVisitor(Visitor):
 
     def visit_Subscript(self, node):
         self.visit(node.value)
-        if type(node.slice) == ast.Index:
+        index = subscript_index(node.slice)
+        if index is not None:
             # Syntax like a[2] or a["b"]
-            if self.smart_bracket and type(node.slice.value) == ast.Str:
+            if self.smart_bracket and isinstance(index, ast.Str):
                 self.write(".g(")
-            elif self.smart_bracket and type(node.slice.value) == ast.Num:
+            elif self.smart_bracket and isinstance(index, ast.Num):
                 self.write(".nth(")
             else:
                 self.write(".bracket(")
-            self.visit(node.slice.value)
+            self.visit(index)
             self.write(")")
         elif type(node.slice) == ast.Slice:
             # Syntax like a[1:2] or a[:2]
@@ -541,7 +650,7 @@ class ReQLVisitor(Visitor):
                 return default
             elif type(bound) == ast.UnaryOp and type(bound.op) == ast.USub:
                 return -bound.operand.n
-            elif type(bound) == ast.Num:
+            elif isinstance(bound, ast.Num):
                 return bound.n
             else:
                 raise RuntimeError(
@@ -555,7 +664,7 @@ class ReQLVisitor(Visitor):
         is_toplevel_constant = False
         if attr_matches("r.row", node):
             self.skip("Java driver doesn't support r.row")
-        elif is_name("r", node.value) and node.attr in self.TOPLEVEL_CONSTANTS:
+        elif is_name("r", node.value) and node.attr in TOPLEVEL_CONSTANTS:
             # Python has r.minval, r.saturday etc. We need to emit
             # r.minval() and r.saturday()
             is_toplevel_constant = True
@@ -0,0 +1,346 @@
+'''Packs converted java snippets into JUnit test classes.
+
+javac refuses methods with more than 64KB of bytecode and gets very
+slow on huge classes, so the tests from one polyglot file are spread
+over several methods and classes, each kept under a size budget. The
+classes don't depend on each other, so they can be compiled in
+parallel.
+
+Definitions (the `def:` entries in polyglot tests) become static
+fields, so they stay visible across methods, and every class after
+the first replays the definitions seen so far in its @BeforeClass
+method. The test statements call `runOrCatch`, which is expected to
+come from the base class. Classes without a base class define it
+themselves, running the queries on a server at $RETHINKDB_HOST
+(localhost by default).
+'''
+
+import ast
+import os
+import logging
+from collections import OrderedDict
+
+import java_converter
+from conversion_utils import add_is_reql_flags
+
+logger = logging.getLogger('java_test_emitter')
+
+# javac's hard limit is 64KB of bytecode per method. The size of the
+# java source is a cheap stand-in which stays well below that for
+# query building code.
+DEFAULT_MAX_METHOD_BYTES = 24 * 1024
+DEFAULT_MAX_CLASS_BYTES = 256 * 1024
+
+DEFAULT_IMPORTS = (
+    'com.rethinkdb.RethinkDB',
+    'com.rethinkdb.gen.ast.*',
+    'com.rethinkdb.gen.exc.*',
+    'com.rethinkdb.model.*',
+    'java.nio.charset.StandardCharsets',
+    'java.util.*',
+    'java.util.stream.*',
+    'org.junit.*',
+    'org.junit.runners.MethodSorters',
+    'static org.junit.Assert.assertEquals',
+)
+
+# What a class without a base class needs for its own runOrCatch
+STANDALONE_IMPORTS = (
+    'com.rethinkdb.ast.ReqlAst',
+    'com.rethinkdb.net.Connection',
+)
+
+STANDALONE_MEMBERS = '''\
+    public static final RethinkDB r = RethinkDB.r;
+    static Connection conn;
+
+    @BeforeClass
+    public static void connect() throws Exception {
+        String host = System.getenv("RETHINKDB_HOST");
+        conn = r.connection()
+            .hostname(host == null ? "localhost" : host).connect();
+    }
+
+    @AfterClass
+    public static void disconnect() {
+        conn.close();
+    }
+
+    static Object runOrCatch(Object query) {
+        if (!(query instanceof ReqlAst)) {
+            return query;
+        }
+        try {
+            return ((ReqlAst) query).run(conn);
+        } catch (Exception e) {
+            return e;
+        }
+    }
+'''
+
+INDENT = '        '
+
+
+def driver_class(name):
+    '''A stand-in for a class of the python driver's rethinkdb.ast
+    module, which isn't needed for transpiling'''
+    return type(name, (object,), {'__module__': 'rethinkdb.ast'})
+
+
+# The terms whose java class has methods ReqlExpr doesn't (tables have
+# insert, get_all, index_create, ...). Everything else is a ReqlExpr
+TERM_CLASSES = {
+    'db': driver_class('DB'),
+    'table': driver_class('Table'),
+}
+
+
+def term_type(node):
+    '''The java type of a variable holding the term built by `node`'''
+    term = None
+    if type(node) == ast.Call and type(node.func) == ast.Attribute:
+        term = TERM_CLASSES.get(node.func.attr)
+    return java_converter.py_to_java_type(term or 'ReqlExpr')
+
+
+def definition_type(node):
+    '''Guess the java type for the value assigned in a definition'''
+    if node.is_reql:
+        return term_type(node.value)
+    try:
+        value = ast.literal_eval(node.value)
+    except (ValueError, TypeError, SyntaxError):
+        return 'Object'
+    if isinstance(value, (list, tuple)):
+        # lists are emitted as r.array(...)
+        return 'ReqlExpr'
+    try:
+        return java_converter.py_to_java_type(type(value))
+    except KeyError:
+        return 'Object'
+
+
+def convert_definition(node, reql_vars, java_type=None):
+    '''Converts a flagged ast.Assign into (name, java type, value).
+    Updates `reql_vars` so later snippets know whether the name holds a
+    reql term'''
+    java_type = java_type or definition_type(node)
+    name = java_converter.Visitor().convert(node.targets[0])
+    if node.is_reql:
+        value = java_converter.ReQLVisitor(
+            reql_vars, type_=java_type, is_def=True,
+        ).convert(node.value)
+        reql_vars.add(node.targets[0].id)
+    else:
+        value = java_converter.Visitor().convert(node.value)
+        reql_vars.discard(node.targets[0].id)
+    return name, java_type, value
+
+
+def one_line(text):
+    return ' '.join(str(text).split())
+
+
+class TestFileEmitter(object):
+    '''Accumulates java test statements and splits them into classes
+    and methods that stay under the size budgets. Finished classes are
+    handed to `on_class(class_name, source)` as soon as they are full,
+    or collected in `self.classes` if no callback is given. `header` is
+    an optional comment put at the top of every class.'''
+
+    TEST_TEMPLATE = (
+        '{indent}{{\n'
+        '{indent}    // {comment}\n'
+        '{indent}    Object expected = {expected};\n'
+        '{indent}    Object obtained = runOrCatch({query});\n'
+        '{indent}    assertEquals(expected, obtained);\n'
+        '{indent}}}\n'
+    )
+    UNCHECKED_TEST_TEMPLATE = (
+        '{indent}// {comment}\n'
+        '{indent}runOrCatch({query});\n'
+    )
+    DEFINITION_TEMPLATE = '{indent}{name} = ({type}) ({value});\n'
+
+    def __init__(self,
+                 class_name,
+                 package=None,
+                 base_class=None,
+                 imports=DEFAULT_IMPORTS,
+                 reql_vars=frozenset('r'),
+                 max_method_bytes=DEFAULT_MAX_METHOD_BYTES,
+                 max_class_bytes=DEFAULT_MAX_CLASS_BYTES,
+                 on_class=None,
+                 header=None,
+    ):
+        self.class_name = class_name
+        self.header = header
+        self.package = package
+        self.base_class = base_class
+        self.imports = imports
+        self.reql_vars = set(reql_vars)
+        self.max_method_bytes = max_method_bytes
+        self.max_class_bytes = max_class_bytes
+        self.classes = []
+        self.on_class = on_class or (
+            lambda name, source: self.classes.append((name, source)))
+        # name -> java type of every definition seen so far
+        self.fields = OrderedDict()
+        # assignments replayed at the start of each new class
+        self.definitions = []
+        self.class_count = 0
+        self.closed = False
+        self._start_class()
+
+    def _start_class(self):
+        self.class_count += 1
+        self.replay = list(self.definitions)
+        self.methods = []
+        self.statements = []
+        self.method_bytes = 0
+        self.class_bytes = sum(len(s) for s in self.replay)
+
+    def current_class_name(self):
+        return '%sPart%d' % (self.class_name, self.class_count)
+
+    def add_definition(self, source, java_type=None):
+        '''Adds a python definition like "tbl = r.table('foo')"'''
+        node = ast.parse(source, mode='exec').body[0]
+        if type(node) != ast.Assign or len(node.targets) != 1:
+            raise RuntimeError("We only support assigning to one variable")
+        add_is_reql_flags(node, self.reql_vars)
+        self.add_java_definition(
+            *convert_definition(node, self.reql_vars, java_type))
+
+    def add_java_definition(self, name, java_type, value):
+        statement = self.DEFINITION_TEMPLATE.format(
+            indent=INDENT, name=name, type=java_type, value=value)
+        self.fields[name] = java_type
+        self.add_statement(statement)
+        self.definitions.append(statement)
+
+    def add_test(self, source, expected=None, comment=None):
+        '''Adds a python test query and (optionally) the python
+        expression for its expected result'''
+        node = ast.parse(source, mode='eval').body
+        add_is_reql_flags(node, self.reql_vars)
+        query = java_converter.Visitor(self.reql_vars).convert(node)
+        if expected is not None:
+            expected_node = ast.parse(expected, mode='eval').body
+            add_is_reql_flags(expected_node)
+            expected = java_converter.Visitor().convert(expected_node)
+        self.add_java_test(query, expected, source if comment is None
+                           else comment)
+
+    def add_java_test(self, query, expected=None, comment=''):
+        template = (self.UNCHECKED_TEST_TEMPLATE if expected is None
+                    else self.TEST_TEMPLATE)
+        self.add_statement(template.format(
+            indent=INDENT,
+            comment=one_line(comment),
+            query=query,
+            expected=expected,
+        ))
+
+    def add_statement(self, statement):
+        if self.closed:
+            raise RuntimeError("Emitter is already closed")
+        size = len(statement)
+        if size > self.max_method_bytes:
+            logger.warning("Statement of %d bytes is over the method "
+                           "budget, giving it a method of its own", size)
+        if self.statements and \
+           self.method_bytes + size > self.max_method_bytes:
+            self._finish_method()
+        if self.methods and \
+           self.class_bytes + self.method_bytes + size > \
+           self.max_class_bytes:
+            self._finish_class()
+        self.statements.append(statement)
+        self.method_bytes += size
+
+    def _finish_method(self):
+        if self.statements:
+            self.methods.append(self.statements)
+            self.class_bytes += self.method_bytes
+        self.statements = []
+        self.method_bytes = 0
+
+    def _finish_class(self):
+        self._finish_method()
+        if self.methods:
+            self.on_class(self.current_class_name(), self._render_class())
+        self._start_class()
+
+    def close(self):
+        '''Flushes the last class. Returns the collected classes'''
+        if not self.closed:
+            self._finish_class()
+            self.closed = True
+        return self.classes
+
+    def _chunk(self, statements):
+        '''Splits statements into lists under the method budget'''
+        chunk, size = [], 0
+        for statement in statements:
+            if chunk and size + len(statement) > self.max_method_bytes:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(statement)
+            size += len(statement)
+        if chunk:
+            yield chunk
+
+    def _render_class(self):
+        lines = []
+        if self.header:
+            lines.append('// %s\n' % one_line(self.header))
+        if self.package:
+            lines.append('package %s;\n\n' % self.package)
+        imports = self.imports
+        if not self.base_class:
+            imports = tuple(imports) + STANDALONE_IMPORTS
+        for imp in imports:
+            lines.append('import %s;\n' % imp)
+        lines.append('\n@FixMethodOrder(MethodSorters.NAME_ASCENDING)\n')
+        lines.append('public class %s' % self.current_class_name())
+        if self.base_class:
+            lines.append(' extends %s' % self.base_class)
+        lines.append(' {\n')
+        if not self.base_class:
+            lines.append(STANDALONE_MEMBERS)
+        if self.fields and not self.base_class:
+            lines.append('\n')
+        for name, java_type in self.fields.items():
+            lines.append('    static %s %s;\n' % (java_type, name))
+        if self.replay:
+            replay_chunks = list(self._chunk(self.replay))
+            lines.append('\n    @BeforeClass\n'
+                         '    public static void replayDefinitions() {\n')
+            for i in range(len(replay_chunks)):
+                lines.append('%sreplayDefinitions%d();\n' % (INDENT, i + 1))
+            lines.append('    }\n')
+            for i, chunk in enumerate(replay_chunks):
+                lines.append('\n    private static void '
+                             'replayDefinitions%d() {\n' % (i + 1))
+                lines.extend(chunk)
+                lines.append('    }\n')
+        for i, statements in enumerate(self.methods):
+            lines.append('\n    @Test\n'
+                         '    public void test%05d() throws Exception {\n'
+                         % (i + 1))
+            lines.extend(statements)
+            lines.append('    }\n')
+        lines.append('}\n')
+        return ''.join(lines)
+
+
+def write_classes(classes, out_dir):
+    '''Writes (class_name, source) pairs to out_dir/ClassName.java'''
+    paths = []
+    for name, source in classes:
+        path = os.path.join(out_dir, name + '.java')
+        with open(path, 'w') as f:
+            f.write(source)
+        paths.append(path)
+    return paths
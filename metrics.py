@@ -0,0 +1,234 @@
+'''Counters and latency histograms for the transpiler, dumped in the
+Prometheus text exposition format.
+
+Metrics are off by default. Instrumented code checks `metrics.enabled`
+before doing anything else, so when they're off an instrumented call
+costs one attribute lookup and no clock reads:
+
+    if metrics.enabled:
+        metrics.TRANSPILES.inc(lang, 'success')
+
+Turn them on with `metrics.enable()` (or `--metrics PATH` on the
+command line tools) and write them out with `metrics.dump(out)`, or
+`metrics.write(path)` where path "-" means stdout. Updates take a lock,
+so the threaded batch functions can share the registry.
+'''
+
+from __future__ import print_function
+
+import sys
+import threading
+from collections import OrderedDict
+
+enabled = False
+
+# Seconds. Snippets usually take tens of microseconds, big literals and
+# deep nesting go up to seconds
+DEFAULT_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1,
+                   0.5, 1.0, 5.0)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = registry.lock
+        # label values -> value
+        self.values = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        self.values.clear()
+
+    def check(self, values):
+        if len(values) != len(self.labels):
+            raise ValueError("%s takes labels %s" % (
+                self.name, ', '.join(self.labels) or 'none'))
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name,
+                                  self.help_text.replace('\n', ' ')),
+                '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def clear(self):
+        super(Counter, self).clear()
+        if not self.labels:
+            # a counter without labels has one value, which reads 0
+            # before the first inc()
+            self.values[()] = 0
+
+    def inc(self, *values, **kwargs):
+        '''Adds `amount` (default 1) for the given label values'''
+        amount = kwargs.pop('amount', 1)
+        with self.lock:
+            try:
+                self.values[values] += amount
+            except KeyError:
+                self.check(values)
+                self.values[values] = amount
+
+    def lines(self):
+        lines = self.header()
+        for values, total in self.values.items():
+            lines.append('%s%s %s' % (
+                self.name, format_labels(self.labels, values),
+                format_value(total)))
+        return lines
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, amount, *values):
+        with self.lock:
+            state = self.values.get(values)
+            if state is None:
+                self.check(values)
+                # per bucket counts (not cumulative), sum, count
+                state = self.values[values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            state[1] += amount
+            state[2] += 1
+
+    def lines(self):
+        lines = self.header()
+        for values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name, format_labels(
+                        self.labels, values, [('le', format_value(bound))]),
+                    cumulative))
+            labels = format_labels(self.labels, values)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.add(Counter(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(self, name, help_text, labels, buckets))
+
+    def reset(self):
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.clear()
+
+    def exposition(self):
+        '''The Prometheus text format of every metric'''
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PARSES = REGISTRY.counter(
+    'reql_parse_total', 'Snippets parsed, by outcome (success, error)',
+    ['outcome'])
+TRANSPILES = REGISTRY.counter(
+    'reql_transpile_total', 'Snippets converted per target language, by '
+    'outcome (success; skip when the precheck rules the language out, '
+    'like r.row in java; error)', ['lang', 'outcome'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'reql_stage_seconds', 'Time spent per snippet in each stage (parse, '
+    'transpile, fastpath), per target language', ['stage', 'lang'])
+INPUT_BYTES = REGISTRY.counter(
+    'reql_input_bytes_total', 'Bytes of python snippets parsed')
+OUTPUT_BYTES = REGISTRY.counter(
+    'reql_output_bytes_total', 'Bytes of converted code per target '
+    'language', ['lang'])
+CORPUS_TESTS = REGISTRY.counter(
+    'reql_corpus_tests_total', 'Polyglot tests seen by the corpus runners')
+REDUCER_SECONDS = REGISTRY.histogram(
+    'reql_reducer_seconds', 'Time spent per test in each corpus reducer',
+    ['reducer'])
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def dump(out=None, registry=REGISTRY):
+    (out or sys.stdout).write(registry.exposition())
+
+
+def write(path, registry=REGISTRY):
+    '''Writes the metrics to `path`, or stdout for "-"'''
+    if path == '-':
+        dump(sys.stdout, registry)
+        return
+    with open(path, 'w') as f:
+        dump(f, registry)
+
+
+def utf8_size(text):
+    return len(text.encode('utf-8'))
@@ -1,23 +1,87 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import argparse
+import copy
+import pickle
+import pprint
 import sys
-import ast
 import os
-from collections import Counter
-
-import conversion_utils
-import ruby_converter
-import java_converter
-import js_converter
+import time
+from collections import Counter, OrderedDict
+from functools import reduce
+
+import batch
+import budgets
+import capabilities
+import fastpath
+import metrics
+import reports
+import sampling
+import scheduling
+import sharding
+import snippet_ir
+import triage
 from parsePolyglot import parse_yaml
 
 DEFAULT_TEST_DIR = '../../test/rql_test/src'
 
 
 def main():
-    if len(sys.argv) > 1:
-        snippet = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        description='Transpiles a python ReQL snippet (from the command '
+        'line or stdin), or runs the corpus reducers with --run')
+    parser.add_argument('snippet', nargs='?')
+    parser.add_argument('--run', metavar='NAMES',
+                        help='comma separated reducers to run over the '
+                        'corpus, or "all". One of: ' + ', '.join(REDUCERS))
+    parser.add_argument('--shard', metavar='I/N', type=sharding.parse_shard,
+                        help='only run shard I of N, writing a partial '
+                        'result file to --out')
+    parser.add_argument('--balance', action='store_true',
+                        help='with --shard, split whole files by '
+                        'predicted transpile time instead of tests by '
+                        'hash. Every shard must use it')
+    parser.add_argument('--cost-model', metavar='PATH',
+                        help='cost model for --balance, from '
+                        '`./bench.py calibrate`')
+    parser.add_argument('--merge', nargs='+', metavar='PARTIAL',
+                        help='combine the partial files of every shard')
+    parser.add_argument('--sample', metavar='FRACTION', type=float,
+                        help='only run a seeded sample of the tests of '
+                        'every file and print estimated rates')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='picks the --sample (default: %(default)s)')
+    parser.add_argument('--out', help='write the (pickled) results here')
+    parser.add_argument('--test-dir', default=DEFAULT_TEST_DIR)
+    parser.add_argument('--ir-cache', action='store_true',
+                        help='keep the parsed snippets of every polyglot '
+                        'file in a .ir file next to it, and reuse them on '
+                        'the next run (see snippet_ir.py)')
+    parser.add_argument('--intern', action='store_true',
+                        help='share identical subtrees between the parsed '
+                        'snippets of the run, to use less memory')
+    parser.add_argument('--wire', action='store_true',
+                        help='also print the ReQL wire format JSON of '
+                        'the snippet')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write prometheus metrics of the run here '
+                        '("-" for stdout)')
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    try:
+        run_main(args)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+
+
+def run_main(args):
+    if args.run or args.merge:
+        return run_corpus(args)
+    if args.snippet is not None:
+        snippet = args.snippet
     else:
         snippet = sys.stdin.read()
     parsed_snippet = parse_snippet(snippet, exit_on_fail=True)
@@ -39,15 +103,37 @@ def main():
     java_snippet = transpile(parsed_snippet, 'java')
     print(" - ", java_snippet)
 
+    if args.wire:
+        print()
+        print("ReQL JSON:")
+        print(" - ", transpile(parsed_snippet, 'json'))
+
 
-def transpile(snippet, lang):
+def transpile(snippet, lang, budget=None):
+    if not metrics.enabled:
+        return _transpile(snippet, lang, budget)
+    start = time.perf_counter()
     try:
-        if lang == 'rb':
-            return transpile_snippet(snippet, ruby_converter)
-        elif lang == 'js':
-            return transpile_snippet(snippet, js_converter)
-        elif lang == 'java':
-            return transpile_snippet(snippet, java_converter)
+        output = _transpile(snippet, lang, budget)
+    finally:
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                      'transpile', lang)
+    if capabilities.classify(snippet, [lang])[lang] is not None:
+        # batch.transpile_one's precheck skips these, whatever the
+        # converter makes of them
+        metrics.TRANSPILES.inc(lang, 'skip')
+    else:
+        batch.count_transpile(lang, output)
+    return output
+
+
+def _transpile(snippet, lang, budget=None):
+    try:
+        if budget is not None:
+            return batch.transpile_tree(snippet, lang, tracker=budget.track())
+        return transpile_snippet(snippet, batch.LANGUAGES[lang])
+    except budgets.BudgetExceeded:
+        raise
     except Exception as e:
         print(e)
         return None
@@ -57,11 +143,18 @@ def transpile_snippet(parsed_snippet, converter):
     return converter.Visitor().convert(parsed_snippet)
 
 
-def parse_snippet(snippet, exit_on_fail=False):
+def parse_snippet(snippet, exit_on_fail=False, budget=None, parser=None):
+    '''Parses and flags a snippet, printing the error and returning
+    None if it isn't valid. Going over `budget` is not a syntax error,
+    so budgets.BudgetExceeded is raised to the caller. `parser` replaces
+    batch.parse, like a snippet_ir.TreeCache's parser for the file'''
     try:
-        parsed = ast.parse(snippet, mode='eval').body
-        conversion_utils.add_is_reql_flags(parsed)
-        return parsed
+        if parser is not None and budget is None:
+            return parser(snippet)
+        return batch.parse(snippet,
+                           tracker=None if budget is None else budget.track())
+    except budgets.BudgetExceeded:
+        raise
     except Exception as e:
         print(e)
         if exit_on_fail:
@@ -70,26 +163,106 @@ def parse_snippet(snippet, exit_on_fail=False):
             return None
 
 
-def all_yaml_tests(test_dir=DEFAULT_TEST_DIR):
+def all_yaml_paths(test_dir=DEFAULT_TEST_DIR):
     '''Generator for the full paths of all non-excluded yaml tests'''
     for root, dirs, files in os.walk(test_dir):
-        for f in files:
+        dirs.sort()
+        for f in sorted(files):
             path = os.path.relpath(os.path.join(root, f), os.getcwd())
             if os.path.splitext(path)[1] == '.yaml':
-                yield parse_yaml(open(path).read())
+                yield path
 
 
-def tests_in_file(test_file):
-    for test in test_file['tests']:
+def all_yaml_tests(test_dir=DEFAULT_TEST_DIR):
+    '''Generator for the parsed contents of all yaml tests'''
+    for path in all_yaml_paths(test_dir):
+        with open(path) as f:
+            yield parse_yaml(f.read())
+
+
+class CorpusTest(dict):
+    '''A polyglot test that remembers its parsed and transpiled
+    snippets, so every reducer in a pass shares the same work.
+    `position` is (number of the file in the walk, index in the file),
+    the order an unsharded run sees the tests in'''
+
+    __slots__ = ('_parsed', '_transpiled', 'position', 'name', 'parser')
+
+    def __init__(self, *args, **kwargs):
+        super(CorpusTest, self).__init__(*args, **kwargs)
+        self._parsed = {}
+        self._transpiled = {}
+        self.position = None
+        # the file's path relative to the test directory
+        self.name = None
+        # parse_snippet's `parser`, when the trees come from a TreeCache
+        self.parser = None
+
+    def parsed(self, key):
+        '''parse_snippet(self[key]), parsed at most once'''
+        if key not in self._parsed:
+            self._parsed[key] = parse_snippet(self[key], parser=self.parser)
+        return self._parsed[key]
+
+    def transpiled(self, key, lang):
+        '''transpile(self.parsed(key), lang), done at most once'''
+        if (key, lang) not in self._transpiled:
+            parsed = self.parsed(key)
+            self._transpiled[key, lang] = (
+                None if parsed is None else transpile(parsed, lang))
+        return self._transpiled[key, lang]
+
+
+def tests_in_file(test_file, file_number=None, name=None, shard=None,
+                  sampler=None):
+    '''With `shard` (an (I, N) pair) only yields the tests of shard I,
+    with a sampling.Sampler only the ones it picks. `name` is the
+    file's path relative to the test directory'''
+    entries = test_file['tests']
+    chosen = None
+    if sampler is not None:
+        chosen = sampler.choose(name, len(entries))
+    for index, entry in enumerate(entries):
+        if shard is not None and \
+           sharding.shard_of(name, index, shard[1]) != shard[0]:
+            continue
+        if chosen is not None and index not in chosen:
+            continue
+        test = CorpusTest(entry)
+        test.position = (file_number, index)
         yield test
 
 
-def every_test(test_dir=DEFAULT_TEST_DIR):
-    for testfile in all_yaml_tests(test_dir):
-        for test in tests_in_file(testfile):
+def every_test(test_dir=DEFAULT_TEST_DIR, shard=None, sampler=None,
+               paths=None, trees=None):
+    '''The tests of every polyglot file, or only of the files in
+    `paths`. Positions are numbered over every file either way. With a
+    snippet_ir.TreeCache as `trees`, the tests parse through it'''
+    for file_number, path in enumerate(all_yaml_paths(test_dir)):
+        if paths is not None and path not in paths:
+            continue
+        with open(path) as f:
+            testfile = parse_yaml(f.read())
+        name = os.path.relpath(path, test_dir)
+        for test in tests_in_file(testfile, file_number, name, shard,
+                                  sampler):
+            test.name = name
+            if trees is not None:
+                test.parser = trees.parser(path)
             yield test
 
 
+def every_snippet(test_dir=DEFAULT_TEST_DIR, keys=('cd', 'py')):
+    '''The python snippets of every test'''
+    for test in every_test(test_dir):
+        for key in keys:
+            value = test.get(key)
+            if value is None:
+                continue
+            for snippet in value if isinstance(value, list) else [value]:
+                yield snippet
+
+
 def add_signature(counter, test):
     counter[frozenset(test.keys())] += 1
     return counter
@@ -104,13 +277,23 @@ def equal_or_contained_in(first, second):
         return False
 
 
+def new_results():
+    return {
+        'correct': [],
+        'incorrect': [],
+        'syntax_error': [],
+        'failed_transpile': [],
+        'r.row': [],
+    }
+
+
 def check_ruby(results, test):
     if 'rb' in test and 'cd' in test:
-        parsed = parse_snippet(test['cd'])
+        parsed = test.parsed('cd')
         if parsed is None:
             results['syntax_error'].append(test['cd'])
             return results
-        transpiled = transpile(parsed, 'rb')
+        transpiled = test.transpiled('cd', 'rb')
         if transpiled is None:
             results['failed_transpile'].append(test['cd'])
             return results
@@ -135,16 +318,48 @@ def check_ruby(results, test):
     return results
 
 
+def language_checker(lang):
+    '''Makes a reducer like check_ruby that compares the transpiled
+    generic test to the hand-written one for `lang`'''
+    def check(results, test):
+        if lang in test and 'cd' in test:
+            if test.parsed('cd') is None:
+                results['syntax_error'].append(test['cd'])
+                return results
+            transpiled = test.transpiled('cd', lang)
+            if transpiled is None:
+                results['failed_transpile'].append(test['cd'])
+                return results
+            entry = {
+                'generic': test['cd'],
+                'transpiled': transpiled,
+                'custom': test[lang],
+            }
+            if equal_or_contained_in(transpiled, test[lang]):
+                results['correct'].append(entry)
+            elif 'r.row' in transpiled:
+                results['r.row'].append(entry)
+            else:
+                results['incorrect'].append(entry)
+        return results
+    check.__name__ = 'check_' + lang
+    return check
+
+
+check_js = language_checker('js')
+check_java = language_checker('java')
+
+
 def check_if_python_works(results, test):
     if 'rb' in test and 'py' in test and 'cd' not in test:
-        parsed = parse_snippet(test['py'])
+        parsed = test.parsed('py')
         if parsed is None:
             results['syntax_error'].append({
                 'python': test['py'],
                 'ruby': test['rb'],
             })
             return results
-        transpiled = transpile(parsed, 'rb')
+        transpiled = test.transpiled('py', 'rb')
         if transpiled is None:
             results['failed_transpile'].append({
                 'python': test['py'],
@@ -171,28 +386,301 @@ def check_if_python_works(results, test):
     return results
 
 
+def check_capabilities(counter, test):
+    '''Counts (language, reason) for every generic test, with reason
+    "translatable" when the capability pre-check lets it through'''
+    if 'cd' in test:
+        parsed = test.parsed('cd')
+        if parsed is None:
+            return counter
+        for lang, reason in capabilities.classify(parsed).items():
+            counter[lang, reason or 'translatable'] += 1
+    return counter
+
+
+def new_fastpath_results():
+    return {'fast': 0, 'fallback': 0, 'mismatches': []}
+
+
+def check_fastpath(results, test):
+    '''Differential check: every generic test that fastpath.py
+    handles must come out exactly like the full path'''
+    if 'cd' in test:
+        snippets = test['cd'] if isinstance(test['cd'], list) \
+            else [test['cd']]
+        report = fastpath.differential(snippets)
+        results['fast'] += report['fast']
+        results['fallback'] += report['fallback']
+        results['mismatches'].extend(report['mismatches'])
+    return results
+
+
+# name -> (reducer, factory for its initial value)
+REDUCERS = OrderedDict([
+    ('key_signatures', (add_signature, Counter)),
+    ('bad_ruby_transpiles', (check_ruby, new_results)),
+    ('bad_js_transpiles', (check_js, new_results)),
+    ('bad_java_transpiles', (check_java, new_results)),
+    ('python_replacements', (check_if_python_works, new_results)),
+    ('capabilities', (check_capabilities, Counter)),
+    ('fastpath', (check_fastpath, new_fastpath_results)),
+])
+
+
+class Aggregation(object):
+    '''Runs several reducers over a single pass of the corpus. Every
+    test is parsed and transpiled at most once per language no matter
+    how many reducers look at it'''
+
+    def __init__(self):
+        self.reducers = OrderedDict()
+
+    def register(self, name, func, initial):
+        self.reducers[name] = (func, initial)
+        return self
+
+    def register_known(self, *names):
+        '''Registers reducers from REDUCERS, or all of them'''
+        for name in names or REDUCERS:
+            func, factory = REDUCERS[name]
+            self.register(name, func, factory())
+        return self
+
+    def run(self, tests=None):
+        results = OrderedDict(
+            (name, initial) for name, (_, initial) in self.reducers.items())
+        reducers = [(name, func)
+                    for name, (func, _) in self.reducers.items()]
+        for test in every_test() if tests is None else tests:
+            if metrics.enabled:
+                self.run_counted(results, reducers, test)
+                continue
+            for name, func in reducers:
+                results[name] = func(results[name], test)
+        return results
+
+    def run_counted(self, results, reducers, test):
+        '''One test of run(), with metrics'''
+        metrics.CORPUS_TESTS.inc()
+        for name, func in reducers:
+            start = time.perf_counter()
+            results[name] = func(results[name], test)
+            metrics.REDUCER_SECONDS.observe(time.perf_counter() - start,
+                                            name)
+
+    def run_shard(self, out, shard, test_dir=DEFAULT_TEST_DIR, model=None,
+                  trees=None):
+        '''Runs shard (I, N) of the corpus, writing what each reducer
+        makes of each test to the binary file `out` for merge(). Tests
+        are split by hash, or with a scheduling.CostModel as `model`
+        whole files are split by predicted cost'''
+        writer = sharding.PartialWriter(
+            out, shard, self.reducers,
+            None if model is None else model.fingerprint())
+        count = 0
+        if model is None:
+            tests = every_test(test_dir, shard, trees=trees)
+        else:
+            paths = scheduling.shard_paths(
+                all_yaml_paths(test_dir), shard[1], model)[shard[0] - 1]
+            tests = every_test(test_dir, paths=set(paths), trees=trees)
+        for test in tests:
+            count += 1
+            if metrics.enabled:
+                metrics.CORPUS_TESTS.inc()
+            for name, (func, initial) in self.reducers.items():
+                delta = func(copy.deepcopy(initial), test)
+                if not sharding.is_empty(delta):
+                    writer.write(test.position, name, delta)
+        return count
+
+    def run_sample(self, sampler, test_dir=DEFAULT_TEST_DIR,
+                   confidence=sampling.DEFAULT_CONFIDENCE, trees=None):
+        '''Runs the reducers over the tests `sampler` picks from every
+        file. Only works for reducers of new_results dicts, which put
+        each test in (at most) one category. Returns name ->
+        sampling.Estimates'''
+        # name -> file name -> outcome of every sampled test
+        outcomes = OrderedDict((name, OrderedDict())
+                               for name in self.reducers)
+        for test in every_test(test_dir, sampler=sampler, trees=trees):
+            if metrics.enabled:
+                metrics.CORPUS_TESTS.inc()
+            for name, (func, initial) in self.reducers.items():
+                delta = func(copy.deepcopy(initial), test)
+                outcomes[name].setdefault(test.name, []).append(
+                    outcome_of(delta))
+        categories = list(new_results())
+        return OrderedDict(
+            (name, sampling.estimate(sampler.strata, by_file, categories,
+                                     confidence))
+            for name, by_file in outcomes.items())
+
+    def merge(self, partials):
+        '''Combines the partial files (open in binary mode) of all
+        shards into what run() would have returned'''
+        return sharding.merge(partials, OrderedDict(
+            (name, copy.deepcopy(initial))
+            for name, (_, initial) in self.reducers.items()))
+
+
+def outcome_of(delta):
+    '''The category a results reducer put one test in, or None'''
+    for category, entries in delta.items():
+        if entries:
+            return category
+    return None
+
+
+def run_corpus(args):
+    '''The --run / --merge part of main()'''
+    names = [] if args.run in (None, 'all') else args.run.split(',')
+    if args.sample is not None:
+        if args.shard or args.merge or args.balance:
+            sys.exit("--sample can't be combined with --shard, --merge "
+                     "or --balance")
+        return run_sample(args, names, tree_cache(args))
+    if args.balance and not args.shard:
+        sys.exit("--balance only works with --shard")
+    trees = tree_cache(args)
+    aggregation = Aggregation().register_known(*names)
+    if args.merge:
+        partials = [open(path, 'rb') for path in args.merge]
+        try:
+            results = aggregation.merge(partials)
+        finally:
+            for f in partials:
+                f.close()
+    elif args.shard:
+        if not args.out:
+            sys.exit("--shard needs --out for the partial result file")
+        model = None
+        if args.balance:
+            model = scheduling.CostModel.load(args.cost_model) \
+                if args.cost_model else scheduling.CostModel()
+        with open(args.out, 'wb') as out:
+            count = aggregation.run_shard(out, args.shard, args.test_dir,
+                                          model, trees)
+        save_trees(trees)
+        print("Shard %d/%d: %d tests written to %s" % (
+            args.shard + (count, args.out)))
+        return
+    else:
+        results = aggregation.run(every_test(args.test_dir, trees=trees))
+        save_trees(trees)
+    if args.out:
+        with open(args.out, 'wb') as out:
+            pickle.dump(results, out, pickle.HIGHEST_PROTOCOL)
+    else:
+        pprint.pprint(dict(results))
+
+
+def tree_cache(args):
+    '''The snippet_ir.TreeCache --ir-cache and --intern ask for, or
+    None'''
+    if not (args.ir_cache or args.intern):
+        return None
+    return snippet_ir.TreeCache(args.ir_cache, args.intern, batch.parse)
+
+
+def save_trees(trees):
+    # only after a complete run: saving prunes the entries not used
+    if trees is not None:
+        trees.save()
+
+
+def run_sample(args, names, trees=None):
+    '''The --run --sample part of main()'''
+    rate_reducers = [name for name, (_, factory) in REDUCERS.items()
+                     if factory is new_results]
+    names = names or rate_reducers
+    for name in names:
+        if name not in rate_reducers:
+            sys.exit("--sample only works with %s" % ', '.join(rate_reducers))
+    try:
+        sampler = sampling.Sampler(args.sample, args.seed)
+    except ValueError as e:
+        sys.exit(str(e))
+    estimates = Aggregation().register_known(*names).run_sample(
+        sampler, args.test_dir, trees=trees)
+    if trees is not None:
+        # a sample only uses some of the stored trees: keep the others
+        trees.save(prune=False)
+    if args.out:
+        with open(args.out, 'wb') as out:
+            pickle.dump(estimates, out, pickle.HIGHEST_PROTOCOL)
+    for name, estimate in estimates.items():
+        print(estimate.format(name))
+
+
+def stream_report(path, *names, **kwargs):
+    '''Runs the result reducers (all of them by default) in one pass,
+    writing every classified test to a JSONL report at `path` as it is
+    produced. Returns StreamingResults holding only counts and the
+    first `max_examples` entries of each category'''
+    max_examples = kwargs.pop('max_examples', reports.DEFAULT_MAX_EXAMPLES)
+    tests = kwargs.pop('tests', None)
+    names = names or [name for name, (_, factory) in REDUCERS.items()
+                      if factory is new_results]
+    with open(path, 'w') as out:
+        writer = reports.JsonlWriter(out)
+        aggregation = Aggregation()
+        for name in names:
+            func, factory = REDUCERS[name]
+            aggregation.register(name, func, reports.StreamingResults(
+                name, writer, factory(), max_examples))
+        return aggregation.run(tests)
+
+
 def count_key_signatures():
     return reduce_tests(add_signature, Counter())
 
 
 def count_bad_ruby_transpiles():
-    return reduce_tests(check_ruby, {
-        'correct': [],
-        'incorrect': [],
-        'syntax_error': [],
-        'failed_transpile': [],
-        'r.row': [],
-    })
+    return reduce_tests(check_ruby, new_results())
+
+
+def estimate_bad_ruby_transpiles(fraction=sampling.DEFAULT_FRACTION, seed=0):
+    '''count_bad_ruby_transpiles over a sample, as rates with
+    confidence intervals'''
+    sampler = sampling.Sampler(fraction, seed)
+    aggregation = Aggregation().register_known('bad_ruby_transpiles')
+    return aggregation.run_sample(sampler)['bad_ruby_transpiles']
+
+
+def count_bad_js_transpiles():
+    return reduce_tests(check_js, new_results())
+
+
+def count_bad_java_transpiles():
+    return reduce_tests(check_java, new_results())
 
 
 def count_python_replacements():
-    return reduce_tests(check_if_python_works, {
-        'correct': [],
-        'incorrect': [],
-        'syntax_error': [],
-        'failed_transpile': [],
-        'r.row': [],
-    })
+    return reduce_tests(check_if_python_works, new_results())
+
+
+def count_unsupported():
+    return reduce_tests(check_capabilities, Counter())
+
+
+def count_fastpath_mismatches():
+    return reduce_tests(check_fastpath, new_fastpath_results())
+
+
+def count_everything():
+    '''All of the above in one pass over the corpus'''
+    return Aggregation().register_known().run()
+
+
+def cluster_bad_ruby_transpiles(max_examples=3):
+    incorrect = count_bad_ruby_transpiles()['incorrect']
+    return triage.cluster_mismatches(incorrect, max_examples)
+
+
+def cluster_python_replacements(max_examples=3):
+    incorrect = count_python_replacements()['incorrect']
+    return triage.cluster_mismatches(incorrect, max_examples)
 
 
 def reduce_tests(func, initial):
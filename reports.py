@@ -0,0 +1,135 @@
+'''Streaming reports for corpus runs.
+
+The corpus reducers in multireql.py append one entry per classified
+test to `results[category]`. StreamingResults can stand in for the
+results dict: every appended entry is written to a JSONL report
+straight away and only the counts plus the first few examples of each
+category stay in memory.
+'''
+
+import json
+import sys
+
+# Field names used by the reducers in multireql.py, mapped to the
+# normalized record fields
+SOURCE_KEYS = ('generic', 'python')
+TRANSPILED_KEYS = ('transpiled', 'transpiled_ruby')
+EXPECTED_KEYS = ('custom', 'handcrafted_ruby', 'ruby')
+
+DEFAULT_MAX_EXAMPLES = 10
+
+
+def pick(entry, keys):
+    for key in keys:
+        if key in entry:
+            return entry[key]
+    return None
+
+
+class Record(object):
+    '''One classified test'''
+
+    __slots__ = ('runner', 'category', 'source', 'transpiled', 'expected')
+
+    def __init__(self, runner, category, source,
+                 transpiled=None, expected=None):
+        self.runner = runner
+        self.category = category
+        self.source = source
+        self.transpiled = transpiled
+        self.expected = expected
+
+    @classmethod
+    def from_entry(cls, runner, category, entry):
+        '''Reducers append either a snippet or a dict of snippets'''
+        if not isinstance(entry, dict):
+            return cls(runner, category, entry)
+        return cls(runner, category,
+                   pick(entry, SOURCE_KEYS),
+                   pick(entry, TRANSPILED_KEYS),
+                   pick(entry, EXPECTED_KEYS))
+
+    def as_dict(self):
+        return {
+            'runner': self.runner,
+            'category': self.category,
+            'source': self.source,
+            'transpiled': self.transpiled,
+            'expected': self.expected,
+        }
+
+    def __repr__(self):
+        return 'Record(%r, %r, %r)' % (self.runner, self.category,
+                                       self.source)
+
+
+class JsonlWriter(object):
+    '''Writes one JSON object per line'''
+
+    def __init__(self, out):
+        self.out = out
+        self.written = 0
+
+    def write(self, record):
+        self.out.write(json.dumps(record.as_dict(), sort_keys=True))
+        self.out.write('\n')
+        self.written += 1
+
+
+class CategorySink(object):
+    '''Takes the place of a results list: counts the entries, streams
+    them to the writer and keeps a bounded sample'''
+
+    __slots__ = ('results', 'category', 'count', 'examples')
+
+    def __init__(self, results, category):
+        self.results = results
+        self.category = sys.intern(category)
+        self.count = 0
+        self.examples = []
+
+    def append(self, entry):
+        record = Record.from_entry(
+            self.results.runner, self.category, entry)
+        self.count += 1
+        if len(self.examples) < self.results.max_examples:
+            self.examples.append(record)
+        if self.results.writer is not None:
+            self.results.writer.write(record)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.examples)
+
+
+class StreamingResults(object):
+    '''Drop-in replacement for the results dict of a reducer'''
+
+    def __init__(self, runner, writer=None, categories=(),
+                 max_examples=DEFAULT_MAX_EXAMPLES):
+        self.runner = sys.intern(runner)
+        self.writer = writer
+        self.max_examples = max_examples
+        self.sinks = {}
+        for category in categories:
+            self[category]
+
+    def __getitem__(self, category):
+        sink = self.sinks.get(category)
+        if sink is None:
+            sink = self.sinks[category] = CategorySink(self, category)
+        return sink
+
+    def counts(self):
+        return {category: sink.count
+                for category, sink in self.sinks.items()}
+
+    def summary(self):
+        return {
+            'runner': self.runner,
+            'counts': self.counts(),
+            'examples': {category: [r.as_dict() for r in sink.examples]
+                         for category, sink in self.sinks.items()},
+        }
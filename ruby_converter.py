@@ -4,6 +4,8 @@ import re
 import ast
 import logging
 
+from conversion_utils import bulk_dict, bulk_literals, subscript_index
+
 try:
     from io import StringIO
 except ImportError:
@@ -15,15 +17,29 @@ logger = logging.getLogger('ruby_converter')
 SYMBOL_REGEX = re.compile(r'[A-Za-z@$_]+[_A-Za-z0-9]*[!_=?A-Za-z0-9]?')
 
 
+def literal_texts(kind, values):
+    '''Source for each (value, negative) of a
+    conversion_utils.bulk_literals run, the same as visiting them'''
+    if kind == 'number':
+        return [("-" if negative else "") + repr(n) for n, negative in values]
+    elif kind == 'str':
+        return [repr(s) for s, _ in values]
+    return ["true" if b else "false" for b, _ in values]
+
+
 class Visitor(ast.NodeVisitor):
     '''Converts python ast nodes into a ruby string'''
 
     def __init__(self,
                  reql_vars=frozenset("r"),
                  out=None):
-        self.out = StringIO() if out is None else out
         self.reql_vars = reql_vars
         super(Visitor, self).__init__()
+        self.reset(out)
+
+    def reset(self, out=None):
+        '''Starts a fresh output buffer so the visitor can be reused'''
+        self.out = StringIO() if out is None else out
         self.write = self.out.write
 
     def skip(self, message, *args, **kwargs):
@@ -150,6 +166,13 @@ class Visitor(ast.NodeVisitor):
 
     def visit_Dict(self, node):
         self.write("{")
+        kind, keys, values = bulk_dict(node)
+        if kind is not None:
+            self.write(", ".join([
+                repr(key) + " => " + text
+                for key, text in zip(keys, literal_texts(kind, values))]))
+            self.write("}")
+            return
         first = True
         for k, v in zip(node.keys, node.values):
             if first:
@@ -163,7 +186,11 @@ class Visitor(ast.NodeVisitor):
 
     def visit_List(self, node):
         self.write("[")
-        self.join(", ", node.elts)
+        kind, values = bulk_literals(node.elts)
+        if kind is None:
+            self.join(", ", node.elts)
+        else:
+            self.write(", ".join(literal_texts(kind, values)))
         self.write("]")
 
     def visit_Tuple(self, node):
@@ -178,9 +205,10 @@ class Visitor(ast.NodeVisitor):
 
     def visit_Subscript(self, node):
         self.visit(node.value)
-        if type(node.slice) == ast.Index:
+        index = subscript_index(node.slice)
+        if index is not None:
             self.write("[")
-            self.visit(node.slice.value)
+            self.visit(index)
             self.write("]")
         elif type(node.slice) == ast.Slice:
             self.write("[(")
@@ -0,0 +1,186 @@
+'''Quick statistical corpus runs: run the reducers over a random sample
+of the tests and estimate what the full run would say, with confidence
+intervals.
+
+The sample is stratified by polyglot file. Every file contributes
+`fraction` of its tests (at least `min_per_file`, or all of them if it
+has fewer), so a big file can't crowd the small ones out and each
+file's quirks are represented. Which tests a file contributes only
+depends on the seed and the file's name, so the same seed picks the
+same tests after unrelated files change.
+
+A rate like "incorrect ruby transpiles" is the share of the tests a
+reducer classifies (the ones with both a `cd` and an `rb` snippet, for
+check_ruby) that end up in a category. It is estimated with the
+stratified ratio estimator, weighting each file by its size over its
+sample size, and its standard error comes from the usual linearization
+with a finite population correction (a file sampled in full adds no
+error).
+
+The interval is a Wilson score interval on the effective sample size,
+rate * (1 - rate) / error ** 2, rather than rate +- z * error: that
+one collapses to zero width when no sampled test (or every one) is in
+the category, claiming certainty about exactly the rare failures worth
+looking for. When the sample has no variation to estimate the error
+from, the effective size is the number of classified sampled tests,
+with the same finite population correction. Those estimates are
+flagged in the output.
+'''
+
+import math
+import random
+from statistics import NormalDist
+
+DEFAULT_FRACTION = 0.1
+DEFAULT_MIN_PER_FILE = 2
+DEFAULT_CONFIDENCE = 0.95
+
+
+class Sampler(object):
+    '''Picks the tests of each file and remembers the size of every
+    stratum it sampled'''
+
+    def __init__(self, fraction=DEFAULT_FRACTION, seed=0,
+                 min_per_file=DEFAULT_MIN_PER_FILE):
+        if not 0 < fraction <= 1:
+            raise ValueError("The sampled fraction must be in (0, 1]")
+        self.fraction = fraction
+        self.seed = seed
+        self.min_per_file = min_per_file
+        # file name -> (tests in the file, tests sampled)
+        self.strata = {}
+
+    def choose(self, name, population):
+        '''The set of test indexes to run out of the `population`
+        tests of file `name`'''
+        size = max(self.min_per_file,
+                   int(math.ceil(self.fraction * population)))
+        size = min(size, population)
+        rng = random.Random('%s:%s' % (self.seed, name.replace('\\', '/')))
+        self.strata[name] = (population, size)
+        return set(rng.sample(range(population), size))
+
+
+class RateEstimate(object):
+    '''The estimated share of a category, with its confidence interval'''
+
+    __slots__ = ('category', 'rate', 'low', 'high', 'sampled', 'uniform')
+
+    def __init__(self, category, rate, low, high, sampled, uniform=False):
+        self.category = category
+        self.rate = rate
+        self.low = low
+        self.high = high
+        # how many sampled tests fell in the category
+        self.sampled = sampled
+        # True if none or all of the classified sampled tests did, so
+        # the interval only comes from the sample size
+        self.uniform = uniform
+
+    def __repr__(self):
+        return 'RateEstimate(%r, %.4f, %.4f, %.4f)' % (
+            self.category, self.rate, self.low, self.high)
+
+
+class Estimates(object):
+    '''What a sample says about one reducer. `classified` and
+    `population` estimate how many tests of the corpus the reducer
+    classifies, and how many tests there are'''
+
+    def __init__(self, rates, classified, sampled, classified_sampled,
+                 population, confidence):
+        self.rates = rates
+        self.classified = classified
+        self.sampled = sampled
+        self.classified_sampled = classified_sampled
+        self.population = population
+        self.confidence = confidence
+
+    def format(self, name):
+        lines = ['%s: %d of %d tests sampled, %d classified '
+                 '(~%.0f in the corpus), %d%% confidence' % (
+                     name, self.sampled, self.population,
+                     self.classified_sampled, self.classified,
+                     round(self.confidence * 100))]
+        for estimate in self.rates:
+            lines.append('  %-16s %6.2f%%  [%6.2f%%, %6.2f%%]  (%d sampled%s)'
+                         % (estimate.category, estimate.rate * 100,
+                            estimate.low * 100, estimate.high * 100,
+                            estimate.sampled,
+                            ', %s of the classified sampled tests' % (
+                                'none' if not estimate.sampled else 'all')
+                            if estimate.uniform else ''))
+        return '\n'.join(lines)
+
+
+def estimate(strata, outcomes, categories, confidence=DEFAULT_CONFIDENCE):
+    '''Estimates the rate of every category. `strata` is a
+    Sampler.strata, `outcomes` maps each sampled file name to the list
+    of outcomes of its sampled tests: a category, or None for a test
+    the reducer doesn't classify'''
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    population = sum(size for size, _ in strata.values())
+    sampled = sum(count for _, count in strata.values())
+    classified = 0.0
+    classified_sampled = 0
+    for name, results in outcomes.items():
+        size, count = strata[name]
+        hits = sum(1 for outcome in results if outcome is not None)
+        classified += size * hits / float(count)
+        classified_sampled += hits
+    rates = []
+    for category in categories:
+        hits = 0
+        total = 0.0
+        for name, results in outcomes.items():
+            size, count = strata[name]
+            in_category = sum(1 for outcome in results if outcome == category)
+            hits += in_category
+            total += size * in_category / float(count)
+        rate = total / classified if classified else 0.0
+        error = ratio_error(strata, outcomes, category, rate, classified)
+        uniform = hits in (0, classified_sampled)
+        if 0 < rate < 1 and error > 0:
+            size = rate * (1 - rate) / error ** 2
+        elif sampled < population:
+            size = classified_sampled / (1 - sampled / float(population))
+        else:
+            # the whole corpus was run: the rate is exact
+            size = None
+        low, high = wilson(rate, size, z)
+        rates.append(RateEstimate(category, rate, low, high, hits,
+                                  uniform and size is not None))
+    return Estimates(rates, classified, sampled, classified_sampled,
+                     population, confidence)
+
+
+def wilson(rate, size, z):
+    '''The Wilson score interval of a proportion over `size` trials,
+    (rate, rate) for size None'''
+    if size is None:
+        return rate, rate
+    if not size:
+        return 0.0, 1.0
+    spread = z * z / size
+    center = (rate + spread / 2) / (1 + spread)
+    half = z * math.sqrt(rate * (1 - rate) / size + spread / size / 4) / \
+        (1 + spread)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def ratio_error(strata, outcomes, category, rate, classified):
+    '''Standard error of a stratified ratio estimate'''
+    if not classified:
+        return 0.0
+    variance = 0.0
+    for name, results in outcomes.items():
+        size, count = strata[name]
+        if count < 2 or count == size:
+            continue
+        # residuals of (in the category) - rate * (classified)
+        residuals = [(outcome == category) - rate * (outcome is not None)
+                     for outcome in results]
+        mean = sum(residuals) / count
+        spread = sum((r - mean) ** 2 for r in residuals) / (count - 1)
+        variance += size ** 2 * (1 - count / float(size)) * spread / count
+    return math.sqrt(variance) / classified
@@ -0,0 +1,280 @@
+'''Spreading snippets over workers by how long they'll take, not by how
+many there are.
+
+Transpiling `r.expr(1)` and a multi-kilobyte nested query differ by
+orders of magnitude, so equal sized chunks leave one worker finishing
+long after the others. A CostModel predicts each snippet's transpile
+time from features that are much cheaper than parsing (source length,
+token count, bracket nesting depth and the size of its literals), as a
+linear combination whose coefficients `calibrate` fits to measured
+times by least squares. `lpt` then hands the snippets out longest
+first, each to the worker with the least work so far (Graham's
+longest-processing-time rule, never more than 4/3 of the best possible
+makespan).
+
+`transpile_scheduled` does that for a batch run on a thread pool and
+returns a ScheduleReport of predicted and measured per-worker times.
+`shard_paths` does it for corpus runs, splitting polyglot files over
+shards by their predicted cost; the model is deterministic, so every
+machine computes the same split on its own.
+'''
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import json
+import os
+import re
+import time
+
+import batch
+from parsePolyglot import parse_yaml
+
+FEATURES = ('snippet', 'length', 'tokens', 'depth', 'literal')
+
+# Seconds per unit of each feature, fitted with `./bench.py calibrate`
+# on a CPython 3.11 x86-64 machine. Only the ratios matter for balancing
+DEFAULT_COEFFICIENTS = (1.2e-4, 0.0, 7.6e-6, 2.3e-5, 5.3e-9)
+
+TOKEN_REGEX = re.compile(r'''
+      (?P<string>[bBrRuU]{0,2}(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"))
+    | (?P<number>\d[\w.]*)
+    | (?P<open>[(\[{])
+    | (?P<close>[)\]}])
+    | \w+
+    | [^\s\w]
+''', re.VERBOSE)
+
+
+def features(snippet):
+    '''The cost model's inputs for one snippet, in FEATURES order. The
+    first one is a constant, for the per-snippet overhead'''
+    tokens = depth = max_depth = literal = 0
+    for match in TOKEN_REGEX.finditer(snippet):
+        tokens += 1
+        kind = match.lastgroup
+        if kind == 'open':
+            depth += 1
+            max_depth = max(max_depth, depth)
+        elif kind == 'close':
+            depth -= 1
+        elif kind in ('string', 'number'):
+            literal += len(match.group())
+    return (1, len(snippet), tokens, max_depth, literal)
+
+
+class CostModel(object):
+    '''Predicts transpile time in seconds from features()'''
+
+    def __init__(self, coefficients=DEFAULT_COEFFICIENTS):
+        if len(coefficients) != len(FEATURES):
+            raise ValueError("Expected %d coefficients" % len(FEATURES))
+        self.coefficients = tuple(coefficients)
+
+    def cost(self, snippet):
+        return sum(c * f for c, f in zip(self.coefficients,
+                                         features(snippet)))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(zip(FEATURES, self.coefficients)), f, indent=2)
+
+    def fingerprint(self):
+        '''Identifies the model, so shards split by it can tell'''
+        return hashlib.sha1(json.dumps(
+            self.coefficients).encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls([data[name] for name in FEATURES])
+
+
+def measure(snippets, langs=batch.DEFAULT_LANGS, repeats=3):
+    '''The best of `repeats` transpile times of each snippet'''
+    times = []
+    for snippet in snippets:
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            batch.transpile_one(snippet, langs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best)
+    return times
+
+
+def calibrate(snippets, langs=batch.DEFAULT_LANGS, repeats=3):
+    '''Fits a CostModel to the measured times of `snippets`'''
+    snippets = list(snippets)
+    rows = [features(snippet) for snippet in snippets]
+    return CostModel(fit(rows, measure(snippets, langs, repeats)))
+
+
+def fit(rows, targets):
+    '''Least squares coefficients, none of them negative: a feature
+    that would get a negative weight is dropped and the rest refitted'''
+    used = list(range(len(rows[0])))
+    while True:
+        solution = solve_least_squares(
+            [[row[i] for i in used] for row in rows], targets)
+        negative = [i for i, c in zip(used, solution) if c < 0]
+        if not negative:
+            break
+        used = [i for i in used if i not in negative]
+    coefficients = [0.0] * len(rows[0])
+    for i, c in zip(used, solution):
+        coefficients[i] = c
+    return coefficients
+
+
+def solve_least_squares(rows, targets):
+    '''Solves the normal equations by gaussian elimination. Columns are
+    scaled first, since lengths and literal sizes dwarf the constant'''
+    width = len(rows[0]) if rows else 0
+    if not width:
+        return []
+    scale = [max(abs(row[j]) for row in rows) or 1.0 for j in range(width)]
+    scaled = [[row[j] / scale[j] for j in range(width)] for row in rows]
+    matrix = [[sum(row[i] * row[j] for row in scaled) for j in range(width)]
+              + [sum(row[i] * t for row, t in zip(scaled, targets))]
+              for i in range(width)]
+    for i in range(width):
+        # a tiny ridge keeps features that are always zero solvable
+        matrix[i][i] += 1e-12
+    for col in range(width):
+        pivot = max(range(col, width), key=lambda r: abs(matrix[r][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        for r in range(width):
+            if r != col:
+                factor = matrix[r][col] / matrix[col][col]
+                matrix[r] = [a - factor * b
+                             for a, b in zip(matrix[r], matrix[col])]
+    return [matrix[i][width] / matrix[i][i] / scale[i] for i in range(width)]
+
+
+def lpt(costs, workers):
+    '''Longest-processing-time-first assignment of jobs to workers.
+    Returns (bins, loads): bins[w] lists the job indexes of worker w
+    and loads[w] their total cost'''
+    bins = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    heap = [(0.0, w) for w in range(workers)]
+    order = sorted(range(len(costs)), key=lambda i: -costs[i])
+    for i in order:
+        load, w = heapq.heappop(heap)
+        bins[w].append(i)
+        loads[w] = load + costs[i]
+        heapq.heappush(heap, (loads[w], w))
+    return bins, loads
+
+
+def chunks(count, workers):
+    '''Equal sized contiguous chunks, the naive split'''
+    size, extra = divmod(count, workers)
+    bins, start = [], 0
+    for w in range(workers):
+        end = start + size + (w < extra)
+        bins.append(list(range(start, end)))
+        start = end
+    return bins
+
+
+def imbalance(loads):
+    '''The slowest worker's load over the average one: 1.0 is a
+    perfect balance, 2.0 means the run took twice as long as it could'''
+    mean = sum(loads) / len(loads) if loads else 0
+    return max(loads) / mean if mean else 1.0
+
+
+class ScheduleReport(object):
+    '''Predicted and measured (cpu) seconds of work per worker, and
+    the wall clock time of the whole run'''
+
+    def __init__(self, predicted, measured, elapsed):
+        self.predicted = predicted
+        self.measured = measured
+        self.elapsed = elapsed
+
+    def format(self):
+        return ('%d workers, %.3fs: predicted imbalance %.3f, '
+                'measured %.3f (slowest worker over the average)' % (
+                    len(self.measured), self.elapsed,
+                    imbalance(self.predicted), imbalance(self.measured)))
+
+
+def transpile_scheduled(snippets, langs=batch.DEFAULT_LANGS, reql_vars=None,
+                        max_workers=None, model=None, precheck=True,
+                        budget=None, fold=False, bins=None):
+    '''Like batch.transpile_threaded, but every worker gets a fixed
+    share of the snippets picked by lpt() over the model's costs.
+    Needs all the snippets up front. Returns (results in input order,
+    ScheduleReport). Pass `bins` to use another assignment, like
+    chunks()'''
+    langs = batch.check_langs(langs)
+    snippets = list(snippets)
+    max_workers = max_workers or os.cpu_count() or 1
+    model = model or CostModel()
+    # identical snippets are only transpiled once
+    unique = list(dict.fromkeys(snippets))
+    costs = [model.cost(snippet) for snippet in unique]
+    if bins is None:
+        bins, predicted = lpt(costs, max_workers)
+    else:
+        predicted = [sum(costs[i] for i in b) for b in bins]
+
+    def work(indexes):
+        # cpu time, so waiting for the GIL doesn't count as work
+        start = time.thread_time()
+        done = [(i, batch.transpile_one(unique[i], langs, reql_vars,
+                                        precheck, budget, fold=fold))
+                for i in indexes]
+        return done, time.thread_time() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers) as pool:
+        outcomes = list(pool.map(work, bins))
+    elapsed = time.perf_counter() - start
+    results = {}
+    for done, _ in outcomes:
+        for i, result in done:
+            results[unique[i]] = result
+    report = ScheduleReport(predicted, [t for _, t in outcomes], elapsed)
+    return [results[snippet] for snippet in snippets], report
+
+
+def file_cost(path, model):
+    '''Predicted cost of transpiling a polyglot file: its snippets'''
+    with open(path) as f:
+        parsed = parse_yaml(f.read())
+    total = 0.0
+    for entry in parsed.get('tests') or ():
+        if not isinstance(entry, dict):
+            continue
+        for key in ('cd', 'def'):
+            value = entry.get(key)
+            if isinstance(value, dict):
+                value = value.get('cd')
+            if value is None:
+                continue
+            for snippet in value if isinstance(value, list) else [value]:
+                total += model.cost(str(snippet))
+    return total
+
+
+def shard_paths(paths, count, model=None):
+    '''Splits files over `count` shards by predicted cost. Returns a
+    list of path lists, shard I being element I - 1'''
+    return balance_paths(paths, count, model)[0]
+
+
+def balance_paths(paths, count, model=None):
+    '''shard_paths, plus the predicted cost of every shard'''
+    paths = list(paths)
+    model = model or CostModel()
+    bins, loads = lpt([file_cost(path, model) for path in paths], count)
+    # lpt sorts by cost: give every shard its files in corpus order
+    return [[paths[i] for i in sorted(b)] for b in bins], loads
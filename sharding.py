@@ -0,0 +1,174 @@
+'''Splitting corpus runs over several machines.
+
+A test belongs to shard `shard_of(path, index, count)`, a stable hash of
+the polyglot file (relative to the test directory) and the test's index
+in it, so every machine agrees on the split without talking to the
+others.
+
+A sharded run doesn't reduce its tests into one value, since that
+loses the order the unsharded run would have seen them in. Instead it
+writes what each reducer produced for each test, tagged with the test's
+position, to a partial file. `merge` sorts the per-test results of all
+the partial files back into corpus order and combines them, which gives
+exactly what a single run over the whole corpus would have.
+
+With `--balance` whole files are split by predicted cost instead
+(scheduling.shard_paths). The two splits put tests in different
+shards, and so do two cost models, so a partial file records how it
+was split and `merge` refuses partials that were split differently.
+
+Shards are numbered from 1, as in `--shard 2/4`.
+'''
+
+import hashlib
+import pickle
+from collections import Counter
+
+PARTIAL_FORMAT_VERSION = 2
+
+# How a run's tests were split, see PartialWriter
+HASH_SPLIT = 'hash'
+BALANCED_SPLIT = 'balance'
+
+
+class ShardError(ValueError):
+    pass
+
+
+def parse_shard(text):
+    '''"I/N" -> (I, N)'''
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ShardError("Expected a shard like 2/4, got %r" % text)
+    if not 1 <= index <= count:
+        raise ShardError("Shard %d/%d is out of range" % (index, count))
+    return index, count
+
+
+def shard_of(path, index, count):
+    '''The shard (1 to count) that test `index` of `path` belongs to.
+    Pass index=None to shard whole files'''
+    key = path.replace('\\', '/')
+    if index is not None:
+        key = '%s#%d' % (key, index)
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def combine(total, delta):
+    '''Adds what a reducer produced for one test (`delta`, starting
+    from a fresh initial value) into `total`'''
+    if isinstance(total, Counter):
+        for key, count in delta.items():
+            total[key] += count
+        return total
+    elif isinstance(total, dict):
+        for key, value in delta.items():
+            if key in total:
+                total[key] = combine(total[key], value)
+            else:
+                total[key] = value
+        return total
+    elif isinstance(total, list):
+        total.extend(delta)
+        return total
+    return total + delta
+
+
+def is_empty(value):
+    '''Whether a per-test result added nothing'''
+    if isinstance(value, dict):
+        return all(is_empty(v) for v in value.values())
+    return not value
+
+
+class PartialWriter(object):
+    '''Writes the per-test results of one shard, one pickle at a time
+    so the shard never holds them all in memory. A shard of a balanced
+    run passes the fingerprint of its cost model as `model`'''
+
+    def __init__(self, out, shard, names, model=None):
+        self.out = out
+        pickle.dump({
+            'version': PARTIAL_FORMAT_VERSION,
+            'shard': shard,
+            'reducers': list(names),
+            'split': HASH_SPLIT if model is None else BALANCED_SPLIT,
+            'model': model,
+        }, out, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, position, name, delta):
+        pickle.dump((position, name, delta), self.out,
+                    pickle.HIGHEST_PROTOCOL)
+
+
+def read_partial(f):
+    '''Returns (header, list of (position, name, delta))'''
+    header = pickle.load(f)
+    if header.get('version') != PARTIAL_FORMAT_VERSION:
+        raise ShardError("Unsupported partial file version %r"
+                         % header.get('version'))
+    entries = []
+    while True:
+        try:
+            entries.append(pickle.load(f))
+        except EOFError:
+            return header, entries
+
+
+def merge(partials, initial_values):
+    '''Combines the partial files (open binary files) of every shard of
+    a run. `initial_values` maps reducer name to a fresh initial value,
+    in the order the results should be listed. Returns name -> result'''
+    headers = []
+    entries = []
+    for f in partials:
+        header, shard_entries = read_partial(f)
+        headers.append(header)
+        entries.extend(shard_entries)
+    check_complete(headers)
+    reducers = headers[0]['reducers']
+    if list(initial_values) != reducers:
+        raise ShardError("Partials are for reducers %s" % ', '.join(reducers))
+    results = initial_values
+    entries.sort(key=lambda entry: entry[0])
+    for position, name, delta in entries:
+        results[name] = combine(results[name], delta)
+    return results
+
+
+def check_complete(headers):
+    if not headers:
+        raise ShardError("No partial files to merge")
+    count = headers[0]['shard'][1]
+    reducers = headers[0]['reducers']
+    split = split_of(headers[0])
+    seen = set()
+    for header in headers:
+        index, shard_count = header['shard']
+        if shard_count != count or header['reducers'] != reducers:
+            raise ShardError("Partial files come from different runs")
+        if split_of(header) != split:
+            # the shards would overlap and leave gaps
+            raise ShardError("Partial files were split differently: %s "
+                             "and %s" % (describe_split(split),
+                                         describe_split(split_of(header))))
+        if index in seen:
+            raise ShardError("Shard %d/%d given twice" % (index, count))
+        seen.add(index)
+    missing = sorted(set(range(1, count + 1)) - seen)
+    if missing:
+        raise ShardError("Missing shards: %s" % ', '.join(
+            '%d/%d' % (index, count) for index in missing))
+
+
+def split_of(header):
+    return header['split'], header['model']
+
+
+def describe_split(split):
+    kind, model = split
+    if kind == BALANCED_SPLIT:
+        return "--balance with cost model %s" % model
+    return "by test hash"
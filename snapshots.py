@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+'''Golden output snapshots, for checking that a converter change
+didn't change what the suite transpiles to.
+
+`record` stores the output of a reference run, `check` transpiles the
+suite again and reports only the (snippet, language) pairs whose output
+changed, with the old and new text.
+
+A snapshot is two files. `<name>.blobs` is an append-only file of
+texts (outputs and snippets), each stored once no matter how many keys
+share it. `<name>.idx` maps a hash of (language, snippet) to the hash,
+offset and length of its output blob, plus where to find the snippet
+text. Checking hashes every new output once and compares it with the
+index; the old text is only read back from the blob file for the
+outputs that changed.
+'''
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import struct
+import sys
+
+import batch
+import multireql
+
+INDEX_MAGIC = b'RQLSNAP1'
+# key digest, then digest, offset and length of the output and of the
+# snippet
+RECORD = struct.Struct('<16s16sQI16sQI')
+DIGEST_SIZE = 16
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode('utf-8'),
+                           digest_size=DIGEST_SIZE).digest()
+
+
+def key_digest(snippet, lang):
+    return digest(lang + '\0' + snippet)
+
+
+def result_texts(result):
+    '''(lang, text) for every language of a batch.TranspileResult.
+    Errors are part of the output too, so a snippet that starts or
+    stops failing shows up as a change'''
+    for lang, output in result.outputs.items():
+        yield lang, output
+    for lang, error in result.errors.items():
+        yield lang, '<%s error %s: %s>' % (error.stage, error.kind,
+                                           error.message)
+
+
+class Change(object):
+    '''An output that differs from the snapshot. `before` is None for
+    snippets the snapshot doesn't know, `after` is None for snippets
+    that are gone'''
+
+    __slots__ = ('snippet', 'lang', 'before', 'after')
+
+    def __init__(self, snippet, lang, before, after):
+        self.snippet = snippet
+        self.lang = lang
+        self.before = before
+        self.after = after
+
+    @property
+    def kind(self):
+        if self.before is None:
+            return 'added'
+        elif self.after is None:
+            return 'removed'
+        return 'changed'
+
+    def __repr__(self):
+        return 'Change(%r, %r, %r, %r)' % (self.snippet, self.lang,
+                                           self.before, self.after)
+
+
+class SnapshotStore(object):
+    '''The index is kept in memory, the texts stay on disk'''
+
+    def __init__(self, path):
+        self.index_path = path + '.idx'
+        self.blob_path = path + '.blobs'
+        # key digest -> (output digest, output offset, output length,
+        #                snippet digest, snippet offset, snippet length)
+        self.records = {}
+        # text digest -> (offset, length) in the blob file
+        self.blobs = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s is not a snapshot index" % self.index_path)
+        for fields in RECORD.iter_unpack(data[len(INDEX_MAGIC):]):
+            self.records[fields[0]] = fields[1:]
+            self.blobs[fields[1]] = fields[2:4]
+            self.blobs[fields[4]] = fields[5:7]
+
+    def __len__(self):
+        return len(self.records)
+
+    def _store(self, blob_file, text):
+        '''Appends a text unless it's already there. Returns (digest,
+        offset, length)'''
+        text_digest = digest(text)
+        location = self.blobs.get(text_digest)
+        if location is None:
+            data = text.encode('utf-8')
+            location = self.blobs[text_digest] = (blob_file.tell(),
+                                                  len(data))
+            blob_file.write(data)
+        return (text_digest,) + location
+
+    def record(self, results):
+        '''Replaces the snapshot with the outputs in `results`, an
+        iterable of batch.TranspileResult'''
+        records = {}
+        with open(self.blob_path, 'ab') as blob_file:
+            for result in results:
+                for lang, text in result_texts(result):
+                    records[key_digest(result.snippet, lang)] = (
+                        self._store(blob_file, text) +
+                        self._store(blob_file, result.snippet))
+        self.records = records
+        self._save()
+        return len(records)
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            for key, fields in self.records.items():
+                f.write(RECORD.pack(key, *fields))
+        os.replace(tmp_path, self.index_path)
+
+    def compare(self, results, partial=False):
+        '''Returns the Changes between the snapshot and `results`. With
+        `partial`, results is only part of the suite, so snippets
+        missing from it don't count as removed. A snippet that occurs
+        several times gets one Change per language'''
+        changes = []
+        seen = set()
+        with open(self.blob_path, 'rb') as blob_file:
+            for result in results:
+                for lang, text in result_texts(result):
+                    key = key_digest(result.snippet, lang)
+                    if key in seen:
+                        # the same snippet again elsewhere in the suite
+                        continue
+                    seen.add(key)
+                    record = self.records.get(key)
+                    if record is None:
+                        changes.append(
+                            Change(result.snippet, lang, None, text))
+                    elif record[0] != digest(text):
+                        before = self._read(blob_file, *record[1:3])
+                        changes.append(
+                            Change(result.snippet, lang, before, text))
+            for key, record in self.records.items():
+                if key not in seen and not partial:
+                    snippet = self._read(blob_file, *record[4:6])
+                    lang = self._lang_of(key, snippet)
+                    before = self._read(blob_file, *record[1:3])
+                    changes.append(Change(snippet, lang, before, None))
+        return changes
+
+    def _read(self, blob_file, offset, length):
+        blob_file.seek(offset)
+        return blob_file.read(length).decode('utf-8')
+
+    def _lang_of(self, key, snippet):
+        for lang in batch.LANGUAGES:
+            if key_digest(snippet, lang) == key:
+                return lang
+        return None
+
+
+def corpus_results(test_dir, langs):
+    return batch.transpile_many(multireql.every_snippet(test_dir), langs)
+
+
+def format_change(change):
+    lines = ['%s %s: %s' % (change.kind, change.lang, change.snippet)]
+    if change.before is not None:
+        lines.append('  - %s' % change.before)
+    if change.after is not None:
+        lines.append('  + %s' % change.after)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=('record', 'check'))
+    parser.add_argument('snapshot', help='path without the extension')
+    parser.add_argument('--test-dir', default=multireql.DEFAULT_TEST_DIR)
+    parser.add_argument('--langs', default=','.join(batch.DEFAULT_LANGS))
+    args = parser.parse_args()
+    store = SnapshotStore(args.snapshot)
+    results = corpus_results(args.test_dir, args.langs.split(','))
+    if args.command == 'record':
+        print("Recorded %d outputs" % store.record(results))
+        return
+    changes = store.compare(results)
+    for change in changes:
+        print(format_change(change))
+    # distinct outputs in the snapshot or the current suite
+    total = len(store) + sum(1 for change in changes
+                             if change.kind == 'added')
+    print("%d of %d outputs differ" % (len(changes), total))
+    sys.exit(1 if changes else 0)
+
+
+if __name__ == '__main__':
+    main()
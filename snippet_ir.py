@@ -0,0 +1,355 @@
+'''Serialized form of parsed, flagged snippets, to skip ast.parse and
+the IsReql pass on snippets that were seen before.
+
+A tree is encoded in preorder as nested tuples
+
+    (node type name, is_reql or None, field values...)
+
+with lists kept as lists and position attributes dropped, and the
+nodes without fields or flag (operators and load/store contexts) as
+just `(node type name,)`. `load_tree` turns an encoded tree back into
+ordinary ast nodes (with their is_reql flags), so the converters
+consume it unchanged; loading takes about a third of the time of
+parsing and flagging (`./bench.py ir`).
+
+The encoding is built for loading speed, not size: one snippet's
+marshalled tree is around five times its source text. What makes the
+`.ir` files small is that they're zlib compressed, and a polyglot
+file's trees repeat the same handful of terms, so a file's store
+comes out smaller than the yaml file itself.
+
+An Interner goes the other way for corpus-scale loads: it turns flagged
+trees into a DAG where identical subtrees (same node types, fields and
+is_reql flags all the way down) are one shared node, so the thousands
+of `r.db('test').table('tbl')` in a suite are stored once.
+
+IRStore keeps the encoded trees for one polyglot file in a `.ir` file
+next to it. Entries are keyed by a hash of the snippet text and the
+reql variables it was flagged with, and the whole file is thrown away
+when the flagging rules (the source of IsReql) or the python version
+change.
+
+Corpus runs get their trees from a TreeCache, which puts an IRStore
+(`--ir-cache`) and/or an Interner (`--intern`) in front of the parser.
+'''
+
+import ast
+import functools
+import hashlib
+import inspect
+import logging
+import marshal
+import os
+import sys
+import zlib
+
+import conversion_utils
+
+logger = logging.getLogger('snippet_ir')
+
+IR_FORMAT_VERSION = 2
+
+# Enough for trees this repetitive, and much faster than level 9
+COMPRESSION_LEVEL = 6
+
+_node_classes = {}
+# node type name -> the one instance of a node without fields
+_singletons = {}
+
+
+def rules_fingerprint():
+    '''Changes whenever a stored IR could have been flagged
+    differently'''
+    digest = hashlib.sha1()
+    digest.update(str(IR_FORMAT_VERSION).encode('utf-8'))
+    digest.update(sys.version.encode('utf-8'))
+    digest.update(inspect.getsource(conversion_utils.IsReql).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def encode(node):
+    '''Encodes a flagged ast node'''
+    is_reql = getattr(node, 'is_reql', None)
+    if not node._fields and is_reql is None:
+        return (type(node).__name__,)
+    encoded = [type(node).__name__, is_reql]
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if isinstance(value, ast.AST):
+            value = encode(value)
+        elif isinstance(value, list):
+            value = [encode(v) if isinstance(v, ast.AST) else v
+                     for v in value]
+        encoded.append(value)
+    return tuple(encoded)
+
+
+def load_tree(encoded):
+    '''Rebuilds ast nodes from an encoded tree'''
+    if len(encoded) == 1:
+        # ast.parse shares these between trees too
+        node = _singletons.get(encoded[0])
+        if node is None:
+            node = _singletons[encoded[0]] = getattr(ast, encoded[0])()
+        return node
+    cls = _node_classes.get(encoded[0])
+    if cls is None:
+        cls = _node_classes[encoded[0]] = getattr(ast, encoded[0])
+    attrs = {}
+    for field, value in zip(cls._fields, encoded[2:]):
+        kind = type(value)
+        if kind is tuple:
+            value = load_tree(value)
+        elif kind is list:
+            value = [load_tree(v) if type(v) is tuple else v for v in value]
+        attrs[field] = value
+    if encoded[1] is not None:
+        attrs['is_reql'] = encoded[1]
+    node = cls.__new__(cls)
+    node.__dict__ = attrs
+    return node
+
+
+def scalar_key(value):
+    '''How a non-node field value takes part in a subtree's identity.
+    Unlike ==, this keeps 1, 1.0 and True apart, and 0.0 and -0.0'''
+    if type(value) in (float, complex):
+        return (type(value), repr(value))
+    return (type(value), value)
+
+
+class Interner(object):
+    '''Hash-conses flagged trees: intern() returns a tree whose
+    subtrees are shared with every identical subtree interned before.
+
+    The shared nodes are ordinary ast nodes, because the converters
+    dispatch on the node class (visit_Name, `type(node) == ast.Name`)
+    and read fields by name. That rules out a separate class with
+    __slots__: ast.AST instances always carry a __dict__, so slots on a
+    subclass would save nothing and the subclass would fail the type
+    checks. Instead a shared node's __dict__ holds only its fields and
+    is_reql, without the four position attributes, and the saving
+    comes from storing every distinct subtree once.
+
+    Shared nodes must not be modified. The converters only read them,
+    and folding.py and hoisting.py build new nodes rather than change
+    old ones. So that no caller interns a tree it goes on to modify,
+    parse() is the only way in: it interns trees it just built itself.
+    Line numbers are dropped, as in load_tree, which is also what stops
+    add_is_reql_flags from flagging a shared tree again'''
+
+    def __init__(self):
+        # (class, is_reql, field keys...) -> node, where a child node's
+        # key is the id() of its interned node, kept alive by this dict
+        self.nodes = {}
+        # (snippet, reql vars) -> interned tree
+        self.roots = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _intern(self, node):
+        cls = type(node)
+        is_reql = getattr(node, 'is_reql', None)
+        key = [cls, is_reql]
+        attrs = {}
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, ast.AST):
+                value = self._intern(value)
+                key.append(id(value))
+            elif isinstance(value, list):
+                value = [self._intern(v) if isinstance(v, ast.AST) else v
+                         for v in value]
+                key.append(tuple(id(v) if isinstance(v, ast.AST)
+                                 else scalar_key(v) for v in value))
+            else:
+                key.append(scalar_key(value))
+            attrs[field] = value
+        key = tuple(key)
+        shared = self.nodes.get(key)
+        if shared is not None:
+            self.hits += 1
+            return shared
+        self.misses += 1
+        if is_reql is not None:
+            attrs['is_reql'] = is_reql
+        shared = cls.__new__(cls)
+        shared.__dict__ = attrs
+        self.nodes[key] = shared
+        return shared
+
+    def parse(self, snippet, reql_vars=None, parse=None):
+        '''Parses, flags and interns a snippet. `parse(snippet,
+        reql_vars)` does the first two, returning a tree nothing else
+        holds on to (parse_snippet by default). A snippet seen before
+        isn't parsed again'''
+        key = (snippet, frozenset(reql_vars or ()))
+        root = self.roots.get(key)
+        if root is None:
+            root = self.roots[key] = self._intern(
+                (parse or parse_snippet)(snippet, reql_vars))
+        return root
+
+
+def parse_snippet(snippet, reql_vars=None):
+    node = ast.parse(snippet, mode='eval').body
+    conversion_utils.add_is_reql_flags(node, reql_vars)
+    return node
+
+
+def dumps(node):
+    return marshal.dumps(encode(node))
+
+
+def loads(data):
+    return load_tree(marshal.loads(data))
+
+
+def snippet_key(snippet, reql_vars=None):
+    digest = hashlib.sha1(snippet.encode('utf-8'))
+    for var in sorted(reql_vars or ()):
+        digest.update(b'\0')
+        digest.update(var.encode('utf-8'))
+    return digest.digest()
+
+
+def ir_path(yaml_path):
+    return yaml_path + '.ir'
+
+
+class IRStore(object):
+    '''Encoded trees for the snippets of one polyglot file'''
+
+    def __init__(self, path, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint or rules_fingerprint()
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    @classmethod
+    def for_yaml(cls, yaml_path, fingerprint=None):
+        return cls(ir_path(yaml_path), fingerprint)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                stored = marshal.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                zlib.error):
+            return
+        if not isinstance(stored, dict) or \
+           stored.get('fingerprint') != self.fingerprint:
+            logger.info("Discarding stale IR in %s", self.path)
+            self.dirty = True
+            return
+        self.entries = stored['entries']
+
+    def get(self, snippet, reql_vars=None):
+        '''Returns the flagged tree for a snippet, or None'''
+        key = snippet_key(snippet, reql_vars)
+        encoded = self.entries.get(key)
+        if encoded is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add(key)
+        return load_tree(encoded)
+
+    def put(self, snippet, node, reql_vars=None):
+        key = snippet_key(snippet, reql_vars)
+        self.entries[key] = encode(node)
+        self.used.add(key)
+        self.dirty = True
+
+    def add(self, snippet, node, reql_vars=None):
+        '''put(), unless the snippet is already stored'''
+        key = snippet_key(snippet, reql_vars)
+        if key in self.entries:
+            self.used.add(key)
+        else:
+            self.put(snippet, node, reql_vars)
+
+    def parse(self, snippet, reql_vars=None, parse=None):
+        '''Returns the stored tree of a snippet, or parses and stores
+        it with `parse(snippet, reql_vars)` (parse_snippet by default,
+        batch.parse for metrics)'''
+        node = self.get(snippet, reql_vars)
+        if node is None:
+            node = (parse or parse_snippet)(snippet, reql_vars)
+            self.put(snippet, node, reql_vars)
+        return node
+
+    def save(self, prune=True):
+        '''Writes the store back. With `prune`, only entries used since
+        it was opened are kept, which drops snippets that were edited
+        or removed from the polyglot file'''
+        if prune and len(self.used) != len(self.entries):
+            self.entries = {k: v for k, v in self.entries.items()
+                            if k in self.used}
+            self.dirty = True
+        if not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(marshal.dumps({
+                'fingerprint': self.fingerprint,
+                'entries': self.entries,
+            }), COMPRESSION_LEVEL))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class TreeCache(object):
+    '''Where a corpus run gets its flagged trees. With `ir`, every
+    polyglot file's trees are kept in an IRStore next to it; with
+    `intern`, identical subtrees are shared through one Interner.
+    `parse(snippet, reql_vars)` parses what neither has. Call save() at
+    the end of the run to write the stores back'''
+
+    def __init__(self, ir=True, intern=False, parse=None):
+        self.ir = ir
+        self.interner = Interner() if intern else None
+        self.fallback = parse or parse_snippet
+        self.fingerprint = rules_fingerprint() if ir else None
+        # yaml path -> IRStore
+        self.stores = {}
+
+    def store(self, yaml_path):
+        store = self.stores.get(yaml_path)
+        if store is None:
+            store = self.stores[yaml_path] = IRStore.for_yaml(
+                yaml_path, self.fingerprint)
+        return store
+
+    def parse(self, yaml_path, snippet, reql_vars=None):
+        '''Returns the flagged tree of a snippet of the file at
+        `yaml_path`'''
+        if not self.ir:
+            if self.interner is None:
+                return self.fallback(snippet, reql_vars)
+            return self.interner.parse(snippet, reql_vars, self.fallback)
+        store = self.store(yaml_path)
+        if self.interner is None:
+            return store.parse(snippet, reql_vars, self.fallback)
+        node = self.interner.parse(snippet, reql_vars, functools.partial(
+            store.parse, parse=self.fallback))
+        # the interner doesn't ask the store for snippets it has seen
+        # in other files, but this file's store still needs them
+        store.add(snippet, node, reql_vars)
+        return node
+
+    def parser(self, yaml_path):
+        '''parse() for the snippets of one file'''
+        return functools.partial(self.parse, yaml_path)
+
+    def save(self, prune=True):
+        '''Writes every IRStore back, see IRStore.save'''
+        for store in self.stores.values():
+            store.save(prune)
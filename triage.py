@@ -0,0 +1,176 @@
+'''Groups incorrect transpiles by what is different about them.
+
+Both the transpiled and the hand-written outputs are tokenized and
+diffed, and every differing region is described by a normalized label
+like "quote style" or "parens added". The sorted set of labels is the
+signature of the mismatch, and mismatches are bucketed by signature in
+a single pass, so large result sets can be summarized without
+comparing mismatches to each other.
+'''
+
+import difflib
+import re
+from collections import OrderedDict
+
+from reports import TRANSPILED_KEYS
+
+TOKEN_REGEX = re.compile(r'''
+    (?P<STR>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<NUM>\d+(?:\.\d+)?(?:[eE][-+]?\d+)?L?)
+  | (?P<NAME>[A-Za-z_@$][A-Za-z0-9_]*[?!]?)
+  | (?P<OP>\.\.\.|\.\.|\*\*|=>|->|==|!=|<=|>=|&&|\|\||::|\S)
+''', re.VERBOSE)
+
+PARENS = {'(', ')'}
+PUNCTUATION_LABEL = re.compile(r'(insert|delete)( OP)+$|paren')
+BLOCK_MARKERS = {'lambda', 'proc', 'Proc', '->'}
+
+# Field names of the hand-written output in the mismatches of the
+# corpus runners in multireql.py
+EXPECTED_KEYS = ('custom', 'handcrafted_ruby')
+
+
+def tokenize(text):
+    '''Returns (kind, value) tuples, ignoring whitespace'''
+    return [(m.lastgroup, m.group(m.lastgroup))
+            for m in TOKEN_REGEX.finditer(text)]
+
+
+def unquote(token):
+    return token[1][1:-1]
+
+
+def number_value(token):
+    try:
+        return float(token[1].rstrip('L'))
+    except ValueError:
+        return None
+
+
+def is_symbol_for(tokens, string_token):
+    return [t[1] for t in tokens] == [':', unquote(string_token)]
+
+
+def label_region(tag, left, right, before):
+    '''Describes one differing region of the token streams.
+    `left` comes from the transpiled output, `right` from the
+    hand-written one, `before` is the token preceding the region'''
+    left_values = [t[1] for t in left]
+    right_values = [t[1] for t in right]
+    changed = set(left_values) | set(right_values)
+    if tag != 'replace' and changed <= PARENS:
+        if before in ('|', ','):
+            return 'paren around lambda arg'
+        return 'parens added' if tag == 'delete' else 'parens missing'
+    if BLOCK_MARKERS & changed or \
+       (left_values[:2] == ['{', '|']) != (right_values[:2] == ['{', '|']):
+        return 'block vs argument'
+    if changed == {'.', 'expr'} or left_values in (['r'], ['r', '.', 'expr']) \
+       and right_values in (['r'], ['r', '.', 'expr']):
+        return 'r() vs r.expr()'
+    if tag != 'replace':
+        return '%s %s' % (tag, ' '.join(t[0] for t in (left or right)[:4]))
+    if len(left) == len(right):
+        if all(l[0] == r[0] == 'STR' and unquote(l) == unquote(r)
+               for l, r in zip(left, right)):
+            return 'quote style'
+        if all(l[0] == r[0] == 'NUM' and
+               number_value(l) == number_value(r)
+               for l, r in zip(left, right)):
+            return 'number format'
+    if (len(left) == 1 and left[0][0] == 'STR' and
+        is_symbol_for(right, left[0])) or \
+       (len(right) == 1 and right[0][0] == 'STR' and
+        is_symbol_for(left, right[0])):
+        return 'symbol vs string'
+    if ('=>' in left_values) != ('=>' in right_values):
+        return 'hash syntax'
+    if len(left) == len(right) == 1 and left[0][0] == right[0][0] == 'NAME':
+        return 'name %s -> %s' % (left_values[0], right_values[0])
+    return 'replace %s -> %s' % (
+        ' '.join(t[0] for t in left[:4]),
+        ' '.join(t[0] for t in right[:4]))
+
+
+def diff_signature(transpiled, expected):
+    '''The sorted, deduplicated labels of all differing regions'''
+    left = tokenize(transpiled)
+    right = tokenize(expected)
+    if left == right:
+        return ('whitespace',)
+    matcher = difflib.SequenceMatcher(None, left, right, autojunk=False)
+    labels = set()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            before = left[i1 - 1][1] if i1 else None
+            labels.add(
+                label_region(tag, left[i1:i2], right[j1:j2], before))
+    if 'block vs argument' in labels:
+        # turning a block into an argument moves punctuation around too
+        labels = {l for l in labels if not PUNCTUATION_LABEL.match(l)}
+    return tuple(sorted(labels))
+
+
+def closest(transpiled, candidates):
+    '''Polyglot tests can list several acceptable outputs; compare
+    against the most similar one'''
+    if not isinstance(candidates, list):
+        return candidates
+    return max(candidates, key=lambda c: difflib.SequenceMatcher(
+        None, transpiled, c, autojunk=False).quick_ratio())
+
+
+def first_key(mismatch, keys):
+    for key in keys:
+        if key in mismatch:
+            return mismatch[key]
+    raise KeyError(keys)
+
+
+def mismatch_texts(mismatch):
+    '''(transpiled, expected) from a result dict or a reports.Record'''
+    if not isinstance(mismatch, dict):
+        return mismatch.transpiled, mismatch.expected
+    return (first_key(mismatch, TRANSPILED_KEYS),
+            first_key(mismatch, EXPECTED_KEYS))
+
+
+class Cluster(object):
+    __slots__ = ('signature', 'count', 'examples')
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.count = 0
+        self.examples = []
+
+    def __repr__(self):
+        return 'Cluster(%r, count=%d)' % (self.signature, self.count)
+
+
+def cluster_mismatches(mismatches, max_examples=3):
+    '''Buckets the `incorrect` entries from check_ruby or
+    check_if_python_works (dicts or reports.Record). Returns clusters,
+    biggest first'''
+    clusters = OrderedDict()
+    for mismatch in mismatches:
+        transpiled, expected = mismatch_texts(mismatch)
+        expected = closest(transpiled, expected)
+        signature = diff_signature(transpiled, expected)
+        cluster = clusters.get(signature)
+        if cluster is None:
+            cluster = clusters[signature] = Cluster(signature)
+        cluster.count += 1
+        if len(cluster.examples) < max_examples:
+            cluster.examples.append(mismatch)
+    return sorted(clusters.values(), key=lambda c: -c.count)
+
+
+def format_clusters(clusters):
+    lines = []
+    for cluster in clusters:
+        lines.append('%6d  %s' % (cluster.count, '; '.join(cluster.signature)))
+        for example in cluster.examples:
+            transpiled, expected = mismatch_texts(example)
+            lines.append('          transpiled: %s' % transpiled)
+            lines.append('          expected:   %s' % expected)
+    return '\n'.join(lines)
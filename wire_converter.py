@@ -0,0 +1,386 @@
+'''Converts a flagged python ast into the ReQL wire format: the JSON term
+tree (`[TERM_TYPE, [args...], {optargs}]`) that the python driver would
+send for the query, so a harness can send it as is without building it
+through a driver. Since it doesn't depend on any driver's syntax, it
+also works as a fingerprint for comparing what the languages produce.
+
+It follows what the python driver does when it builds the query:
+
+- `r.expr(x)` is just x. Lists become MAKE_ARRAY terms, dicts plain
+  JSON objects, bytes BINARY pseudo-types
+- lambdas become FUNC terms, their arguments VAR terms. Variables are
+  numbered from 1 in the order the lambdas appear, so the output is
+  the same every time (the driver uses a process-wide counter)
+- an argument that uses `r.row` (IMPLICIT_VAR) is wrapped in a one
+  argument FUNC, like the driver's func_wrap, but only where the
+  driver calls func_wrap (FUNC_ARGUMENTS). Anywhere else r.row stays
+  an IMPLICIT_VAR for the enclosing method to wrap:
+
+    >>> import batch
+    >>> Visitor().convert(batch.parse(
+    ...     "r.table('t').filter(r.row['a'].add(r.row['b']) > 1)"))
+    '[39,[[15,["t"]],[69,[[2,[1]],[21,[[24,[[170,[[13,[]],"a"]],[170,[[13,[]],"b"]]]],1]]]]]]'
+
+- `x[i]` is BRACKET, `x[a:b]` SLICE, with `x[a:]` closed on the right
+- native arithmetic is computed the way python would compute it
+  (folding.py's 'json' semantics); anything native that's left, like a
+  call to a test helper, can't be serialized and raises
+
+Names other than `r` and lambda arguments (like the table variables of
+a polyglot file) only get a value at runtime, so they raise too.
+'''
+
+import ast
+import base64
+import json
+import logging
+
+try:
+    from io import StringIO
+except ImportError:
+    from cStringIO import StringIO
+
+import folding
+from conversion_utils import subscript_index
+
+logger = logging.getLogger('wire_converter')
+
+# Term.TermType from ql2.proto
+TERM_TYPES = {
+    'DATUM': 1, 'MAKE_ARRAY': 2, 'MAKE_OBJ': 3, 'VAR': 10,
+    'JAVASCRIPT': 11, 'UUID': 169, 'HTTP': 153, 'ERROR': 12,
+    'IMPLICIT_VAR': 13, 'DB': 14, 'TABLE': 15, 'GET': 16, 'GET_ALL': 78,
+    'EQ': 17, 'NE': 18, 'LT': 19, 'LE': 20, 'GT': 21, 'GE': 22, 'NOT': 23,
+    'ADD': 24, 'SUB': 25, 'MUL': 26, 'DIV': 27, 'MOD': 28, 'FLOOR': 183,
+    'CEIL': 184, 'ROUND': 185, 'APPEND': 29, 'PREPEND': 80,
+    'DIFFERENCE': 95, 'SET_INSERT': 88, 'SET_INTERSECTION': 89,
+    'SET_UNION': 90, 'SET_DIFFERENCE': 91, 'SLICE': 30, 'SKIP': 70,
+    'LIMIT': 71, 'OFFSETS_OF': 87, 'CONTAINS': 93, 'GET_FIELD': 31,
+    'KEYS': 94, 'VALUES': 186, 'OBJECT': 143, 'HAS_FIELDS': 32,
+    'WITH_FIELDS': 96, 'PLUCK': 33, 'WITHOUT': 34, 'MERGE': 35,
+    'BETWEEN_DEPRECATED': 36, 'BETWEEN': 182, 'REDUCE': 37, 'MAP': 38,
+    'FOLD': 187, 'FILTER': 39, 'CONCAT_MAP': 40, 'ORDER_BY': 41,
+    'DISTINCT': 42, 'COUNT': 43, 'IS_EMPTY': 86, 'UNION': 44, 'NTH': 45,
+    'BRACKET': 170, 'INNER_JOIN': 48, 'OUTER_JOIN': 49, 'EQ_JOIN': 50,
+    'ZIP': 72, 'RANGE': 173, 'INSERT_AT': 82, 'DELETE_AT': 83,
+    'CHANGE_AT': 84, 'SPLICE_AT': 85, 'COERCE_TO': 51, 'TYPE_OF': 52,
+    'UPDATE': 53, 'DELETE': 54, 'REPLACE': 55, 'INSERT': 56,
+    'DB_CREATE': 57, 'DB_DROP': 58, 'DB_LIST': 59, 'TABLE_CREATE': 60,
+    'TABLE_DROP': 61, 'TABLE_LIST': 62, 'CONFIG': 174, 'STATUS': 175,
+    'WAIT': 177, 'RECONFIGURE': 176, 'REBALANCE': 179, 'SYNC': 138,
+    'GRANT': 188, 'INDEX_CREATE': 75, 'INDEX_DROP': 76, 'INDEX_LIST': 77,
+    'INDEX_STATUS': 139, 'INDEX_WAIT': 140, 'INDEX_RENAME': 156,
+    'SET_WRITE_HOOK': 189, 'GET_WRITE_HOOK': 190, 'FUNCALL': 64,
+    'BRANCH': 65, 'OR': 66, 'AND': 67, 'FOR_EACH': 68, 'FUNC': 69,
+    'ASC': 73, 'DESC': 74, 'INFO': 79, 'MATCH': 97, 'UPCASE': 141,
+    'DOWNCASE': 142, 'SAMPLE': 81, 'DEFAULT': 92, 'JSON': 98,
+    'TO_JSON_STRING': 172, 'ISO8601': 99, 'TO_ISO8601': 100,
+    'EPOCH_TIME': 101, 'TO_EPOCH_TIME': 102, 'NOW': 103,
+    'IN_TIMEZONE': 104, 'DURING': 105, 'DATE': 106, 'TIME_OF_DAY': 126,
+    'TIMEZONE': 127, 'YEAR': 128, 'MONTH': 129, 'DAY': 130,
+    'DAY_OF_WEEK': 131, 'DAY_OF_YEAR': 132, 'HOURS': 133, 'MINUTES': 134,
+    'SECONDS': 135, 'TIME': 136, 'MONDAY': 107, 'TUESDAY': 108,
+    'WEDNESDAY': 109, 'THURSDAY': 110, 'FRIDAY': 111, 'SATURDAY': 112,
+    'SUNDAY': 113, 'JANUARY': 114, 'FEBRUARY': 115, 'MARCH': 116,
+    'APRIL': 117, 'MAY': 118, 'JUNE': 119, 'JULY': 120, 'AUGUST': 121,
+    'SEPTEMBER': 122, 'OCTOBER': 123, 'NOVEMBER': 124, 'DECEMBER': 125,
+    'LITERAL': 137, 'GROUP': 144, 'SUM': 145, 'AVG': 146, 'MIN': 147,
+    'MAX': 148, 'SPLIT': 149, 'UNGROUP': 150, 'RANDOM': 151,
+    'CHANGES': 152, 'ARGS': 154, 'BINARY': 155, 'GEOJSON': 157,
+    'TO_GEOJSON': 158, 'POINT': 159, 'LINE': 160, 'POLYGON': 161,
+    'DISTANCE': 162, 'INTERSECTS': 163, 'INCLUDES': 164, 'CIRCLE': 165,
+    'GET_INTERSECTING': 166, 'FILL': 167, 'GET_NEAREST': 168,
+    'POLYGON_SUB': 171, 'MINVAL': 180, 'MAXVAL': 181, 'BIT_AND': 191,
+    'BIT_OR': 192, 'BIT_XOR': 193, 'BIT_NOT': 194, 'BIT_SAL': 195,
+    'BIT_SAR': 196,
+}
+
+MAKE_ARRAY = TERM_TYPES['MAKE_ARRAY']
+VAR = TERM_TYPES['VAR']
+IMPLICIT_VAR = TERM_TYPES['IMPLICIT_VAR']
+FUNC = TERM_TYPES['FUNC']
+FUNCALL = TERM_TYPES['FUNCALL']
+BRACKET = TERM_TYPES['BRACKET']
+SLICE = TERM_TYPES['SLICE']
+
+# Python method names that aren't the term's name in lower case
+METHOD_ALIASES = {
+    'and_': 'AND',
+    'or_': 'OR',
+    'not_': 'NOT',
+    'js': 'JAVASCRIPT',
+    'to_json': 'TO_JSON_STRING',
+}
+
+# The methods whose arguments the python driver passes through
+# func_wrap, and the first of their arguments it wraps: map and do
+# only wrap their function, the last argument
+FUNC_ARGUMENTS = {
+    'filter': 0, 'concat_map': 0, 'order_by': 0, 'asc': 0, 'desc': 0,
+    'group': 0, 'merge': 0, 'update': 0, 'replace': 0, 'reduce': 0,
+    'fold': 0, 'count': 0, 'sum': 0, 'avg': 0, 'min': 0, 'max': 0,
+    'contains': 0, 'offsets_of': 0, 'for_each': 0, 'index_create': 1,
+    'map': -1, 'do': -1,
+}
+
+# r.<name> without a call
+CONSTANTS = {
+    'minval', 'maxval', 'monday', 'tuesday', 'wednesday', 'thursday',
+    'friday', 'saturday', 'sunday', 'january', 'february', 'march',
+    'april', 'may', 'june', 'july', 'august', 'september', 'october',
+    'november', 'december',
+}
+
+BINARY_OPERATORS = {
+    ast.Add: 'ADD',
+    ast.Sub: 'SUB',
+    ast.Mult: 'MUL',
+    ast.Div: 'DIV',
+    ast.Mod: 'MOD',
+    ast.BitAnd: 'AND',
+    ast.BitOr: 'OR',
+}
+
+COMPARISONS = {
+    ast.Eq: 'EQ',
+    ast.NotEq: 'NE',
+    ast.Lt: 'LT',
+    ast.LtE: 'LE',
+    ast.Gt: 'GT',
+    ast.GtE: 'GE',
+}
+
+# `1 < x` is x.__gt__(1) in python
+REFLECTED = {
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+
+
+def term_type(method):
+    name = METHOD_ALIASES.get(method, method.rstrip('_').upper())
+    try:
+        return TERM_TYPES[name]
+    except KeyError:
+        raise Exception("Unknown ReQL term: %s" % method)
+
+
+def make_term(kind, args, optargs=None):
+    if optargs:
+        return [kind, args, optargs]
+    return [kind, args]
+
+
+def binary_datum(data):
+    return {'$reql_type$': 'BINARY',
+            'data': base64.b64encode(data).decode('ascii')}
+
+
+def uses_implicit_var(term):
+    '''Whether `term` uses r.row outside of any function of its own'''
+    if isinstance(term, dict):
+        return any(uses_implicit_var(v) for v in term.values())
+    if not isinstance(term, list):
+        return False
+    if term[0] == IMPLICIT_VAR:
+        return True
+    if term[0] == FUNC:
+        return False
+    return any(uses_implicit_var(arg) for arg in term[1]) or \
+        (len(term) > 2 and uses_implicit_var(term[2]))
+
+
+class Visitor(ast.NodeVisitor):
+    '''Converts python ast nodes into a wire format JSON string'''
+
+    def __init__(self, reql_vars=frozenset("r"), out=None):
+        self.reql_vars = reql_vars
+        super(Visitor, self).__init__()
+        self.reset(out)
+
+    def reset(self, out=None):
+        '''Starts a fresh output buffer so the visitor can be reused'''
+        self.out = StringIO() if out is None else out
+        self.write = self.out.write
+        # lambda argument name -> VAR number, innermost lambda last
+        self.scopes = []
+        self.next_var = 1
+
+    def convert(self, node):
+        '''Converts a flagged expression to its JSON term tree'''
+        term = self.visit(folding.fold(node, 'json'))
+        self.write(json.dumps(term, separators=(',', ':'), allow_nan=False))
+        return self.out.getvalue()
+
+    def new_var(self):
+        number = self.next_var
+        self.next_var += 1
+        return number
+
+    def generic_visit(self, node):
+        logger.error("While serializing: %s", ast.dump(node))
+        raise Exception("Can't serialize %s" % type(node).__name__)
+
+    def argument(self, node):
+        '''A method argument, wrapped in a function if it uses r.row'''
+        term = self.visit(node)
+        if uses_implicit_var(term):
+            return [FUNC, [[MAKE_ARRAY, [self.new_var()]], term]]
+        return term
+
+    def visit_Constant(self, node):
+        value = node.value
+        if isinstance(value, bytes):
+            return binary_datum(value)
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        raise Exception("Can't serialize %r" % (value,))
+
+    def visit_List(self, node):
+        return [MAKE_ARRAY, [self.visit(elt) for elt in node.elts]]
+
+    def visit_Tuple(self, node):
+        return self.visit_List(node)
+
+    def visit_Dict(self, node):
+        obj = {}
+        for key, value in zip(node.keys, node.values):
+            if type(key) != ast.Constant or not isinstance(key.value, str):
+                raise Exception("Object keys must be strings")
+            obj[key.value] = self.visit(value)
+        return obj
+
+    def visit_Name(self, node):
+        for scope in reversed(self.scopes):
+            if node.id in scope:
+                return [VAR, [scope[node.id]]]
+        if node.id == 'r':
+            raise Exception("r on its own isn't a term")
+        raise Exception("%s only has a value at runtime" % node.id)
+
+    def visit_Lambda(self, node):
+        args = node.args
+        if args.vararg or args.kwarg or args.defaults or args.kwonlyargs:
+            raise Exception("Lambdas can only take plain arguments")
+        scope = {arg.arg: self.new_var() for arg in args.args}
+        self.scopes.append(scope)
+        try:
+            body = self.visit(node.body)
+        finally:
+            self.scopes.pop()
+        return [FUNC, [[MAKE_ARRAY, [scope[arg.arg] for arg in args.args]],
+                       body]]
+
+    def is_r(self, node):
+        return type(node) == ast.Name and node.id == 'r' and \
+            not any('r' in scope for scope in self.scopes)
+
+    def visit_Attribute(self, node):
+        if self.is_r(node.value):
+            if node.attr == 'row':
+                return [IMPLICIT_VAR, []]
+            if node.attr in CONSTANTS:
+                return [term_type(node.attr), []]
+        raise Exception("Can't serialize the attribute %s" % node.attr)
+
+    def visit_Call(self, node):
+        if type(node.func) != ast.Attribute or \
+           not getattr(node, 'is_reql', False):
+            raise Exception("Can't serialize a call to a native function")
+        method = node.func.attr
+        receiver = node.func.value
+        top = self.is_r(receiver)
+        args = list(node.args)
+        optargs = {}
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                raise Exception("Can't serialize **kwargs")
+            optargs[keyword.arg] = self.visit(keyword.value)
+        if any(type(arg) == ast.Starred for arg in args):
+            raise Exception("Can't serialize *args")
+        if top and method == 'expr':
+            if len(args) != 1:
+                raise Exception("r.expr takes one argument")
+            if optargs:
+                raise Exception("Can't serialize the optargs of r.expr")
+            return self.visit(args[0])
+        if top and method == 'binary' and len(args) == 1 and \
+           type(args[0]) == ast.Constant and \
+           isinstance(args[0].value, bytes):
+            return binary_datum(args[0].value)
+        term_args = self.arguments(method, args)
+        if method == 'do':
+            # the function goes first: x.do(y, f) is FUNCALL(f, x, y)
+            if not args:
+                raise Exception("do needs a function")
+            values = ([] if top else [self.visit(receiver)]) + \
+                term_args[:-1]
+            return make_term(FUNCALL, term_args[-1:] + values, optargs)
+        kind = term_type(method)
+        if not top:
+            term_args.insert(0, self.visit(receiver))
+        return make_term(kind, term_args, optargs)
+
+    def arguments(self, method, args):
+        '''The terms of a method's arguments, with the ones the driver
+        would pass through func_wrap wrapped'''
+        first = FUNC_ARGUMENTS.get(method)
+        if first is None:
+            return [self.visit(arg) for arg in args]
+        if first < 0:
+            first += len(args)
+        return [self.argument(arg) if i >= first else self.visit(arg)
+                for i, arg in enumerate(args)]
+
+    def visit_Subscript(self, node):
+        if not getattr(node, 'is_reql', False):
+            raise Exception("Can't serialize a native subscript")
+        value = self.visit(node.value)
+        index = subscript_index(node.slice)
+        if index is not None:
+            return [BRACKET, [value, self.visit(index)]]
+        slc = node.slice
+        if type(slc) != ast.Slice or slc.step is not None:
+            raise Exception("Can't serialize this slice")
+        lower = 0 if slc.lower is None else self.visit(slc.lower)
+        if slc.upper is None:
+            return [SLICE, [value, lower, -1], {'right_bound': 'closed'}]
+        return [SLICE, [value, lower, self.visit(slc.upper)]]
+
+    def visit_BinOp(self, node):
+        name = BINARY_OPERATORS.get(type(node.op))
+        if name is None or not node.is_reql:
+            raise Exception("Can't serialize the native operation %s"
+                            % type(node.op).__name__)
+        # reflected operators keep the order too: 1 + x is Add(1, x)
+        return [TERM_TYPES[name], [self.visit(node.left),
+                                   self.visit(node.right)]]
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1:
+            raise Exception("Can't serialize chained comparisons")
+        op = type(node.ops[0])
+        left, right = node.left, node.comparators[0]
+        if op not in COMPARISONS or not node.is_reql:
+            raise Exception("Can't serialize the comparison %s"
+                            % op.__name__)
+        if not left.is_reql:
+            left, right, op = right, left, REFLECTED[op]
+        return [TERM_TYPES[COMPARISONS[op]],
+                [self.visit(left), self.visit(right)]]
+
+    def visit_UnaryOp(self, node):
+        if type(node.op) == ast.Invert and node.operand.is_reql:
+            return [TERM_TYPES['NOT'], [self.visit(node.operand)]]
+        operand = node.operand
+        if type(node.op) in (ast.USub, ast.UAdd) and \
+           type(operand) == ast.Constant and \
+           type(operand.value) in (int, float):
+            return -operand.value if type(node.op) == ast.USub \
+                else operand.value
+        raise Exception("Can't serialize the unary %s"
+                        % type(node.op).__name__)